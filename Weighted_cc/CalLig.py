@@ -1,68 +1,152 @@
-import sys
-import decimal
+import heapq
+import math
 import numpy as np
+from scipy import linalg, sparse
+from scipy.sparse.csgraph import connected_components
 from Graphs import Graph
 import csv
-decimal.getcontext().rounding = "ROUND_HALF_UP"
 
 def set_node_map(graph):
-    node_map = [[decimal.Decimal(sys.maxsize) if (val1 != val2) else decimal.Decimal(0.0) for val2 in range(len(graph.V))]
-            for val1 in range(len(graph.V))]
+    # sparse adjacency: node_map[i] maps every neighbour of node i to the squared error of the pair
+    node_map = [dict() for i in range(len(graph.V))]
     for x, y, val in graph.nodelist:
-        node_map[graph.V.index(x)][graph.V.index(y)] = node_map[graph.V.index(y)][graph.V.index(x)] = decimal.Decimal(val ** 2)
+        i, j = graph.nodeIndex[x], graph.nodeIndex[y]
+        node_map[i][j] = node_map[j][i] = float(val) ** 2
     return  node_map
 
 def cal_node_path_independent_error(node,node_map):
-    node_rel=[[decimal.Decimal(-1) if (p==sys.maxsize) else p for p in n]for n in node_map]
-    no_ref_error=[np.max(n) for n in node_rel]
+    no_ref_error=[max([0.0] + list(n.values())) for n in node_map]
     return no_ref_error
 
 def cal_node_path_dependent_error(source,node,node_map):
+    # Dijkstra with a binary heap, the distance of a node is the sum of the squared pair errors along its path
     vertex_num=len(node)
-    visited=[False for i in range(vertex_num)]
-    visited[source]=True;
-    dist=[0 for i in range(vertex_num)]
-    pre = [0 for i in range(vertex_num)]
-    for i in range(len(node)):
-        dist[i]=node_map[source][i];
-        pre[i]=source;
-    for i in range(1,vertex_num):
-        min_cost=sys.maxsize
-        for j in range(vertex_num):
-            if visited[j]==False and dist[j]<min_cost:
-                min_cost_index=j
-                min_cost=dist[j]
-        visited[min_cost_index]=True
-        for j in range(vertex_num):
-            if visited[j]==False and node_map[min_cost_index][j] != sys.maxsize and min_cost+node_map[min_cost_index][j]<dist[j]:
-                dist[j]=min_cost+node_map[min_cost_index][j]
-                pre[j]= min_cost_index
+    dist=[math.inf for i in range(vertex_num)]
+    pre=[None for i in range(vertex_num)]
+    dist[source]=0.0
+    heap=[(0.0, source)]
+    while heap:
+        min_cost, i = heapq.heappop(heap)
+        if min_cost > dist[i]:
+            continue
+        for j, val in node_map[i].items():
+            if min_cost + val < dist[j]:
+                dist[j] = min_cost + val
+                pre[j] = i
+                heapq.heappush(heap, (dist[j], j))
 
+    # path from every node to the source, None if the node can't be reached
     path_all=[]
     for i in range(0,vertex_num):
-        path=[]
-        path.append(i)
-        if i!=source :
-            t=pre[i]
-            path.append(t)
-            while t!=source:
-                t=pre[t]
-                path.append(t)
+        path=None
+        if dist[i] < math.inf:
+            path=[i]
+            while path[-1]!=source:
+                path.append(pre[path[-1]])
         path_all.append(path)
 
     return dist,path_all
 
+def cal_reference_errors(node,node_map):
+    # network-wide error with every node as the reference: root mean square and maximum of the path dependent errors
+    # of the other nodes, sorted from the best reference
+    ref_errors=[]
+    for source in range(len(node)):
+        dist=[d for i, d in enumerate(cal_node_path_dependent_error(source,node,node_map)[0]) if i != source]
+        if len(dist)==0:
+            continue
+        ref_errors.append((node[source], math.sqrt(sum(dist)/len(dist)), math.sqrt(max(dist))))
+    return sorted(ref_errors, key=lambda ref: ref[1])
+
 def calcMolEnes(ref_ene,graph,path):
     mol_ene=[[ref_ene for i in range(len(graph.V))] for j in range(0,graph.weight_num)]
     for k in range(0,graph.weight_num):
         for m in range(len(graph.V)):
             route_mol_list = path[m]
+            if route_mol_list is None:
+                mol_ene[k][m] = math.nan
+                continue
             for i in range(len(route_mol_list) - 1):
-                curr_path = (graph.V[route_mol_list[i]], graph.V[route_mol_list[i + 1]])
-                curr_ene = graph.ddG_cc[curr_path][k]
+                curr_ene = graph.getEnergy(k, route_mol_list[i], route_mol_list[i + 1])
                 mol_ene[k][m] -= float(curr_ene)###
     return mol_ene
 
+def getIncidence(graph):
+    # incidence matrix of the pairs, the energy of the pair (i, j) is G_j - G_i
+    vertex_num = len(graph.V)
+    edge_num = len(graph.edges)
+    incidence = sparse.csr_matrix((np.tile([-1.0, 1.0], edge_num), (np.repeat(np.arange(edge_num), 2), graph.edges.ravel())),
+                                  shape=(edge_num, vertex_num))
+    if connected_components(incidence.T @ incidence, directed=False)[0] > 1:
+        raise Exception("The graph is not connected, the energies of all molecules can't be calculated from one reference")
+    return incidence
+
+def factoriseNormal(incidence, w, ref_node):
+    # inverse of the Cholesky factor of the normal matrix A^T W A without the row and column of the reference, its
+    # product with its transpose is the covariance matrix of the free nodes. The covariance is dense, so the normal
+    # matrix is factorised as a dense matrix
+    free = np.delete(np.arange(incidence.shape[1]), ref_node)
+    normal = (incidence.T @ sparse.diags(w) @ incidence).toarray()
+    inverse_factor = linalg.solve_triangular(np.linalg.cholesky(normal[np.ix_(free, free)]), np.eye(len(free)), lower=True)
+    return free, inverse_factor
+
+def solveMolEnes(graph, ref_node, ref_ene=0.0):
+    # weighted least squares fit of the node energies to the pair energies, min sum (G_j - G_i - ddG_ij)^2 / w_ij, for
+    # every weight scheme, with the energy of the reference fixed. The uncertainties of the nodes are the square roots
+    # of the diagonal of the covariance matrix; the unit weights of the first scheme carry no error, so its covariance
+    # is scaled by the variance of the residuals
+    incidence = getIncidence(graph)
+    edge_num, vertex_num = incidence.shape
+    mol_ene = np.full((graph.weight_num, vertex_num), float(ref_ene))
+    mol_err = np.zeros((graph.weight_num, vertex_num))
+    for k in range(0, graph.weight_num):
+        w = 1 / graph.weight[k]
+        free, inverse_factor = factoriseNormal(incidence, w, ref_node)
+        # with the reference at 0 the solution is only shifted by the energy of the reference
+        rhs = incidence.T @ (w * graph.ddG)
+        mol_ene[k, free] += inverse_factor.T @ (inverse_factor @ rhs[free])
+        variance = np.sum(inverse_factor ** 2, axis=0)
+        if k == 0:
+            residuals = incidence @ mol_ene[k] - graph.ddG
+            if edge_num > len(free):
+                variance = variance * (residuals @ residuals) / (edge_num - len(free))
+        mol_err[k, free] = np.sqrt(variance)
+    return mol_ene.tolist(), mol_err.tolist()
+
+def sampleMolEnes(graph, ref_node, ref_ene=0.0, samples=10000, seed=None):
+    # Monte-Carlo propagation of the pair errors: all samples of the pair energies are drawn at once from normal
+    # distributions with the errors of the first error column, and the samples are closed with every weight scheme by
+    # one product with the factorised normal matrix. Returns the node energies of the samples, weight_num x samples x V
+    if graph.weight_num < 2:
+        raise Exception("The pairs have no errors to sample from")
+    incidence = getIncidence(graph)
+    edge_num, vertex_num = incidence.shape
+    rng = np.random.default_rng(seed)
+    ddG = graph.ddG + rng.standard_normal((samples, edge_num)) * np.sqrt(graph.weight[1])
+    mol_ene = np.full((graph.weight_num, samples, vertex_num), float(ref_ene))
+    for k in range(0, graph.weight_num):
+        w = 1 / graph.weight[k]
+        free, inverse_factor = factoriseNormal(incidence, w, ref_node)
+        rhs = (incidence.T @ (ddG * w).T).T
+        mol_ene[k][:, free] += (rhs[:, free] @ inverse_factor.T) @ inverse_factor
+    return mol_ene
+
+def printMolErrors(nodes,mol_ene,mol_err):
+    print('{:^4s} {:^12s}'.format('Node', 'dG_cc'), end='')
+    for k in range(1,len(mol_ene)):
+        print(' {:^12s}'.format("dG_wcc" + str(k)), end='')
+    print(' {:^12s}'.format('error_cc'), end='')
+    for k in range(1,len(mol_ene)):
+        print(' {:^12s}'.format("error_wcc" + str(k)), end='')
+    print()
+    for i in range(len(nodes)):
+        print("{:^4s}".format(nodes[i]), end='')
+        for k in range(0, len(mol_ene)):
+            print(' {:^12.4f}'.format(mol_ene[k][i]), end='')
+        for k in range(0, len(mol_ene)):
+            print(' {:^12.4f}'.format(mol_err[k][i]), end='')
+        print()
+
 def printMol(nodes,mol_ene,path_dependent_error,path_independent_error):
     print('{:^4s} {:^12s}'.format('Node', 'dG_cc'), end='')
     for k in range(1,len(mol_ene)):
@@ -72,12 +156,29 @@ def printMol(nodes,mol_ene,path_dependent_error,path_independent_error):
         print("{:^4s} {:^12.4f}".format(nodes[i],mol_ene[0][i]),end='')
         for k in range(1, len(mol_ene)):
             print(' {:^12.4f}'.format(mol_ene[k][i]), end='')
-        print(' {:^25.4f} {:^25.4f}'.format(path_dependent_error[i].sqrt().quantize(decimal.Decimal('0.00')),path_independent_error[i]))
+        print(' {:^25.4f} {:^25.4f}'.format(round(math.sqrt(path_dependent_error[i]), 2),path_independent_error[i]))
 
-def outputMol(nodes, mol_ene, output_file):
+def outputMol(nodes, mol_ene, output_file, mol_err=None):
     with open(output_file, 'w', newline='') as csvfile:
         writer = csv.writer(csvfile)
-        writer.writerow(['Ligand', 'Cycled_no_error'] + ['Cycled_with_error' + str(k) for k in range(1, len(mol_ene))])
+        header = ['Ligand', 'Cycled_no_error'] + ['Cycled_with_error' + str(k) for k in range(1, len(mol_ene))]
+        if mol_err is not None:
+            header += ['Uncertainty_no_error'] + ['Uncertainty_with_error' + str(k) for k in range(1, len(mol_err))]
+        writer.writerow(header)
         for i in range(len(nodes)):
             row = [nodes[i], mol_ene[0][i]] + [mol_ene[k][i] for k in range(1, len(mol_ene))]
-            writer.writerow(row)
\ No newline at end of file
+            if mol_err is not None:
+                row += [mol_err[k][i] for k in range(len(mol_err))]
+            writer.writerow(row)
+
+def printRefs(ref_errors):
+    print('{:^4s} {:^25s} {:^25s}'.format('Ref', 'rms_path_dependent_error', 'max_path_dependent_error'))
+    for ref, rms_error, max_error in ref_errors:
+        print('{:^4s} {:^25.4f} {:^25.4f}'.format(ref, rms_error, max_error))
+
+def outputRefs(ref_errors, output_file):
+    with open(output_file, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['Reference', 'RMS_path_dependent_error', 'Max_path_dependent_error'])
+        for row in ref_errors:
+            writer.writerow(row)
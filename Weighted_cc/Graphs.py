@@ -1,170 +1,222 @@
-import math
-from collections import defaultdict
-import copy
-import decimal
-from decimal import Decimal
-decimal.getcontext().rounding = "ROUND_HALF_UP"
+from collections import deque
+import numpy as np
 class Graph:
-    def __init__(self, filename):
+    # nodes are numbered in the order they appear in the input, every edge (i, j) is stored once in self.edges and
+    # the energies of the edges are the energies from i to j
+    def __init__(self, filename, pairs=None):
         self.num_e=0
-        self.graph = defaultdict(list)
+        self.V = []
+        self.nodeIndex = {}
+        self.graph = []
+        self.edgeIndex = {}
         self.cycles = []
         self.nodelist = []
-        self.paths = defaultdict(list)
-        self.start = ''
-        self.ddG = defaultdict(decimal.Decimal)
-        self.ddG_cc = defaultdict(list)
-        self.ddG_save = defaultdict(decimal.Decimal)
-        self.err = defaultdict(decimal.Decimal) #pair-err
-        self.weight = defaultdict(list)
-        self.print_e = defaultdict(decimal.Decimal)
+        edges, ddG, err, weight = [], [], [], []
         if filename is not None:
             fp=open(filename)
             try:
-                for line in fp:
-                    data = line.strip().split()
-                    if len(data)==3:
-                        weight="no"
-                    elif len(data)>3:
-                        weight="yes"
-                    elif len(data)<3:
-                        raise Exception("input error")
-                        exit()
-                    self.addEdge(data,weight)
-                    self.num_e += 1
+                rows = [line.strip().split() for line in fp]
             finally:
                 fp.close()
-                Exception("Illegal input! Please check your input file.")
+        elif pairs is not None:
+            # rows of a DataFrame or an array in the columns of the input file
+            rows = pairs.itertuples(index=False) if hasattr(pairs, 'itertuples') else pairs
         else:
             print("Error: No input files")
             exit()
-#        if len(data) > 3:
-#            warnings.warn("Please make sure 4th column in input is standard deviation generated by BAR ")
-
-
-        self.V=list(self.graph.keys())
-        self.cycleset= set()
-
-
-
-    def addEdge(self, data,weight):
-        mol1, mol2, b_ddG=data[0:3]
-        self.graph[mol1].append(mol2)
-        self.graph[mol2].append(mol1)
-        self.ddG[(mol1, mol2)] = decimal.Decimal(b_ddG)
-        self.ddG[(mol2, mol1)] = -1*decimal.Decimal(b_ddG)
-        self.print_e[(mol1,mol2)]=0
-        self.ddG_save[(mol1, mol2)] = decimal.Decimal(0)
-        self.ddG_save[(mol2, mol1)] = decimal.Decimal(0)
-        self.weight[(mol1,mol2)].append(decimal.Decimal(1))
-        self.weight[(mol2,mol1)].append(decimal.Decimal(1))
-        self.err[(mol1,mol2)]=-1
-        self.err[(mol2,mol1)]=-1
-        self.ddG_cc[(mol1, mol2)].append(decimal.Decimal(b_ddG))
-        self.ddG_cc[(mol2, mol1)].append(-1 * decimal.Decimal(b_ddG))
-        if weight=="yes":#if bar_std is provided, compare bar_std with single pair std
-#            warnings.warn("Please make sure 4th colunma data is BAR std")
-            self.err[(mol1,mol2)]=decimal.Decimal(data[3])
-            self.err[(mol2,mol1)]=decimal.Decimal(data[3])
-            w_lst=data[3:]
-            for i in range(0,len(w_lst)):
-                self.weight[(mol1, mol2)].append(decimal.Decimal(w_lst[i])**2)
-                self.weight[(mol2, mol1)].append(decimal.Decimal(w_lst[i])**2)
-                self.ddG_cc[(mol1, mol2)].append(decimal.Decimal(b_ddG))
-                self.ddG_cc[(mol2, mol1)].append(-1*decimal.Decimal(b_ddG))
-        self.weight_num=len(self.weight[(mol1,mol2)])
-
-    def getAllPathsUtil(self, u, d, visited, path, iscycle=False):
-        self.num_iteration += 1
-        if iscycle:
-            if self.num_iteration > 1:
-                visited[u] = True
-        else:
-            visited[u] = True
-            if self.num_iteration == 1:
-                self.start = u
-        path.append(u)
-        if self.num_iteration > 1 and u == d:
-            if iscycle:
-                if len(path) > 3:
-                    path_s=copy.deepcopy(path)
-                    path_s.sort()
-                    path_str={''.join(path_s)}
-                    if not path_str <self.cycleset:
-                        self.cycles.append(copy.deepcopy(path))
-                        self.cycleset.add(''.join(path_s))
-            else:
-                self.paths[(self.start, d)].append(copy.deepcopy(path))
-
-        else:
-            for i in self.graph[u]:
-                if visited[i] == False:
-                    self.getAllPathsUtil(i, d, visited, path, iscycle=iscycle)
-        path.pop()
-        visited[u] = False
-
-    def getAllCyles(self):
-        visit = dict(zip(self.graph.keys(), [False] * (len(self.graph))))
-        for mol in self.V:
-            visited=visit
-            path=[]
-            self.num_iteration=0
-            self.getAllPathsUtil(mol, mol, visited, path, iscycle=True)
-            visit[mol] = True
+        for data in rows:
+            if len(data)==0:
+                continue
+            elif len(data)<3:
+                raise Exception("input error")
+            mol1, mol2 = self.addNode(str(data[0])), self.addNode(str(data[1]))
+            self.num_e += 1
+            if (mol1, mol2) in self.edgeIndex or mol1 == mol2:
+                continue
+            self.edgeIndex[(mol1, mol2)] = self.edgeIndex[(mol2, mol1)] = len(edges)
+            self.graph[mol1].append(mol2)
+            self.graph[mol2].append(mol1)
+            edges.append((mol1, mol2))
+            ddG.append(float(data[2]))
+            # if bar_std is provided, it is the first estimate of the pair error and the weights of the
+            # weighted closures are the variances of the columns
+            err.append(float(data[3]) if len(data) > 3 else -1.0)
+            weight.append([1.0] + [float(w) ** 2 for w in data[3:]])
+
+        self.edges = np.array(edges, dtype=int).reshape(-1, 2)
+        self.ddG = np.array(ddG, dtype=np.float64)
+        self.err = np.array(err, dtype=np.float64) #pair-err
+        self.weight_num = len(weight[-1]) if weight else 1
+        self.weight = np.array([w[:self.weight_num] for w in weight], dtype=np.float64).reshape(-1, self.weight_num).T
+        self.ddG_cc = np.tile(self.ddG, (self.weight_num, 1))
+        self.ddG_save = np.zeros(self.ddG_cc.shape)
+
+    def addNode(self, mol):
+        if mol not in self.nodeIndex:
+            self.nodeIndex[mol] = len(self.V)
+            self.V.append(mol)
+            self.graph.append([])
+        return self.nodeIndex[mol]
+
+    def getEdge(self, mol1, mol2):
+        # edge of the pair and the sign of the energy from mol1 to mol2
+        edge = self.edgeIndex[(mol1, mol2)]
+        return edge, (1.0 if self.edges[edge, 0] == mol1 else -1.0)
+
+    def getEnergy(self, n, mol1, mol2):
+        edge, sign = self.getEdge(mol1, mol2)
+        return sign * self.ddG_cc[n, edge]
+
+    def getCycleBasis(self):
+        # BFS spanning tree of every connected part of the graph
+        parent = [None] * len(self.V)
+        depth = [-1] * len(self.V)
+        for root in range(len(self.V)):
+            if depth[root] >= 0:
+                continue
+            depth[root] = 0
+            queue = deque([root])
+            while queue:
+                u = queue.popleft()
+                for v in self.graph[u]:
+                    if depth[v] < 0:
+                        parent[v] = u
+                        depth[v] = depth[u] + 1
+                        queue.append(v)
+        # every edge that is not in the tree closes one fundamental cycle
+        cycles = []
+        for u, v in self.edges:
+            if parent[u] == v or parent[v] == u:
+                continue
+            cycles.append(self.getTreeCycle(u, v, parent, depth))
+        return cycles
+
+    def getTreeCycle(self, u, v, parent, depth):
+        # tree paths from u and v up to their common ancestor, closed by the edge v-u
+        left, right = [u], [v]
+        while depth[left[-1]] > depth[right[-1]]:
+            left.append(parent[left[-1]])
+        while depth[right[-1]] > depth[left[-1]]:
+            right.append(parent[right[-1]])
+        while left[-1] != right[-1]:
+            left.append(parent[left[-1]])
+            right.append(parent[right[-1]])
+        return left + right[-2::-1] + [u]
+
+    def getShortCycles(self, max_length):
+        # all simple cycles with at most max_length edges, each found from its smallest node
+        cycles = []
+        for start in range(len(self.V)):
+            stack = [[start]]
+            while stack:
+                path = stack.pop()
+                for v in self.graph[path[-1]]:
+                    if v == start:
+                        if len(path) > 2 and path[1] < path[-1]:
+                            cycles.append(path + [start])
+                    elif v > start and v not in path and len(path) < max_length:
+                        stack.append(path + [v])
+        return cycles
+
+    def getCycleKey(self, cycle_list):
+        # the same cycle is stored once, whatever its first node and direction
+        nodes = cycle_list[:-1]
+        first = nodes.index(min(nodes))
+        nodes = nodes[first:] + nodes[:first]
+        if nodes[-1] < nodes[1]:
+            nodes = nodes[:1] + nodes[:0:-1]
+        return tuple(nodes)
+
+    def getCycles(self, max_length=6):
+        # fundamental cycle basis, plus the short cycles used for the pair errors (max_length 0 uses the basis only)
+        cycles = self.getCycleBasis()
+        if max_length > 2:
+            cycles += self.getShortCycles(max_length)
+        keys = set()
+        for cycle_list in cycles:
+            key = self.getCycleKey(cycle_list)
+            if key not in keys:
+                keys.add(key)
+                self.cycles.append(cycle_list)
+        self.setCycleEdges()
         return
 
-
+    def setCycleEdges(self):
+        # edges of all cycles concatenated, with the sign of the edge along the cycle and the cycle it belongs to
+        edges, signs, lengths = [], [], []
+        for cycle_list in self.cycles:
+            for i in range(len(cycle_list) - 1):
+                edge, sign = self.getEdge(cycle_list[i], cycle_list[i + 1])
+                edges.append(edge)
+                signs.append(sign)
+            lengths.append(len(cycle_list) - 1)
+        self.cycle_edges = np.array(edges, dtype=int)
+        self.cycle_signs = np.array(signs, dtype=np.float64)
+        self.cycle_lengths = np.array(lengths, dtype=int)
+        self.cycle_of = np.repeat(np.arange(len(lengths)), lengths)
+        bounds = np.concatenate(([0], np.cumsum(lengths)))
+        self.cycle_slices = [slice(bounds[k], bounds[k + 1]) for k in range(len(lengths))]
 
     def getDelta(self,n, cycle_list):
-        delta = decimal.Decimal(0.0)
+        delta = 0.0
         edges = 0
-        std=decimal.Decimal(0)
+        std = 0.0
         for i in range(len(cycle_list) - 1):
-            mol1, mol2 = cycle_list[i:i + 2]
-            delta += self.ddG_cc[mol1, mol2][n]
+            edge, sign = self.getEdge(cycle_list[i], cycle_list[i + 1])
+            delta += sign * self.ddG_cc[n, edge]
             edges += 1
-            std += self.weight[mol1,mol2][n]
+            std += self.weight[n, edge]
         return delta, edges , std
 
-    def CycleClosure(self,n,edge_error):
-        # cycle closure for all the cycles of a single molecule
-        for k in range(len(self.cycles)):
-            cycle_list=self.cycles[k]
-            delta,edges,std_sum=self.getDelta(n,cycle_list)
-            single_err=abs(delta/decimal.Decimal(math.sqrt(edges)))
-            for i in range(len(cycle_list) - 1):
-                mol1, mol2 = cycle_list[i:i + 2]
-                if edge_error==True:
-                    if edges > 6: #ignore cycles more than 6edges
-                        continue
-                    if single_err >self.err[mol1,mol2]:
-                        self.err[mol1,mol2] = single_err
-                        self.err[mol2, mol1] = single_err
-                    continue
-                scale = self.weight[mol1,mol2][n]/std_sum
-                ene = self.ddG_cc[mol1,mol2][n]
-                newene = ene - scale * delta
-                self.ddG_cc[mol1, mol2][n] = newene
-                self.ddG_cc[mol2, mol1][n] = -newene
+    def getDeltas(self, n):
+        # closure errors of all cycles
+        return np.bincount(self.cycle_of, weights=self.cycle_signs * self.ddG_cc[n, self.cycle_edges],
+                           minlength=len(self.cycles))
 
+    def CycleClosure(self,n,edge_error):
+        # n is a weight scheme, or an array of weight schemes which are closed together
+        if edge_error==True:
+            # pair error: the largest closure error per square root of the edges of the cycles (of at most 6 edges)
+            # through the pair
+            single_err = np.abs(self.getDeltas(n)) / np.sqrt(self.cycle_lengths)
+            short = self.cycle_lengths[self.cycle_of] <= 6 #ignore cycles more than 6edges
+            np.maximum.at(self.err, self.cycle_edges[short], single_err[self.cycle_of][short])
+            return
+        # cycle closure for all the cycles, one after another, every cycle is corrected with the energies updated by
+        # the previous ones. The energies of the weight schemes are the columns of one array, so that every cycle is
+        # corrected in all of them at once
+        n = np.atleast_1d(n)
+        ene = self.ddG_cc[n].T.copy()
+        # share of the closure error that every edge of a cycle takes, which does not change between the iterations
+        weight = self.weight[n][:, self.cycle_edges]
+        starts = np.array([part.start for part in self.cycle_slices], dtype=int)
+        total = np.add.reduceat(weight, starts, axis=1) if len(starts) > 0 else weight
+        share = (self.cycle_signs * weight / total[:, self.cycle_of]).T
+        for part in self.cycle_slices:
+            edges = self.cycle_edges[part]
+            cycle_ene = ene[edges]
+            ene[edges] = cycle_ene - share[part] * (self.cycle_signs[part] @ cycle_ene)
+        self.ddG_cc[n] = ene.T
 
     def chk_continue(self,n, tol=0.001):
-        for curr_key in self.ddG.keys():
-            if abs(self.ddG_save[curr_key] - self.ddG_cc[curr_key][n]) > tol:
-                return True
-        return False
+        # for an array of weight schemes, whether every one of them has not converged yet
+        return np.any(np.abs(self.ddG_save[n] - self.ddG_cc[n]) > tol, axis=-1)
 
     def iterateCycleClosure(self, minimum_cycles=2):
-        for n in range(0,self.weight_num):
-            i = 0
-            while i < minimum_cycles or self.chk_continue(n,0.001) :
-                cal_error=True if (i==0) else False #if the first iteration, calculate pair error
-                for curr_key in self.ddG.keys():            #save the current energy value for the next step
-                    self.ddG_save[curr_key] = self.ddG_cc[curr_key][n]
-                self.CycleClosure(n,cal_error)
-                i += 1
-        for molpair in self.print_e:
-            self.nodelist.append([molpair[0], molpair[1], self.err[molpair]])
+        # the first iteration calculates the pair errors, which are the same for all weight schemes as the energies
+        # are not closed yet
+        self.CycleClosure(0,True)
+        # all weight schemes are closed together, a scheme is left out once its energies are converged
+        active = np.arange(self.weight_num)
+        i = 1
+        while len(active) > 0:
+            self.ddG_save[active] = self.ddG_cc[active]   #save the current energy value for the next step
+            self.CycleClosure(active,False)
+            i += 1
+            if i >= minimum_cycles:
+                active = active[self.chk_continue(active,0.001)]
+        for edge, (mol1, mol2) in enumerate(self.edges):
+            self.nodelist.append([self.V[mol1], self.V[mol2], self.err[edge]])
 
     def printEnePairs(self):
 
@@ -173,12 +225,11 @@ class Graph:
         for k in range(1,self.weight_num):
             print(' {:^10s}'.format("ddG_wcc"+str(k)),end='')
         print(' {:^10s}'.format('pair_error'))
-        for molpair in self.print_e:
-            print('{:>2s}-{:2s}{:^14.4f}'.format(molpair[0],molpair[1], self.ddG_cc[molpair][0],),end='')
+        for edge, (mol1, mol2) in enumerate(self.edges):
+            print('{:>2s}-{:2s}{:^14.4f}'.format(self.V[mol1],self.V[mol2], self.ddG_cc[0, edge],),end='')
             for k in range(1,self.weight_num):
-                print(" {:^10.4f}".format(self.ddG_cc[molpair][k]),end="")
-            print('{:^10.4f}'.format(Decimal(self.err[molpair]).quantize(decimal.Decimal('0.00'))))
-            #self.nodelist.append([molpair[0], molpair[1], self.err[molpair]])
+                print(" {:^10.4f}".format(self.ddG_cc[k, edge]),end="")
+            print('{:^10.4f}'.format(round(self.err[edge], 2)))
         print("*" * 100)
 
 
@@ -12,10 +12,47 @@ class optParser():
         parser.add_option('-e', '--ref_ene', dest='ref_ene', help='Energy for the reference molecule. Default: 0.00',
                           default=0.00, type=float)
         parser.add_option('-o', '--output', dest='output', help='Output file name. Default: output.txt')
+        parser.add_option('-l', '--max_cycle_length', dest='max_cycle_length', help='Also close all cycles with up to this number of edges, on top of the cycle basis of the graph (0 uses the basis only). Default: 6',
+                          default=6, type=int)
+        parser.add_option('-m', '--method', dest='method', help='iterative: closes the cycles one after another until the energies converge. lsq: solves the closure directly as a weighted least squares problem and writes the uncertainties of the molecules. Default: iterative',
+                          default='iterative', choices=['iterative', 'lsq'])
+        parser.add_option('-a', '--ref_errors', dest='ref_errors', help='Output file for the network-wide path dependent error with every molecule as the reference, to choose the reference with the smallest error (only with the iterative method)')
         if fakeArgs:
             self.option, self.args = parser.parse_args(fakeArgs)
         else:
             self.option, self.args = parser.parse_args()
+        # the path dependent errors need the pair errors of the iterative closure, which lsq does not calculate
+        if self.option.method == 'lsq' and self.option.ref_errors:
+            parser.error('-a (--ref_errors) needs the iterative closure, it can not be used with -m lsq')
+
+def getRefNode(g, ref):
+    if not ref:
+        ref = g.V[0]
+    if ref not in g.nodeIndex:
+        raise ValueError(f"Ref {ref} isn't in the pairs")
+    return g.nodeIndex[ref]
+
+def cycleClosure(pairs, ref='', ref_ene=0.00, max_cycle_length=6, method='iterative'):
+    # cycle closure without files: pairs is a DataFrame or an array with the columns of the input file (mol1, mol2,
+    # ddG and the errors of the weighted closures). Returns the molecules, their energies for every weight scheme and,
+    # with the lsq method, their uncertainties (None with the iterative method)
+    g = Graph(None, pairs)
+    ref_node = getRefNode(g, ref)
+    if method == 'lsq':
+        mol_ene, mol_err = lig.solveMolEnes(g, ref_node, ref_ene)
+        return g.V, mol_ene, mol_err
+    g.getCycles(max_cycle_length)
+    if len(g.cycles) == 0:
+        raise ValueError("No cycle in this graph.")
+    g.iterateCycleClosure(minimum_cycles=2)
+    path_dependent_error, path = lig.cal_node_path_dependent_error(ref_node, g.V, lig.set_node_map(g))
+    return g.V, lig.calcMolEnes(ref_ene, g, path), None
+
+def cycleClosureSamples(pairs, ref='', ref_ene=0.00, samples=10000, seed=None):
+    # Monte-Carlo samples of the cycled energies of the pairs, drawn from their errors (see CalLig.sampleMolEnes).
+    # Returns the molecules and the energies of the samples for every weight scheme, weight_num x samples x molecules
+    g = Graph(None, pairs)
+    return g.V, lig.sampleMolEnes(g, getRefNode(g, ref), ref_ene, samples, seed)
 
 if __name__ == '__main__':
     opts = optParser('')
@@ -24,12 +61,6 @@ if __name__ == '__main__':
     if not opts.option.file:
         raise Exception("No input energy data!")
     g = Graph(opts.option.file)
-    g.getAllCyles()
-    if len(g.cycles)== 0:
-        print("No cycle in this graph.")
-        exit()
-    g.iterateCycleClosure(minimum_cycles=2)
-    node_map=lig.set_node_map(g)
     if not opts.option.ref.strip():
         opts.option.ref=g.V[0]
     try:
@@ -37,10 +68,25 @@ if __name__ == '__main__':
     except ValueError as e:
         print("Check your args. Ref",opts.option.ref,"isn't in your input file!")
         exit()
+    if opts.option.method == 'lsq':
+        mol_ene, mol_err = lig.solveMolEnes(g, ref_node, opts.option.ref_ene)
+        lig.printMolErrors(g.V, mol_ene, mol_err)
+        lig.outputMol(g.V, mol_ene, opts.option.output, mol_err)
+        exit()
+    g.getCycles(opts.option.max_cycle_length)
+    if len(g.cycles)== 0:
+        print("No cycle in this graph.")
+        exit()
+    g.iterateCycleClosure(minimum_cycles=2)
+    node_map=lig.set_node_map(g)
     path_independent_error = lig.cal_node_path_independent_error(g.V, node_map)
     path_dependent_error, path = lig.cal_node_path_dependent_error(ref_node, g.V, node_map)
     mol_ene = lig.calcMolEnes(opts.option.ref_ene, g, path)
     lig.printMol(g.V,mol_ene,path_dependent_error,path_independent_error)
     lig.outputMol(g.V,mol_ene,opts.option.output)
+    if opts.option.ref_errors:
+        ref_errors = lig.cal_reference_errors(g.V, node_map)
+        lig.printRefs(ref_errors)
+        lig.outputRefs(ref_errors, opts.option.ref_errors)
 
 
@@ -0,0 +1,258 @@
+""" Variance-driven allocation of the production time of the lambda windows.
+
+With adaptive sampling, the ti2p2 job first runs a short pilot pass of every window (a fraction of nstlim). This
+script is then called by the job, and it performs the following tasks:
+
+1. Calculates the variance, statistical inefficiency and effective sample count of dV/dl in every window from the
+   pilot pass and saves them to the window_statistics table.
+2. Distributes the rest of the production time of the run between the windows in proportion to their contribution
+   to the error of the free energy (the windows with a larger error get more time).
+3. Writes the input files of the extension segments and sends a job, which runs only the windows that got extra
+   time, to the queue. When the extension job ends, the analysis of the simulation is queued.
+
+Usage:
+    python3 adaptive_sampling.py -r simulation_id -n nstlim
+
+Arguments:
+    -r, --simulation_id: Id of the ti2p2 simulation (required).
+    -n, --nstlim: Number of MD steps of a window without adaptive sampling (required).
+"""
+
+import argparse
+import os
+import textwrap
+
+import numpy as np
+from pymbar.timeseries import statistical_inefficiency
+
+from amber_parser import read_dvdl
+from database_helper import get_db, add_job_id, get_lambda_schedule, get_run_context
+from mdin import transformation_parameters, stage_input, render_input
+from parm7 import read_masks, read_stage_box, prepare_topology
+from settings_helper import get_gpu_settings, get_amberti_path
+from simulation_id_helper import get_complex_name, get_run_name, get_result_id
+
+
+def window_variance_statistics(dvdl):
+    """
+    Calculate the variance statistics of dV/dl of one window.
+
+    The statistical inefficiency is the one of pymbar, which alchemlyb also uses to decorrelate the windows.
+
+    Parameters
+    ----------
+    dvdl : np.ndarray
+        dV/dl records of the window in kcal/mol.
+
+    Returns
+    -------
+    tuple of (float, float, float, float)
+        Variance, statistical inefficiency, effective sample count and error of the mean dV/dl.
+    """
+    variance = np.var(dvdl, ddof=1)
+    # pymbar can not calculate the statistical inefficiency of a constant series
+    g = statistical_inefficiency(dvdl) if variance > 0 else 1.0
+    effective_samples = len(dvdl) / g
+    return variance, g, effective_samples, np.sqrt(variance / effective_samples)
+
+
+def allocate_extensions(contributions, pilot_steps, budget, step=1):
+    """
+    Distribute the production budget between the windows.
+
+    The total time of every window is made proportional to its contribution to the error (weight times standard
+    deviation times the square root of the statistical inefficiency), which minimises the error of the free energy for
+    the given total time. Windows that would get less than their pilot pass get no extension, and the rest of the
+    budget is divided between the others.
+
+    Parameters
+    ----------
+    contributions : np.ndarray
+        Error contribution of every window per square root of sample.
+    pilot_steps : int
+        Number of MD steps of the pilot pass of every window.
+    budget : int
+        Number of MD steps to distribute.
+    step : int
+        The extensions are multiples of this number of steps (ntpr).
+
+    Returns
+    -------
+    np.ndarray
+        Number of MD steps of the extension of every window.
+    """
+    contributions = np.asarray(contributions, dtype=float)
+    if not np.any(contributions > 0):
+        contributions = np.ones(len(contributions))
+    total = pilot_steps * len(contributions) + budget
+    fixed = contributions <= 0
+    while True:
+        free = ~fixed
+        steps = np.where(free, contributions * (total - pilot_steps * fixed.sum()) / contributions[free].sum(), 0)
+        too_short = free & (steps < pilot_steps)
+        if not too_short.any():
+            break
+        fixed |= too_short
+    extensions = np.where(fixed, 0, steps - pilot_steps)
+    return (extensions // step * step).astype(int)
+
+
+def save_window_statistics(db, result_id, statistics, extensions):
+    """
+    Save the statistics of the pilot pass and the extensions of the windows to the database.
+
+    Parameters
+    ----------
+    db : sqlite3.Connection
+        Database connection.
+    result_id : str
+        Id of the result.
+    statistics : list of tuple
+        Sample count, variance, statistical inefficiency, effective sample count and error of every window.
+    extensions : np.ndarray
+        Number of MD steps of the extension of every window.
+    """
+    db.execute('DELETE FROM window_statistics WHERE result_id=?', (result_id,))
+    db.executemany('''INSERT INTO window_statistics (result_id, lambda, sample_count, variance,
+                      statistical_inefficiency, effective_samples, error, extension_steps)
+                      VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                   [(result_id, i, *map(float, row), int(extension))
+                    for i, (row, extension) in enumerate(zip(statistics, extensions))])
+    db.commit()
+
+
+def extension_input(steps, clambda, masks, modifications=None, box=None, hmr=False):
+    """
+    Make the input of an extension segment of a window.
+
+    The input is the production input of the window (see ti2p2.py) restarted from its restart file (ntx=5, irest=1),
+    with the number of MD steps of the extension.
+
+    Parameters
+    ----------
+    steps : int
+        Number of MD steps of the extension, with the time step of the window.
+    clambda : float
+        Lambda of the window.
+    masks : dict
+        TI masks of the transformation (see mdin.transformation_parameters).
+    modifications : dict
+        Modifications of the stages of the run.
+    box : tuple of (list, list)
+        Lengths and angles of the box of the system.
+    hmr : bool
+        Whether the run uses hydrogen mass repartitioning.
+
+    Returns
+    -------
+    str
+        Text of the input file.
+    """
+    namelists = stage_input('ti2p2', modifications, box, hmr, **masks, clambda=clambda)
+    # the steps are already counted with the time step of the window, so they are set after the HMR rescaling
+    namelists['namelists'][0][1].update({'ntx': 5, 'irest': 1, 'nstlim': int(steps)})
+    return render_input(namelists)
+
+
+def plan_extensions(simulation_id, nstlim):
+    """
+    Analyse the pilot pass of a simulation and plan the extension segments of its windows.
+
+    Has to be called from the folder of the transformation.
+
+    Parameters
+    ----------
+    simulation_id : str
+        Id of the ti2p2 simulation.
+    nstlim : int
+        Number of MD steps of a window without adaptive sampling.
+
+    Returns
+    -------
+    np.ndarray
+        Number of MD steps of the extension of every window.
+    """
+    complex = get_complex_name(simulation_id)
+    run_name = get_run_name(simulation_id)
+    schedule, clambdas, weights = get_lambda_schedule(run_name)
+
+    statistics = []
+    for i in range(len(clambdas)):
+        times, dvdl, header = read_dvdl(os.path.join(str(i), f'{complex}_prod_{run_name}_{i}.out'))
+        statistics.append((len(dvdl), *window_variance_statistics(dvdl)))
+    ntpr = header['ntpr']
+    pilot_steps = header['nstlim']
+
+    contributions = np.array([weight * np.sqrt(variance * g) for weight, (_, variance, g, _, _) in
+                              zip(weights, statistics)])
+    extensions = allocate_extensions(contributions, pilot_steps, len(clambdas) * (nstlim - pilot_steps), ntpr)
+
+    db = get_db()
+    save_window_statistics(db, get_result_id(simulation_id), statistics, extensions)
+    db.close()
+
+    context = get_run_context(run_name)
+    masks = transformation_parameters(*read_masks(f'params_{complex}.in'))
+    for i, steps in enumerate(extensions):
+        if steps > 0:
+            # the extension continues from the restart file of the pilot pass
+            box = read_stage_box([os.path.join(str(i), f'{complex}_prod_{run_name}_{i}.rst7'),
+                                  os.path.join(str(i), f'{complex}_equi_{i}.rst7'), f'{complex}.rst7'],
+                                 f'{complex}.parm7')
+            with open(os.path.join(str(i), f'{i}_ext.in'), 'w') as outfile:
+                outfile.write(extension_input(steps, clambdas[i], masks, context['modifications'], box,
+                                              context['hmr']))
+    return extensions
+
+
+def submit_extensions(simulation_id, extensions):
+    """
+    Send the job running the extension segments to the queue.
+
+    Parameters
+    ----------
+    simulation_id : str
+        Id of the ti2p2 simulation.
+    extensions : np.ndarray
+        Number of MD steps of the extension of every window.
+    """
+    complex = get_complex_name(simulation_id)
+    run_name = get_run_name(simulation_id)
+    windows = ' '.join(str(i) for i, steps in enumerate(extensions) if steps > 0)
+    parm7 = prepare_topology(complex, get_run_context(run_name)['hmr'])
+
+    string = textwrap.dedent(f'''\
+#!/bin/bash
+#SBATCH --time=20:00:00
+#SBATCH --job-name=ti2p2_ext
+{get_gpu_settings()}
+
+trap "python3 {os.path.join(get_amberti_path(), "update_job_status.py")} -r {simulation_id} -s 4; exit" ERR
+
+for i in {windows}
+do
+cd ${{i}}
+pmemd.cuda -O -i ${{i}}_ext.in -c {complex}_prod_{run_name}_${{i}}.rst7 -p ../{parm7} -o {complex}_ext_{run_name}_${{i}}.out -r {complex}_ext_{run_name}_${{i}}.rst7 -x {complex}_ext_{run_name}_${{i}}.nc
+cd ..
+done
+
+python3 {os.path.join(get_amberti_path(), "update_job_status.py")} -r {simulation_id} -s 3
+''')
+
+    with open('ti2p2_ext.txt', 'w') as outfile:
+        outfile.write(string)
+    output = os.popen(f'sbatch ti2p2_ext.txt').read().strip()
+    print(output)
+    add_job_id(output.split()[-1], simulation_id)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='This script plans the extensions of the lambda windows')
+    parser.add_argument('-r', '--simulation_id', help='Id of the ti2p2 simulation', required=True)
+    parser.add_argument('-n', '--nstlim', help='Number of MD steps of a window without adaptive sampling',
+                        required=True, type=int)
+
+    args = parser.parse_args()
+    extensions = plan_extensions(args.simulation_id, args.nstlim)
+    print('Extension steps of the windows: ' + ' '.join(str(steps) for steps in extensions))
+    submit_extensions(args.simulation_id, extensions)
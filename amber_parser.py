@@ -0,0 +1,255 @@
+"""Fast parser of the dV/dλ data in AMBER TI output files.
+
+Only the ``DV/DL`` records and the header values needed to build the time axis (``ntpr``, ``dt``, ``temp0``,
+``clambda`` and the starting time) are read. The file is memory-mapped and scanned with a single compiled regular
+expression, and the gradients are written into a preallocated NumPy array, so the parser stays fast and uses little
+memory on large production outputs.
+
+:func:`extract_dHdl` returns the same DataFrame as :func:`alchemlyb.parsing.amber.extract_dHdl` and can be used in
+its place, e.g. as the dHdl reader of the alchemlyb ABFE workflow.
+
+Functions
+---------
+read_header(buffer)
+    Read the run parameters from the control data section.
+
+read_dvdl(outfile)
+    Read the dV/dλ records of an output file into NumPy arrays.
+
+read_dvdl_since(outfile, offset, last_nstep)
+    Read the dV/dλ records appended to a growing output file.
+
+dvdl_to_dataframe(times, dvdl, clambda, T)
+    Convert dV/dλ arrays to an alchemlyb DataFrame.
+
+extract_dHdl(outfile, T)
+    Return dV/dλ of an output file as an alchemlyb DataFrame.
+
+"""
+
+import mmap
+import os
+import re
+
+import numpy as np
+import pandas as pd
+from alchemlyb.postprocessors.units import R_kJmol, kJ2kcal
+
+k_b = R_kJmol * kJ2kcal
+
+_FP = rb'[+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?'
+
+# Every record we care about starts at the beginning of a line with a single space. The summary blocks at the end of
+# the run (and every ntave steps) are preceded by their own title line and are skipped.
+_RECORD_RE = re.compile(rb'\n (?:NSTEP =\s*(\d+)|DV/DL  =\s*(\S+)[ \t]*\r?\n|(\s*(?:A V E R A G E S|R M S  F L U C|DV/DL, AVE))'
+                        rb'|(  5\.  TIMINGS))')
+
+_HEADER_FIELDS = {
+    'ntpr': (rb'[\s,]ntpr\s*=\s*(\d+)', int),
+    'nstlim': (rb'[\s,]nstlim\s*=\s*(\d+)', int),
+    'dt': (rb'[\s,]dt\s*=\s*(' + _FP + rb')', float),
+    'T': (rb'[\s,]temp0\s*=\s*(' + _FP + rb')', float),
+    'clambda': (rb'[\s,]clambda\s*=\s*(' + _FP + rb')', float),
+}
+_HEADER_RE = {name: (re.compile(pattern), cast) for name, (pattern, cast) in _HEADER_FIELDS.items()}
+_BEGIN_TIME_RE = re.compile(rb'begin time read from input coords\s*=\s*(' + _FP + rb')')
+
+
+def read_header(buffer):
+    """Read the run parameters from the control data section.
+
+    Parameters
+    ----------
+    buffer : bytes or mmap.mmap
+        Content of the AMBER output file.
+
+    Returns
+    -------
+    dict
+        Dictionary with ntpr, nstlim, dt, T, clambda and t0 (starting time in ps).
+
+    Raises
+    ------
+    ValueError
+        If the file does not contain a complete header.
+
+    """
+    start = buffer.find(b'   2.  CONTROL  DATA  FOR  THE  RUN')
+    if start == -1:
+        raise ValueError('No "CONTROL DATA" section found in the file.')
+    end = buffer.find(b'   4.  RESULTS', start)
+    if end == -1:
+        raise ValueError('No "RESULTS" section found in the file.')
+    header_text = buffer[start:end]
+
+    header = {}
+    for name, (pattern, cast) in _HEADER_RE.items():
+        match = pattern.search(header_text)
+        if match is None:
+            raise ValueError(f'No valid "{name}" record found in the file.')
+        header[name] = cast(match.group(1))
+
+    match = _BEGIN_TIME_RE.search(header_text)
+    if match is None:
+        raise ValueError('No starting simulation time found in the file.')
+    header['t0'] = float(match.group(1))
+    header['results_offset'] = end
+    return header
+
+
+def _scan_dvdl(buffer, start, capacity, old_nstep=None):
+    """Collect the dV/dλ values of all MD steps in the buffer after the start offset.
+
+    Only the first DV/DL record of every NSTEP is kept (pmemd prints one block for each TI region) and the averages
+    and fluctuations blocks are skipped.
+
+    Returns
+    -------
+    tuple of (np.ndarray, int, int)
+        The dV/dλ values, the offset of the end of the last complete record and its NSTEP.
+
+    """
+    dvdl = np.empty(max(capacity, 16), dtype=np.float64)
+    count = 0
+    nstep = None
+    summary_pending = False
+    in_summary = False
+    end = start
+    for match in _RECORD_RE.finditer(buffer, start):
+        step, value, summary, timings = match.groups()
+        if step is not None:
+            in_summary = summary_pending
+            summary_pending = False
+            nstep = None if in_summary else int(step)
+        elif value is not None:
+            if nstep is None or nstep == old_nstep:
+                continue
+            if count == len(dvdl):
+                dvdl = np.resize(dvdl, 2 * count)
+            dvdl[count] = float('inf') if b'*' in value else float(value)
+            count += 1
+            old_nstep = nstep
+            # Resume just before the line break so that the next record still starts with one
+            end = match.end() - 1
+        elif summary is not None:
+            summary_pending = True
+        elif timings is not None:
+            break
+    return dvdl[:count], end, old_nstep
+
+
+def read_dvdl(outfile):
+    """Read the dV/dλ records of an AMBER output file into NumPy arrays.
+
+    Parameters
+    ----------
+    outfile : str
+        Path to the AMBER .out file.
+
+    Returns
+    -------
+    tuple of (np.ndarray, np.ndarray, dict)
+        Times in ps, dV/dλ in kcal/mol and the header values (see :func:`read_header`).
+
+    """
+    with open(outfile, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            header = read_header(buffer)
+            dvdl, _, _ = _scan_dvdl(buffer, header['results_offset'], header['nstlim'] // header['ntpr'] + 1)
+    times = header['t0'] + np.arange(1, len(dvdl) + 1) * header['dt'] * header['ntpr']
+    return times, dvdl, header
+
+
+def read_dvdl_since(outfile, offset=0, last_nstep=None):
+    """Read the dV/dλ records appended to a growing AMBER output file.
+
+    Only the part of the file after the offset is scanned and records that are not completely written yet are left
+    for the next call, so the function can be called repeatedly on the output of a running simulation.
+
+    Parameters
+    ----------
+    outfile : str
+        Path to the AMBER .out file.
+    offset : int
+        Offset returned by the previous call, 0 to read from the beginning.
+    last_nstep : int
+        NSTEP of the last record returned by the previous call.
+
+    Returns
+    -------
+    tuple of (np.ndarray, dict, int, int)
+        The new dV/dλ values in kcal/mol, the header values, the offset and the NSTEP to pass to the next call.
+        The header is None and no values are returned if the file does not have a complete header yet.
+
+    """
+    if not os.path.isfile(outfile) or os.path.getsize(outfile) == 0:
+        return np.empty(0), None, offset, last_nstep
+    with open(outfile, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            try:
+                header = read_header(buffer)
+            except ValueError:
+                return np.empty(0), None, offset, last_nstep
+            start = max(offset, header['results_offset'])
+            dvdl, end, last_nstep = _scan_dvdl(buffer, start, 64, last_nstep)
+    return dvdl, header, max(end, start), last_nstep
+
+
+def dvdl_to_dataframe(times, dvdl, clambda, T):
+    """Convert dV/dλ arrays to the DataFrame format of alchemlyb.
+
+    Parameters
+    ----------
+    times : np.ndarray
+        Times in ps.
+    dvdl : np.ndarray
+        dV/dλ in kcal/mol.
+    clambda : float
+        Lambda value of the window.
+    T : float
+        Temperature in Kelvin.
+
+    Returns
+    -------
+    pd.DataFrame
+        dH/dλ in units of kT indexed by time and lambda.
+
+    """
+    df = pd.DataFrame(dvdl / (k_b * T), columns=['dHdl'], index=pd.Index(times, name='time', dtype='Float64'))
+    df['lambdas'] = clambda
+    df = df.reset_index().set_index(['time', 'lambdas'])
+    df.attrs['temperature'] = T
+    df.attrs['energy_unit'] = 'kT'
+    return df
+
+
+def extract_dHdl(outfile, T):
+    """Return gradients dH/dλ from an AMBER TI output file.
+
+    Drop-in replacement of :func:`alchemlyb.parsing.amber.extract_dHdl` for TI-only analysis.
+
+    Parameters
+    ----------
+    outfile : str
+        Path to the AMBER .out file.
+    T : float
+        Temperature in Kelvin at which the simulation was performed.
+
+    Returns
+    -------
+    pd.DataFrame or None
+        dH/dλ in units of kT indexed by time and lambda, None if the file contains no dV/dλ data.
+
+    Raises
+    ------
+    ValueError
+        If the file is not a valid output file or the temperature does not match the one in the file.
+
+    """
+    times, dvdl, header = read_dvdl(outfile)
+    if not np.isclose(T, header['T'], atol=0.01):
+        raise ValueError(f"The temperature read from the input file ({header['T']:.2f} K) is different from the "
+                         f"temperature passed as parameter ({T:.2f} K)")
+    if len(dvdl) == 0:
+        return None
+    return dvdl_to_dataframe(times, dvdl, header['clambda'], T)
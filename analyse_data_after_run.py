@@ -6,7 +6,8 @@ It performs the following tasks:
 2. Executes an analysis workflow.
 3. Calculates and stores the convergence of each lambda window and the total convergence of the simulation.
 4. Records the lambdas and free energy values in the database.
-5. Updates the error status in the run info to indicate errorlessness during analysis.
+5. Stores the bootstrap error and the bootstrap resamples of the free energy.
+6. Updates the error status in the run info to indicate errorlessness during analysis.
 
 Usage:
     python script_name.py -r simulation_id [-k skiptime]
@@ -25,16 +26,44 @@ import numpy as np
 import sqlite3
 import datetime
 
-from alchemlyb.parsing.amber import extract_dHdl
-from alchemlyb.preprocessing import decorrelate_dhdl, dhdl2series
-from alchemlyb.convergence import fwdrev_cumavg_Rc
-
-from database_helper import get_db, get_protein_pathway
-from settings_helper import get_amberti_path
+from analysis_cache import window_convergence
+from analysis_workflow import run_workflow
+from database_helper import get_db, get_protein_pathway, get_lambda_schedule
 from simulation_id_helper import get_run_name, get_ligand_one, get_ligand_two, get_is_wat, get_complex_name, \
     get_result_id, get_run_name_from_result_id
 
 
+def get_result_pathway(result_id):
+    """Get the folder of the transformation of a result."""
+    return os.path.join(get_protein_pathway(get_run_name_from_result_id(result_id)), get_ligand_one(result_id),
+                        get_complex_name(result_id))
+
+
+def read_convergences(result_id, run_name):
+    """
+    Calculate the convergence of each lambda window.
+
+    Parameters
+    ----------
+    result_id : str
+        Id of the simulation result.
+    run_name : str
+        Name of the run.
+
+    Returns
+    -------
+    list of float
+        Convergence of every lambda window.
+    """
+    pathway = get_result_pathway(result_id)
+    schedule, clambdas, weights = get_lambda_schedule(run_name)
+    convergences = []
+    for i in range(0, len(clambdas)):
+        file = os.path.join(pathway, str(i), get_complex_name(result_id) + '_prod_' + run_name + f'_{i}' + '.out')
+        convergences.append(window_convergence(file, T=300))
+    return convergences
+
+
 def save_convergence(db, result_id, run_name):
     """
     Save the convergence of each lambda window and the total convergence of the simulation.
@@ -48,23 +77,36 @@ def save_convergence(db, result_id, run_name):
     run_name : str
         Name of the run.
     """
-    os.chdir(os.path.join(get_protein_pathway(run_name), get_ligand_one(result_id), get_complex_name(result_id)))
-    convergences = np.empty(12, dtype=object)
-    for i in range(0, 12):
-        os.chdir(str(i))
-        file = get_complex_name(result_id) + '_prod_' + run_name + f'_{i}' + '.out'
-        dhdl = extract_dHdl(file, T=300)
-        decorrelated = decorrelate_dhdl(dhdl, remove_burnin=True)
-        R_c, running_average = fwdrev_cumavg_Rc(dhdl2series(decorrelated), tol=2)
-        convergences[i] = R_c
-        db.execute('''INSERT INTO convergences (result_id, lambda, convergence) VALUES (?, ?, ?)''',
-                   (result_id, i, R_c))
-        os.chdir('..')
+    convergences = read_convergences(result_id, run_name)
+    db.executemany('''INSERT INTO convergences (result_id, lambda, convergence) VALUES (?, ?, ?)''',
+                   [(result_id, i, R_c) for i, R_c in enumerate(convergences)])
     db.execute('''UPDATE free_energies SET total_convergence = ? WHERE result_id = ?''',
                (np.mean(convergences), result_id))
     db.commit()
 
-    # TODO check for number of lambda windows
+
+def read_bootstrap(result_id):
+    """Read the deviations of the bootstrap resamples of the free energy from bootstrap.npy."""
+    return np.load(os.path.join(get_result_pathway(result_id), 'bootstrap.npy'))
+
+
+def save_bootstrap(db, result_id):
+    """
+    Save the bootstrap error and the bootstrap resamples of the free energy to the database.
+
+    Parameters
+    ----------
+    db : sqlite3.Connection
+        Database connection.
+    result_id : str
+        Id of the simulation result.
+    """
+    deviations = read_bootstrap(result_id)
+    db.execute('''UPDATE free_energies SET bootstrap_error = ? WHERE result_id = ?''',
+               (float(np.std(deviations)), result_id))
+    db.execute('''INSERT OR REPLACE INTO bootstrap_samples (result_id, deviations) VALUES (?, ?)''',
+               (result_id, deviations.astype(np.float64).tobytes()))
+    db.commit()
 
 
 def save_run_info(db, simulation_id):
@@ -85,6 +127,29 @@ def save_run_info(db, simulation_id):
     db.commit()
 
 
+def read_lambdas(result_id):
+    """
+    Read the free energy of every lambda segment and the total free energy from results.csv.
+
+    Parameters
+    ----------
+    result_id : str
+        Id of the results.
+
+    Returns
+    -------
+    tuple of (list, tuple)
+        Rows (lambda, lambda_result, error) of every segment (trapezoidal rule) or window (quadrature) and the total
+        free energy and its error.
+    """
+    data = pd.read_csv(os.path.join(get_result_pathway(result_id), 'results.csv'), sep=',')
+    states = data[data.iloc[:, 0] == 'States']
+    total = data[data.iloc[:, 1] == 'TOTAL'].iloc[0]
+    rows = [(i, float(lambda_result), float(error)) for i, (lambda_result, error) in
+            enumerate(zip(states.loc[:, 'TI'], states.loc[:, 'TI_Error']))]
+    return rows, (float(total.loc['TI']), float(total.loc['TI_Error']))
+
+
 def save_lambdas(db, result_id):
     """
     Save the lambdas and the free energy to the database.
@@ -96,17 +161,11 @@ def save_lambdas(db, result_id):
     result_id : str
         Id of the results.
     """
-    run_name = get_run_name_from_result_id(result_id)
-    current_protein_pathway = get_protein_pathway(run_name)
-    data = pd.read_csv(os.path.join(current_protein_pathway, get_ligand_one(result_id), get_complex_name(result_id),
-                                    'results.csv'), sep=',')
-    lambdas = data.iloc[:, 2]
-    errors = data.iloc[:, 3]
-    for i in range(0, 11):
-        db.execute('''INSERT INTO lambdas (result_id, lambda, lambda_result, error) VALUES (?, ?, ?, ?)''',
-                   (result_id, i, lambdas[i], errors[i]))
+    rows, (total_free_energy, total_error) = read_lambdas(result_id)
+    db.executemany('''INSERT INTO lambdas (result_id, lambda, lambda_result, error) VALUES (?, ?, ?, ?)''',
+                   [(result_id, *row) for row in rows])
     db.execute('''INSERT INTO free_energies (result_id, total_free_energy, total_error) VALUES (?, ?, ?)''',
-               (result_id, data.iloc[12].loc['TI'], data.iloc[12].loc['TI_Error']))
+               (result_id, total_free_energy, total_error))
     db.commit()
 
 
@@ -142,8 +201,11 @@ if __name__ == '__main__':
     db = get_db()
     if not args.redo:
         save_run_info(db, simulation_id)
-    os.system(f'python3 {os.path.join(get_amberti_path(), "analysis_workflow.py")} -c {complex} -p _prod_{run_name} -s {skip_time}')
+    schedule, clambdas, weights = get_lambda_schedule(run_name)
+    print(run_workflow(get_result_pathway(result_id), f'{complex}_prod_{run_name}', float(skip_time),
+                       weights if schedule is not None else None))
     save_lambdas(db, result_id)
     save_convergence(db, result_id, run_name)
+    save_bootstrap(db, result_id)
     save_analysis_errorless(db, result_id)
     db.close()
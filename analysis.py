@@ -0,0 +1,53 @@
+#!/bin/python3
+
+"""Sends the analysis of a finished transformation to the queue as a CPU job.
+
+The analysis is the fifth stage of a transformation. It is added to the simulations table when ti2p2 finishes and sent
+by check_queue.py, at most max_analyses at once, so that the GPU of ti2p2 is released as soon as the MD ends.
+"""
+
+import argparse
+import os
+import textwrap
+
+from database_helper import add_job_id, check_if_job_id_null
+from settings_helper import get_analysis_settings, get_environment, get_amberti_path
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='This script analyses the transformation')
+    parser.add_argument('-c', '--complex', help='Name of complex', required=True)
+    parser.add_argument('--timask1', help='timask1', required=False)
+    parser.add_argument('--timask2', help='timask2', required=False)
+    parser.add_argument('--scmask1', help='scmask1', required=False)
+    parser.add_argument('--scmask2', help='scmask2', required=False)
+    parser.add_argument('-r', '--simulation_id', help='Run id of the simulation', required=False, default="no_id")
+    parser.add_argument('-k', '--skiptime', help='Skip some time at the beginning', default='0')
+
+    args = parser.parse_args()
+
+    analysis_script = textwrap.dedent(f'''\
+#!/bin/bash
+#SBATCH --time=04:00:00
+#SBATCH --job-name=analysis
+{get_analysis_settings()}
+
+trap "python3 {os.path.join(get_amberti_path(), "update_job_status.py")} -r {args.simulation_id} -s 4; exit" ERR
+
+python3 {os.path.join(get_amberti_path(), "update_job_status.py")} -r {args.simulation_id} -s 2
+
+{get_environment()}
+python3 {os.path.join(get_amberti_path(), "analyse_data_after_run.py")} -r {args.simulation_id} -k {args.skiptime}
+
+python3 {os.path.join(get_amberti_path(), "update_job_status.py")} -r {args.simulation_id} -s 3
+''')
+
+    if check_if_job_id_null(args.simulation_id):
+        with open('analysis.txt', 'w') as outfile:
+            outfile.write(analysis_script)
+        output = os.popen(f'sbatch analysis.txt').read().strip()
+        print(output)
+        jobid = output.split()[-1]
+
+        add_job_id(job_id=jobid, simulation_id=args.simulation_id)
+    else:
+        print("Job id already exists. Please delete the job id to run again.")
@@ -0,0 +1,341 @@
+""" Disk cache of parsed and analysed lambda windows.
+
+Re-analysing a simulation (e.g. with redo_analysis after a failed database insert) parses and decorrelates every
+window again, although the output files have not changed. This module keeps the results of these steps on disk, so
+that repeated analyses of unchanged windows are read back immediately.
+
+Every entry is keyed by the SHA-256 hash of the content of the .out file and the parameters of the analysis step
+(temperature, skiptime and decorrelation threshold). The hash of a file is computed only once and reused for as long
+as its size and modification time stay the same. The cache lives in the analysis_cache folder next to the database,
+and the least recently used entries are removed when it grows over the size set by analysis_cache_size (in MB) in the
+settings file. Setting analysis_cache_size to 0 disables the cache.
+
+Functions
+---------
+extract_dHdl(outfile, T)
+    Cached dV/dλ of an output file as an alchemlyb DataFrame.
+
+window_dHdl(outfile, T)
+    Cached dV/dλ of a production window including its extension segment.
+
+decorrelated_dHdl(outfile, T, skiptime, threshold)
+    Cached decorrelated dV/dλ of a window, as done by the preprocessing of the ABFE workflow.
+
+window_convergence(outfile, T)
+    Cached forward/reverse convergence of a window.
+
+clear_cache()
+    Remove all entries from the cache.
+
+Usage:
+    python3 analysis_cache.py clear_cache
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from alchemlyb.convergence import fwdrev_cumavg_Rc
+from alchemlyb.preprocessing import decorrelate_dhdl, dhdl2series
+
+from amber_parser import read_dvdl, dvdl_to_dataframe, extract_dHdl as parse_dHdl, k_b
+from settings_helper import get_home_pathway, get_analysis_cache_size
+
+# Version of the format of the entries, entries of older versions are not read
+CACHE_VERSION = 2
+
+
+def get_cache_dir():
+    """Get the folder of the analysis cache."""
+    return os.path.join(get_home_pathway(), 'analysis_cache')
+
+
+def get_cache_db():
+    """Get the connection to the index of the analysis cache, creating it if needed."""
+    os.makedirs(get_cache_dir(), exist_ok=True)
+    db = sqlite3.connect(os.path.join(get_cache_dir(), 'analysis_cache.db'), timeout=60)
+    db.execute('''CREATE TABLE IF NOT EXISTS file_hashes
+                  (path text PRIMARY KEY,
+                  size int NOT NULL,
+                  mtime_ns int NOT NULL,
+                  hash text NOT NULL)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS entries
+                  (key text PRIMARY KEY,
+                  size int NOT NULL,
+                  last_access float NOT NULL)''')
+    return db
+
+
+def file_hash(db, file):
+    """
+    Get the SHA-256 hash of the content of a file.
+
+    The hash is only computed if the file is new or its size or modification time changed since the last call.
+
+    Parameters
+    ----------
+    db : sqlite3.Connection
+        Connection to the cache index.
+    file : str
+        Path to the file.
+
+    Returns
+    -------
+    str
+        Hex digest of the file content.
+    """
+    path = os.path.realpath(file)
+    stat = os.stat(path)
+    row = db.execute('SELECT size, mtime_ns, hash FROM file_hashes WHERE path=?', (path,)).fetchone()
+    if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+        return row[2]
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1 << 23), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    db.execute('INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, hash) VALUES (?, ?, ?, ?)',
+               (path, stat.st_size, stat.st_mtime_ns, digest))
+    db.commit()
+    return digest
+
+
+def entry_key(digest, kind, **parameters):
+    """Build the key of a cache entry from the file hash, the analysis step and its parameters."""
+    description = json.dumps({'version': CACHE_VERSION, 'file': digest, 'kind': kind, **parameters}, sort_keys=True)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def load_entry(db, key):
+    """Load the arrays of a cache entry, None if it is not cached."""
+    path = os.path.join(get_cache_dir(), key + '.npz')
+    if db.execute('SELECT key FROM entries WHERE key=?', (key,)).fetchone() is None or not os.path.isfile(path):
+        return None
+    with np.load(path) as data:
+        arrays = {name: data[name] for name in data.files}
+    db.execute('UPDATE entries SET last_access=? WHERE key=?', (time.time(), key))
+    db.commit()
+    return arrays
+
+
+def store_entry(db, key, **arrays):
+    """Save the arrays of a cache entry and remove the least recently used entries if the cache is too big."""
+    path = os.path.join(get_cache_dir(), key + '.npz')
+    # Write to a temporary file first, so that an analysis running at the same time never reads a partial entry
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as outfile:
+        np.savez(outfile, **arrays)
+    os.replace(temporary_path, path)
+    db.execute('INSERT OR REPLACE INTO entries (key, size, last_access) VALUES (?, ?, ?)',
+               (key, os.path.getsize(path), time.time()))
+    db.commit()
+    evict(db, get_analysis_cache_size() * 1e6)
+
+
+def evict(db, max_size):
+    """
+    Remove the least recently used entries until the cache is smaller than the maximal size.
+
+    Parameters
+    ----------
+    db : sqlite3.Connection
+        Connection to the cache index.
+    max_size : float
+        Maximal size of the cache in bytes.
+    """
+    total_size = db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+    if total_size <= max_size:
+        return
+    for key, size in db.execute('SELECT key, size FROM entries ORDER BY last_access').fetchall():
+        if total_size <= max_size:
+            break
+        path = os.path.join(get_cache_dir(), key + '.npz')
+        if os.path.isfile(path):
+            os.remove(path)
+        db.execute('DELETE FROM entries WHERE key=?', (key,))
+        total_size -= size
+    db.commit()
+
+
+def extract_dHdl(outfile, T):
+    """
+    Return gradients dH/dλ from an AMBER TI output file, reading them from the cache if the file is unchanged.
+
+    Drop-in replacement of :func:`amber_parser.extract_dHdl`.
+
+    Parameters
+    ----------
+    outfile : str
+        Path to the AMBER .out file.
+    T : float
+        Temperature in Kelvin at which the simulation was performed.
+
+    Returns
+    -------
+    pd.DataFrame or None
+        dH/dλ in units of kT indexed by time and lambda, None if the file contains no dV/dλ data.
+    """
+    if get_analysis_cache_size() <= 0:
+        return parse_dHdl(outfile, T)
+    db = get_cache_db()
+    try:
+        key = entry_key(file_hash(db, outfile), 'dvdl')
+        arrays = load_entry(db, key)
+        if arrays is None:
+            times, dvdl, header = read_dvdl(outfile)
+            arrays = {'times': times, 'dvdl': dvdl, 'clambda': header['clambda'], 'T': header['T']}
+            store_entry(db, key, **arrays)
+    finally:
+        db.close()
+
+    if not np.isclose(T, arrays['T'], atol=0.01):
+        raise ValueError(f"The temperature read from the input file ({float(arrays['T']):.2f} K) is different from "
+                         f"the temperature passed as parameter ({T:.2f} K)")
+    if len(arrays['dvdl']) == 0:
+        return None
+    return dvdl_to_dataframe(arrays['times'], arrays['dvdl'], float(arrays['clambda']), T)
+
+
+def window_files(outfile):
+    """Get the output files of a production window: the production file and the extension segment, if it exists."""
+    directory, name = os.path.split(outfile)
+    extension = os.path.join(directory, name.replace('_prod_', '_ext_', 1))
+    if extension != outfile and os.path.isfile(extension):
+        return [outfile, extension]
+    return [outfile]
+
+
+def window_hash(db, outfile):
+    """Get the hash of all output files of a production window."""
+    return '+'.join(file_hash(db, file) for file in window_files(outfile))
+
+
+def window_dHdl(outfile, T):
+    """
+    Return gradients dH/dλ of a production window, joining the production file and its extension segment.
+
+    Parameters
+    ----------
+    outfile : str
+        Path to the AMBER .out file of the production.
+    T : float
+        Temperature in Kelvin.
+
+    Returns
+    -------
+    pd.DataFrame or None
+        dH/dλ in units of kT indexed by time and lambda, None if the files contain no dV/dλ data.
+    """
+    frames = [dhdl for dhdl in (extract_dHdl(file, T) for file in window_files(outfile)) if dhdl is not None]
+    if len(frames) == 0:
+        return None
+    if len(frames) == 1:
+        return frames[0]
+    dhdl = pd.concat(frames)
+    dhdl.attrs = dict(frames[0].attrs)
+    return dhdl
+
+
+def decorrelated_dHdl(outfile, T, skiptime=0, threshold=50):
+    """
+    Return the decorrelated dH/dλ of a window, reading it from the cache if the files are unchanged.
+
+    The data before skiptime are discarded and the rest is decorrelated in the same way as by
+    :meth:`alchemlyb.workflows.ABFE.preprocess`: if fewer than threshold uncorrelated samples are found, all the samples
+    are kept.
+
+    Parameters
+    ----------
+    outfile : str
+        Path to the AMBER .out file.
+    T : float
+        Temperature in Kelvin.
+    skiptime : float
+        Data before this time (ps) are discarded as equilibration.
+    threshold : int
+        Minimal number of uncorrelated samples.
+
+    Returns
+    -------
+    pd.DataFrame
+        Decorrelated dH/dλ in units of kT.
+    """
+    def decorrelate():
+        dhdl = window_dHdl(outfile, T)
+        dhdl = dhdl[dhdl.index.get_level_values('time') >= skiptime]
+        subsample = decorrelate_dhdl(dhdl, remove_burnin=True)
+        if len(subsample) < threshold:
+            subsample = dhdl
+        return subsample
+
+    if get_analysis_cache_size() <= 0:
+        return decorrelate()
+    db = get_cache_db()
+    try:
+        key = entry_key(window_hash(db, outfile), 'decorrelated', T=T, skiptime=skiptime, threshold=threshold)
+        arrays = load_entry(db, key)
+        if arrays is None:
+            subsample = decorrelate()
+            # dV/dλ is kept in kcal/mol like the entries of extract_dHdl
+            arrays = {'times': subsample.index.get_level_values('time').to_numpy(dtype=float),
+                      'dvdl': subsample['dHdl'].to_numpy() * (k_b * T),
+                      'clambda': subsample.index.get_level_values('lambdas')[0]}
+            store_entry(db, key, **arrays)
+    finally:
+        db.close()
+    return dvdl_to_dataframe(arrays['times'], arrays['dvdl'], float(arrays['clambda']), T)
+
+
+def window_convergence(outfile, T):
+    """
+    Return the forward/reverse convergence R_c of a window, reading it from the cache if the files are unchanged.
+
+    Parameters
+    ----------
+    outfile : str
+        Path to the AMBER .out file.
+    T : float
+        Temperature in Kelvin.
+
+    Returns
+    -------
+    float
+        Convergence R_c of the decorrelated dH/dλ.
+    """
+    def convergence():
+        decorrelated = decorrelate_dhdl(window_dHdl(outfile, T), remove_burnin=True)
+        R_c, running_average = fwdrev_cumavg_Rc(dhdl2series(decorrelated), tol=2)
+        return R_c
+
+    if get_analysis_cache_size() <= 0:
+        return convergence()
+    db = get_cache_db()
+    try:
+        key = entry_key(window_hash(db, outfile), 'convergence', T=T)
+        arrays = load_entry(db, key)
+        if arrays is None:
+            arrays = {'R_c': convergence()}
+            store_entry(db, key, **arrays)
+    finally:
+        db.close()
+    return float(arrays['R_c'])
+
+
+def clear_cache():
+    """Remove all entries from the cache."""
+    db = get_cache_db()
+    evict(db, 0)
+    db.execute('DELETE FROM file_hashes')
+    db.commit()
+    db.close()
+    print('Analysis cache cleared')
+
+
+if __name__ == '__main__':
+    globals()[sys.argv[1]](*sys.argv[2:])
@@ -16,44 +16,125 @@ import pathlib
 import pickle
 import sys
 
+import numpy as np
+import pandas as pd
 from alchemlyb.workflows import ABFE
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Collect data and estimate free energy differences",
-                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter, )
-    parser.add_argument("-s", "--skiptime",
-                        help="Discard data prior to this specified time as 'equilibration' data. Units picoseconds. "
-                             "Default: 0 ps.",
-                        default=0, type=float, )
-    parser.add_argument("-c", "--complex", help="The complex name.", required=True, )
-    parser.add_argument("-p", "--prefix", help="Prefix after the complex name.", required=True, )
+from amber_parser import k_b
+from analysis_cache import window_dHdl, decorrelated_dHdl
+from bootstrap import block_bootstrap
+from lambda_schedule import window_statistics, quadrature_ti, trapezoid_weights
 
-    args = parser.parse_args(sys.argv[1:])
-    pre = args.complex + args.prefix
-    skip_time = args.skiptime
 
-    workflow = ABFE(software='AMBER', dir='./', prefix=f'*/{pre}', suffix='out', T=300, outdirectory='./')
+def quadrature_summary(dHdl_sample_list, weights, T):
+    """
+    Integrate the decorrelated dV/dλ of the windows with the quadrature weights of the lambda schedule.
+
+    Parameters
+    ----------
+    dHdl_sample_list : list of pd.DataFrame
+        Decorrelated dH/dλ of every window in units of kT, sorted by lambda.
+    weights : list of float
+        Quadrature weights of the windows.
+    T : float
+        Temperature in Kelvin.
+
+    Returns
+    -------
+    pd.DataFrame
+        Summary in the format of the ABFE workflow, with the contribution of every window in the States rows.
+    """
+    if len(weights) != len(dHdl_sample_list):
+        raise ValueError(f'The lambda schedule has {len(weights)} windows, but {len(dHdl_sample_list)} windows '
+                         f'were found')
+    means, variances = window_statistics([sample['dHdl'].to_numpy(dtype=float) for sample in dHdl_sample_list])
+    kT = k_b * T
+    weights = np.asarray(weights, dtype=float)
+    total, total_error = quadrature_ti(means, variances, weights)
+    index = [('States', str(i)) for i in range(len(weights))] + [('Stages', 'lambdas'), ('Stages', 'TOTAL')]
+    return pd.DataFrame({'TI': np.concatenate((weights * means, [total, total])) * kT,
+                         'TI_Error': np.concatenate((weights * np.sqrt(variances), [total_error, total_error])) * kT},
+                        index=pd.MultiIndex.from_tuples(index))
+
+
+def run_workflow(directory, pre, skip_time=0, weights=None):
+    """
+    Estimate the free energy difference of one transformation with the ABFE workflow.
+
+    Without weights, dV/dλ is integrated with the trapezoidal rule of alchemlyb. With the quadrature weights of the
+    lambda schedule of the run, it is integrated with them instead (e.g. Gauss-Legendre quadrature).
+    The summary is saved to result.p and results.csv in the directory of the transformation, and the deviations of the
+    block bootstrap resamples of the free energy from their mean (kcal/mol) are saved to bootstrap.npy.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the transformation, containing one folder per lambda window.
+    pre : str
+        Prefix of the production output files (complex name and prefix after it).
+    skip_time : float
+        Discard data prior to this time (ps) as equilibration.
+    weights : list of float
+        Quadrature weights of the lambda windows (optional).
+
+    Returns
+    -------
+    pd.DataFrame
+        Summary of the free energy differences between the lambda windows and in total.
+    """
+    workflow = ABFE(software='AMBER', dir=directory, prefix=f'*/{pre}', suffix='out', T=300, outdirectory=directory)
 
     # Set the unit to kcal/mol
     workflow.update_units('kcal/mol')
 
-    # Read the data
-    workflow.read(read_u_nk=False)
+    # Read the data with the fast dV/dl-only parser, unchanged windows are read from the analysis cache.
+    # Windows extended by adaptive sampling are joined with their extension segment. The windows are read here instead
+    # of by workflow.read, and sorted by lambda as it does.
+    dHdl_list = [window_dHdl(file, workflow.T) for file in workflow.file_list]
+    order = sorted(range(len(dHdl_list)), key=lambda i: dHdl_list[i].index.get_level_values('lambdas')[0])
+    workflow.file_list = [workflow.file_list[i] for i in order]
+    workflow.dHdl_list = [dHdl_list[i] for i in order]
+    workflow.u_nk_list = []
 
-    # Decorrelate the data
-    workflow.preprocess(skiptime=skip_time, uncorr='dhdl', threshold=50)
+    # Decorrelate the data (same as workflow.preprocess(skiptime=skip_time, uncorr='dhdl', threshold=50), but cached)
+    workflow.dHdl_sample_list = [decorrelated_dHdl(file, workflow.T, skip_time, 50) for file in workflow.file_list]
 
-    # Run the estimator
-    workflow.estimate(estimators=['TI'])
+    if weights is None:
+        # Run the estimator
+        workflow.estimate(estimators=['TI'])
 
-    # Retrieve the result
-    summary = workflow.generate_result()
+        # Retrieve the result
+        summary = workflow.generate_result()
+    else:
+        summary = quadrature_summary(workflow.dHdl_sample_list, weights, workflow.T)
 
     # Save the summary to a pickle file
-    pickle.dump(summary, open("result.p", "wb"))
-
-    # Print the summary
-    print(summary)
+    pickle.dump(summary, open(os.path.join(directory, "result.p"), "wb"))
 
     # Save the summary as a CSV file
-    summary.round(6).to_csv("results.csv")
+    summary.round(6).to_csv(os.path.join(directory, "results.csv"))
+
+    # Bootstrap the free energy from the whole dV/dl series of the windows, integrated in the same way as above
+    series = [dhdl['dHdl'].to_numpy(dtype=float)[dhdl.index.get_level_values('time') >= skip_time]
+              for dhdl in workflow.dHdl_list]
+    if weights is None:
+        weights = trapezoid_weights([dhdl.index.get_level_values('lambdas')[0] for dhdl in workflow.dHdl_list])
+    resamples = block_bootstrap(series, weights) * k_b * workflow.T
+    np.save(os.path.join(directory, "bootstrap.npy"), resamples - resamples.mean())
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect data and estimate free energy differences",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter, )
+    parser.add_argument("-s", "--skiptime",
+                        help="Discard data prior to this specified time as 'equilibration' data. Units picoseconds. "
+                             "Default: 0 ps.",
+                        default=0, type=float, )
+    parser.add_argument("-c", "--complex", help="The complex name.", required=True, )
+    parser.add_argument("-p", "--prefix", help="Prefix after the complex name.", required=True, )
+
+    args = parser.parse_args(sys.argv[1:])
+
+    # Print the summary
+    print(run_workflow('./', args.complex + args.prefix, args.skiptime))
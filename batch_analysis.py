@@ -0,0 +1,332 @@
+""" Re-analyses many results at once.
+
+It performs the following tasks:
+
+1. Selects the results to analyse - all results of a run, a list of result ids, or only the results with an analysis
+   error.
+2. Analyses them concurrently, either on a local process pool or as a Slurm array of CPU tasks.
+3. Writes all results to the database in one transaction and reports the results that failed, with their errors.
+
+With --slurm, every array task saves its result to a JSON file, and a collecting job that starts after the whole array
+has ended writes them to the database.
+
+Usage:
+    python3 batch_analysis.py [-n run_name | -i result_id [result_id ...] | --collect folder] [-e] [-j processes]
+                              [-k skiptime] [--slurm]
+
+Arguments:
+    -n, --run_name: Analyse all results of the run.
+    -i, --result_ids: Analyse the listed results.
+    --collect: Write the results saved by the Slurm array tasks in the folder to the database.
+    -e, --errors: Only analyse the results with an analysis error. Without -n or -i, all results with an analysis error
+                  are analysed.
+    -j, --processes: Number of results analysed at once on the local machine (default is '1').
+    -k, --skiptime: Skip some time at the beginning (default is '0').
+    --slurm: Submit the analyses as a Slurm array of CPU tasks.
+    --save: Save the results to a JSON file instead of the database (used by the Slurm array tasks).
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import textwrap
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+from analyse_data_after_run import get_result_pathway, read_lambdas, read_convergences, read_bootstrap
+from analysis_workflow import run_workflow
+from database_helper import get_db, get_lambda_schedule
+from settings_helper import get_amberti_path, get_analysis_settings, get_environment, get_home_pathway, \
+    get_max_analyses
+from simulation_id_helper import get_complex_name, get_run_name_from_result_id, get_ligand_one, get_ligand_two, \
+    get_is_wat
+
+
+def get_result_ids(run_name=None, errors_only=False):
+    """
+    Get the ids of the results to analyse.
+
+    Parameters
+    ----------
+    run_name : str
+        Only results of this run (optional).
+    errors_only : bool
+        Only results with an analysis error.
+
+    Returns
+    -------
+    list of str
+        Ids of the results.
+    """
+    query = 'SELECT result_id FROM run_info WHERE 1=1'
+    parameters = []
+    if run_name is not None:
+        query += ' AND run_name=?'
+        parameters.append(run_name)
+    if errors_only:
+        query += ' AND error=1'
+    db = get_db()
+    result_ids = [row[0] for row in db.execute(query + ' ORDER BY result_id', parameters).fetchall()]
+    db.close()
+    return result_ids
+
+
+def analyse_item(result_id, skip_time=0):
+    """
+    Analyse one result without writing to the database.
+
+    Parameters
+    ----------
+    result_id : str
+        Id of the result.
+    skip_time : float
+        Skip some time at the beginning (ps).
+
+    Returns
+    -------
+    dict
+        Lambda rows, total free energy and error, convergences of the windows, deviations of the bootstrap resamples
+        and the error message (None if the analysis succeeded).
+    """
+    item = {'result_id': result_id, 'error': None}
+    try:
+        run_name = get_run_name_from_result_id(result_id)
+        schedule, clambdas, weights = get_lambda_schedule(run_name)
+        run_workflow(get_result_pathway(result_id), f'{get_complex_name(result_id)}_prod_{run_name}', skip_time,
+                     weights if schedule is not None else None)
+        item['lambdas'], item['free_energy'] = read_lambdas(result_id)
+        item['convergences'] = read_convergences(result_id, run_name)
+        item['bootstrap'] = read_bootstrap(result_id).tolist()
+    except Exception:
+        item['error'] = traceback.format_exc()
+    return item
+
+
+def analyse_items(result_ids, skip_time=0, processes=1):
+    """
+    Analyse several results, several of them at once if processes is larger than 1.
+
+    Parameters
+    ----------
+    result_ids : list of str
+        Ids of the results.
+    skip_time : float
+        Skip some time at the beginning (ps).
+    processes : int
+        Number of results analysed at once.
+
+    Returns
+    -------
+    list of dict
+        Analysed items in the order of result_ids (see analyse_item).
+    """
+    if processes <= 1 or len(result_ids) <= 1:
+        return [analyse_item(result_id, skip_time) for result_id in result_ids]
+    with ProcessPoolExecutor(max_workers=min(processes, len(result_ids))) as executor:
+        return list(executor.map(analyse_item, result_ids, repeat(skip_time)))
+
+
+def save_items(db, items):
+    """
+    Write analysed items to the database in one transaction.
+
+    The old results of every item are replaced, and the error in run_info is set for every item.
+
+    Parameters
+    ----------
+    db : sqlite3.Connection
+        Database connection.
+    items : list of dict
+        Analysed items (see analyse_item).
+    """
+    done = [item for item in items if item['error'] is None]
+    done_ids = [(item['result_id'],) for item in done]
+
+    now = datetime.datetime.now()
+    db.executemany('''INSERT OR IGNORE INTO run_info (result_id, run_name, simulation_datetime, ligand_1, ligand_2,
+                      is_wat, error) VALUES (?, ?, ?, ?, ?, ?, 1)''',
+                   [(item['result_id'], get_run_name_from_result_id(item['result_id']), now,
+                     get_ligand_one(item['result_id']), get_ligand_two(item['result_id']),
+                     get_is_wat(item['result_id'])) for item in items])
+    for table in ('lambdas', 'free_energies', 'convergences', 'bootstrap_samples'):
+        db.executemany(f'DELETE FROM {table} WHERE result_id=?', done_ids)
+    db.executemany('''INSERT INTO lambdas (result_id, lambda, lambda_result, error) VALUES (?, ?, ?, ?)''',
+                   [(item['result_id'], *row) for item in done for row in item['lambdas']])
+    db.executemany('''INSERT INTO free_energies (result_id, total_free_energy, total_error, total_convergence,
+                      bootstrap_error) VALUES (?, ?, ?, ?, ?)''',
+                   [(item['result_id'], *item['free_energy'], float(np.mean(item['convergences'])),
+                     float(np.std(item['bootstrap']))) for item in done])
+    db.executemany('''INSERT INTO convergences (result_id, lambda, convergence) VALUES (?, ?, ?)''',
+                   [(item['result_id'], i, R_c) for item in done for i, R_c in enumerate(item['convergences'])])
+    db.executemany('''INSERT INTO bootstrap_samples (result_id, deviations) VALUES (?, ?)''',
+                   [(item['result_id'], np.array(item['bootstrap'], dtype=np.float64).tobytes()) for item in done])
+    db.executemany('''UPDATE run_info SET error = 0 WHERE result_id = ?''', done_ids)
+    db.executemany('''UPDATE run_info SET error = 1 WHERE result_id = ?''',
+                   [(item['result_id'],) for item in items if item['error'] is not None])
+    db.commit()
+
+
+def report(items):
+    """
+    Print the result of every item and the errors of the failed ones.
+
+    Parameters
+    ----------
+    items : list of dict
+        Analysed items (see analyse_item).
+
+    Returns
+    -------
+    list of str
+        Ids of the failed results.
+    """
+    failed = [item for item in items if item['error'] is not None]
+    for item in items:
+        if item['error'] is None:
+            print(f"OK     {item['result_id']}: {item['free_energy'][0]:.4f} +- {item['free_energy'][1]:.4f}")
+        else:
+            print(f"ERROR  {item['result_id']}: {item['error'].strip().splitlines()[-1]}")
+    for item in failed:
+        print(f"\nError in {item['result_id']}:\n{item['error']}")
+    print(f'\n{len(items) - len(failed)} of {len(items)} results analysed successfully')
+    return [item['result_id'] for item in failed]
+
+
+def collect_items(folder):
+    """
+    Read the items saved by the tasks of a Slurm array.
+
+    Results whose task did not save anything (e.g. because it ran out of time) are returned as failed.
+
+    Parameters
+    ----------
+    folder : str
+        Folder of the batch analysis.
+
+    Returns
+    -------
+    list of dict
+        Analysed items (see analyse_item).
+    """
+    with open(os.path.join(folder, 'result_ids.txt'), 'r') as infile:
+        result_ids = infile.read().split()
+    items = {}
+    for file in glob.glob(os.path.join(folder, '*.json')):
+        with open(file, 'r') as infile:
+            for item in json.load(infile):
+                items[item['result_id']] = item
+    return [items.get(result_id, {'result_id': result_id, 'error': 'No result was saved by the Slurm task'})
+            for result_id in result_ids]
+
+
+def submit_array(result_ids, skip_time=0):
+    """
+    Submit the analyses as a Slurm array of CPU tasks and a job collecting their results.
+
+    Parameters
+    ----------
+    result_ids : list of str
+        Ids of the results.
+    skip_time : float
+        Skip some time at the beginning (ps).
+
+    Returns
+    -------
+    str
+        Folder of the batch analysis.
+    """
+    folder = os.path.join(get_home_pathway(), 'batch_analysis', datetime.datetime.now().strftime('%Y%m%d_%H%M%S'))
+    os.makedirs(folder)
+    with open(os.path.join(folder, 'result_ids.txt'), 'w') as outfile:
+        outfile.write('\n'.join(result_ids) + '\n')
+    script = os.path.join(get_amberti_path(), 'batch_analysis.py')
+
+    array_script = textwrap.dedent(f'''\
+#!/bin/bash
+#SBATCH --time=04:00:00
+#SBATCH --job-name=batch_analysis
+#SBATCH --array=0-{len(result_ids) - 1}%{get_max_analyses()}
+#SBATCH --output={os.path.join(folder, 'slurm-%A_%a.out')}
+{get_analysis_settings()}
+
+{get_environment()}
+result_id=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" {os.path.join(folder, 'result_ids.txt')})
+python3 {script} -i $result_id -k {skip_time} --save {folder}/$result_id.json
+''')
+    collect_script = textwrap.dedent(f'''\
+#!/bin/bash
+#SBATCH --time=01:00:00
+#SBATCH --job-name=batch_collect
+#SBATCH --output={os.path.join(folder, 'collect.out')}
+{get_analysis_settings()}
+
+{get_environment()}
+python3 {script} --collect {folder}
+''')
+    with open(os.path.join(folder, 'array.txt'), 'w') as outfile:
+        outfile.write(array_script)
+    with open(os.path.join(folder, 'collect.txt'), 'w') as outfile:
+        outfile.write(collect_script)
+
+    output = os.popen(f'sbatch {os.path.join(folder, "array.txt")}').read().strip()
+    print(output)
+    jobid = output.split()[-1]
+    print(os.popen(f'sbatch --dependency=afterany:{jobid} {os.path.join(folder, "collect.txt")}').read().strip())
+    print(f'The results will be written to the database by the collecting job, its report is in '
+          f'{os.path.join(folder, "collect.out")}')
+    return folder
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='This script re-analyses many results at once')
+    selection = parser.add_mutually_exclusive_group()
+    selection.add_argument('-n', '--run_name', help='Analyse all results of the run')
+    selection.add_argument('-i', '--result_ids', help='Analyse the listed results', nargs='+')
+    selection.add_argument('--collect', help='Write the results saved by the Slurm array tasks in the folder')
+    parser.add_argument('-e', '--errors', help='Only analyse the results with an analysis error', action='store_true')
+    parser.add_argument('-j', '--processes', help='Number of results analysed at once', default=1, type=int)
+    parser.add_argument('-k', '--skiptime', help='Skip some time at the beginning', default=0, type=float)
+    parser.add_argument('--slurm', help='Submit the analyses as a Slurm array of CPU tasks', action='store_true')
+    parser.add_argument('--save', help='Save the results to a JSON file instead of the database')
+
+    args = parser.parse_args()
+    if not (args.run_name or args.result_ids or args.collect or args.errors):
+        parser.error('one of the arguments -n/--run_name -i/--result_ids --collect -e/--errors is required')
+
+    if args.collect:
+        items = collect_items(args.collect)
+    else:
+        if args.result_ids:
+            result_ids = args.result_ids
+            if args.errors:
+                error_ids = get_result_ids(errors_only=True)
+                result_ids = [result_id for result_id in result_ids if result_id in error_ids]
+        else:
+            result_ids = get_result_ids(args.run_name, args.errors)
+        if len(result_ids) == 0:
+            print('No results to analyse')
+            exit(0)
+
+        if args.slurm:
+            submit_array(result_ids, args.skiptime)
+            exit(0)
+
+        print(f'Analysing {len(result_ids)} results with {args.processes} processes')
+        items = analyse_items(result_ids, args.skiptime, args.processes)
+        if args.save:
+            with open(args.save, 'w') as outfile:
+                json.dump(items, outfile)
+            report(items)
+            exit(0)
+
+    db = get_db()
+    save_items(db, items)
+    db.close()
+    failed = report(items)
+    if failed:
+        exit(1)
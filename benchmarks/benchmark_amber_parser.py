@@ -0,0 +1,216 @@
+""" Benchmark of the fast dV/dl parser against the AMBER parser of alchemlyb.
+
+Synthetic pmemd TI output files (two TI regions, energy averages every ntave steps and the final averages and
+fluctuations blocks) are generated for a set of lengths, both parsers are timed on them and their results compared.
+
+Usage:
+    python3 benchmarks/benchmark_amber_parser.py [-f frames] [-w windows] [-r repeats] [-o output]
+
+Arguments:
+    -f, --frames: Numbers of dV/dl frames per file to benchmark (default is '1000 10000 100000').
+    -w, --windows: Number of lambda windows (files) per benchmark (default is '3').
+    -r, --repeats: Number of timed repeats, the best one is reported (default is '3').
+    -o, --output: JSON file to write the results to (optional).
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from alchemlyb.parsing.amber import extract_dHdl as alchemlyb_extract_dHdl
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from amber_parser import extract_dHdl
+
+HEADER = '''\
+
+          -------------------------------------------------------
+          Amber 20 PMEMD                              2020
+          -------------------------------------------------------
+
+| PMEMD implementation of SANDER, Release 18
+
+ Here is the input file:
+
+NVT MD w/No position restraints and PME (sander)
+ &cntrl
+  ntpr   = {ntpr},
+  nstlim = {nstlim},
+  dt     = {dt},
+  temp0  = {temp0},
+  clambda={clambda},
+ &end
+
+--------------------------------------------------------------------------------
+   2.  CONTROL  DATA  FOR  THE  RUN
+--------------------------------------------------------------------------------
+
+default_name
+
+General flags:
+     imin    =       0, nmropt  =       0
+
+Nature and format of output:
+     ntxo    =       2, ntpr    = {ntpr:7d}, ntrx    =       1, ntwr    =  {nstlim:6d}
+     iwrap   =       1, ntwx    =   50000, ntwv    =      -1, ntwe    =    1000
+
+Molecular dynamics:
+     nstlim  = {nstlim:9d}, nscm    =      1000, nrespa  =         1
+     t       =   0.00000, dt      = {dt:9.5f}, vlimit  =  -1.00000
+
+Berendsen (weak-coupling) temperature regulation:
+     temp0   = {temp0:9.5f}, tempi   = {temp0:9.5f}, tautp   =   2.00000
+
+Free energy options:
+     icfe    =       1, ifsc    =       1, klambda =       1
+     clambda = {clambda:7.4f}, scalpha =  0.5000, scbeta  = 12.0000
+     sceeorder =       2
+     dynlmb =  0.0000 logdvdl =       0
+
+--------------------------------------------------------------------------------
+   3.  ATOMIC COORDINATES AND VELOCITIES
+--------------------------------------------------------------------------------
+
+default_name
+ begin time read from input coords = {t0:9.3f} ps
+
+--------------------------------------------------------------------------------
+   4.  RESULTS
+--------------------------------------------------------------------------------
+
+'''
+
+ENERGY_BLOCK = '''\
+ NSTEP = {nstep:8d}   TIME(PS) = {time:11.3f}  TEMP(K) =   300.12  PRESS =     0.0
+ Etot   =    -48999.2247  EKtot   =     21421.4705  EPtot      =    -70420.6952
+ BOND   =       840.4000  ANGLE   =      2517.8698  DIHED      =      3653.4661
+ 1-4 NB =      1102.0880  1-4 EEL =     11628.0992  VDWAALS    =      6044.2521
+ EELEC  =    -96206.8705  EHBOND  =         0.0000  RESTRAINT  =         0.0000
+ DV/DL  = {dvdl:14.4f}
+ ------------------------------------------------------------------------------
+
+  Softcore part of the system:      11 atoms,       TEMP(K)    =         301.27
+ SC_Etot=        65.7365  SC_EKtot=        33.3876  SC_EPtot   =        32.3489
+ SC_EEL_DER=      2.2296  SC_VDW_DER=      -8.2296  SC_DERIV   =        -6.0000
+ ------------------------------------------------------------------------------
+
+'''
+
+FOOTER = '''\
+--------------------------------------------------------------------------------
+   5.  TIMINGS
+--------------------------------------------------------------------------------
+
+|  Master Setup CPU time:            0.61 seconds
+'''
+
+
+def write_synthetic_out(path, clambda, frames, ntpr=1000, ntave=1000, dt=0.001, temp0=300.0, t0=1000.0, seed=0):
+    """Write a synthetic pmemd TI output file.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file to write.
+    clambda : float
+        Lambda value of the window.
+    frames : int
+        Number of printed MD steps.
+    ntpr : int
+        Number of MD steps between the printed energies.
+    ntave : int
+        Number of MD steps between the printed energy averages.
+    dt : float
+        Time step in ps.
+    temp0 : float
+        Temperature in K.
+    t0 : float
+        Starting time in ps.
+    seed : int
+        Seed of the random dV/dl series.
+
+    Returns
+    -------
+    np.ndarray
+        The dV/dl values written to the file in kcal/mol.
+
+    """
+    rng = np.random.default_rng(seed)
+    # AR(1) series so that the data are correlated like real dV/dl
+    noise = rng.normal(scale=5.0, size=frames)
+    dvdl = np.empty(frames)
+    dvdl[0] = noise[0]
+    for i in range(1, frames):
+        dvdl[i] = 0.8 * dvdl[i - 1] + noise[i]
+    dvdl = np.round(dvdl + 40.0 * (clambda - 0.5), 4)
+
+    nstlim = frames * ntpr
+    with open(path, 'w') as outfile:
+        outfile.write(HEADER.format(ntpr=ntpr, nstlim=nstlim, dt=dt, temp0=temp0, clambda=clambda, t0=t0))
+        for i in range(frames):
+            nstep = (i + 1) * ntpr
+            for region in (1, 2):
+                outfile.write(f'| TI region  {region}\n\n\n')
+                outfile.write(ENERGY_BLOCK.format(nstep=nstep, time=t0 + nstep * dt, dvdl=dvdl[i]))
+            if nstep % ntave == 0:
+                outfile.write(f'      A V E R A G E S   O V E R    {ntave // ntpr} S T E P S\n\n\n')
+                outfile.write(ENERGY_BLOCK.format(nstep=nstep, time=t0 + nstep * dt, dvdl=dvdl[i]))
+        for title in (f'A V E R A G E S   O V E R {frames:7d} S T E P S', 'R M S  F L U C T U A T I O N S',
+                      f'DV/DL, AVERAGES OVER {frames:7d} STEPS'):
+            outfile.write(f'      {title}\n\n\n')
+            outfile.write(ENERGY_BLOCK.format(nstep=nstlim, time=t0 + nstlim * dt, dvdl=dvdl.mean()))
+        outfile.write(FOOTER)
+    return dvdl
+
+
+def time_parser(parser, files, repeats):
+    """Return the best wall time of parsing all files and the parsed data of the last repeat."""
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        data = [parser(file, 300) for file in files]
+        best = min(best, time.perf_counter() - start)
+    return best, data
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the fast dV/dl parser against alchemlyb')
+    parser.add_argument('-f', '--frames', help='Numbers of dV/dl frames per file', nargs='+', type=int,
+                        default=[1000, 10000, 100000])
+    parser.add_argument('-w', '--windows', help='Number of lambda windows', type=int, default=3)
+    parser.add_argument('-r', '--repeats', help='Number of timed repeats', type=int, default=3)
+    parser.add_argument('-o', '--output', help='JSON file to write the results to', required=False)
+
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for frames in args.frames:
+            files = []
+            for window, clambda in enumerate(np.linspace(0.1, 0.9, args.windows)):
+                file = os.path.join(tmpdir, f'synthetic_{frames}_{window}.out')
+                write_synthetic_out(file, round(clambda, 5), frames, seed=window)
+                files.append(file)
+            size = sum(os.path.getsize(file) for file in files)
+
+            alchemlyb_time, alchemlyb_data = time_parser(alchemlyb_extract_dHdl, files, args.repeats)
+            fast_time, fast_data = time_parser(extract_dHdl, files, args.repeats)
+            for expected, actual in zip(alchemlyb_data, fast_data):
+                pd.testing.assert_frame_equal(expected, actual)
+
+            results.append({'frames': frames, 'windows': args.windows, 'megabytes': size / 1e6,
+                            'alchemlyb_seconds': alchemlyb_time, 'fast_seconds': fast_time,
+                            'speedup': alchemlyb_time / fast_time})
+            print(f'{frames:>8d} frames x {args.windows} windows ({size / 1e6:8.1f} MB): '
+                  f'alchemlyb {alchemlyb_time:8.3f} s, fast {fast_time:8.3f} s, '
+                  f'speedup {alchemlyb_time / fast_time:6.1f}x')
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
@@ -0,0 +1,200 @@
+""" Validation benchmark of hydrogen mass repartitioning (HMR) with a 4 fs time step.
+
+The topologies of the test systems (e.g. the MCL1 transformations in pytest) are repartitioned and checked: the mass of
+every residue has to stay the same, the hydrogens outside water get the new mass, no heavy atom may become lighter
+than a hydrogen, and the atoms of the two TI regions that are not softcore (which pmemd pairs one to one) should keep
+the same masses. The inputs of the stages are generated with and without HMR and compared, the simulated time has to
+stay the same and the number of MD steps tells the reduction of GPU time per transformation.
+
+When the same transformations were run with and without HMR (run_several_sims.py --hmr), the free energies of the legs
+of both runs are compared as well.
+
+Usage:
+    python3 benchmarks/benchmark_hmr.py [-p protein_folder] [-w windows] [-r run_name hmr_run_name] [-o output]
+
+Arguments:
+    -p, --protein_folder: Folder with the transformation folders of a protein (default is 'pytest/MCL1').
+    -w, --windows: Number of lambda windows of a transformation (default is '12').
+    -r, --runs: Run without and run with HMR of the same transformations to compare their free energies (optional).
+    -o, --output: JSON file to write the results to (optional).
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from mdin import stage_input, HMR_STAGES
+from parm7 import read_parm7, read_masks, resolve_mask, repartition_hydrogen_masses, residue_of_atoms, \
+    MASK_FLAGS, HYDROGEN_MASS, WATER_RESIDUES
+
+
+def find_systems(protein_folder):
+    """Get the folders and complex names of the transformations of a protein that have a topology."""
+    systems = []
+    for folder, _, files in sorted(os.walk(protein_folder)):
+        complex_name = os.path.basename(folder)
+        if f'{complex_name}.parm7' in files:
+            systems.append((folder, complex_name))
+    return systems
+
+
+def common_atoms(topology, masks):
+    """Get the atoms of both TI regions that are not softcore, in the order pmemd pairs them."""
+    timask1, timask2, scmask1, scmask2 = (set(resolve_mask(topology, mask)[0]) for mask in masks)
+    return sorted(timask1 - scmask1), sorted(timask2 - scmask2)
+
+
+def validate_topology(folder, complex_name):
+    """
+    Repartition the topology of a transformation and check the masses.
+
+    Parameters
+    ----------
+    folder : str
+        Folder of the transformation.
+    complex_name : str
+        Name of the complex.
+
+    Returns
+    -------
+    dict
+        Number of atoms and repartitioned hydrogens, the seconds of the repartitioning, the largest change of the mass
+        of a residue, the lightest heavy atom, whether all hydrogens outside water have the new mass, and the largest
+        mass difference of the paired common atoms before and after the repartitioning (None without params file).
+    """
+    parm7_file = os.path.join(folder, f'{complex_name}.parm7')
+    flags = MASK_FLAGS + ('MASS', 'ATOMIC_NUMBER')
+    with tempfile.TemporaryDirectory() as directory:
+        hmr_file = os.path.join(directory, f'{complex_name}_hmr.parm7')
+        start = time.perf_counter()
+        hydrogens = repartition_hydrogen_masses(parm7_file, hmr_file)
+        seconds = time.perf_counter() - start
+        before, after = read_parm7(parm7_file, flags), read_parm7(hmr_file, flags)
+
+    residue_of = np.array(residue_of_atoms(before))
+    mass_before, mass_after = np.array(before['MASS']), np.array(after['MASS'])
+    residue_change = np.bincount(residue_of, weights=mass_after - mass_before)
+    is_hydrogen = np.array(before['ATOMIC_NUMBER']) == 1
+    in_water = np.isin(np.array(before['RESIDUE_LABEL'])[residue_of], WATER_RESIDUES)
+    result = {'atoms': len(mass_before), 'hydrogens': hydrogens, 'seconds': seconds,
+              'max_residue_mass_change': float(np.max(np.abs(residue_change))),
+              'lightest_heavy_atom': float(np.min(mass_after[~is_hydrogen])),
+              'hydrogens_repartitioned': bool(np.allclose(mass_after[is_hydrogen & ~in_water], HYDROGEN_MASS)),
+              'common_mass_difference_before': None, 'common_mass_difference_after': None}
+
+    params_file = os.path.join(folder, f'params_{complex_name}.in')
+    if os.path.isfile(params_file):
+        common_1, common_2 = common_atoms(before, read_masks(params_file))
+        if len(common_1) == len(common_2):
+            result['common_mass_difference_before'] = float(np.max(np.abs(mass_before[common_1] -
+                                                                          mass_before[common_2]), initial=0))
+            result['common_mass_difference_after'] = float(np.max(np.abs(mass_after[common_1] -
+                                                                         mass_after[common_2]), initial=0))
+    return result
+
+
+def compare_inputs(windows=12):
+    """
+    Compare the inputs of the stages with and without HMR.
+
+    Parameters
+    ----------
+    windows : int
+        Number of lambda windows, which run ti2p1 and ti2p2 each.
+
+    Returns
+    -------
+    dict
+        MD steps and simulated time (ps) of every MD stage without and with HMR (the heating runs with 1 fs either way),
+        and the ratio of the MD steps of a whole transformation.
+    """
+    stages = {}
+    for stage in ('06_heat',) + HMR_STAGES:
+        rows = []
+        for hmr in (False, True):
+            cntrl = stage_input(stage, hmr=hmr)['namelists'][0][1]
+            rows.append((int(cntrl['nstlim']), int(cntrl['nstlim']) * float(cntrl['dt'])))
+        stages[stage] = {'steps': rows[0][0], 'hmr_steps': rows[1][0], 'time': rows[0][1], 'hmr_time': rows[1][1]}
+    repeats = {stage: windows if stage in ('ti2p1', 'ti2p2') else 1 for stage in stages}
+    steps = sum(stages[stage]['steps'] * repeats[stage] for stage in stages)
+    hmr_steps = sum(stages[stage]['hmr_steps'] * repeats[stage] for stage in stages)
+    return {'stages': stages, 'step_ratio': steps / hmr_steps}
+
+
+def compare_runs(db, run_name, hmr_run_name):
+    """
+    Compare the free energies of the legs of a run without and a run with HMR.
+
+    Parameters
+    ----------
+    db : sqlite3.Connection
+        Database connection object.
+    run_name, hmr_run_name : str
+        Run without and run with HMR.
+
+    Returns
+    -------
+    list of dict
+        Complex, both free energies, their difference and its z-score for every leg of both runs.
+    """
+    energies = []
+    for name in (run_name, hmr_run_name):
+        rows = db.execute("SELECT result_id, total_free_energy, total_error FROM free_energies "
+                          "WHERE SUBSTR(result_id, INSTR(result_id, '_') + 1) = ?", (name,)).fetchall()
+        energies.append({result_id.split('_', 1)[0]: (energy, error) for result_id, energy, error in rows})
+    comparison = []
+    for complex_name in sorted(set(energies[0]) & set(energies[1])):
+        (energy, error), (hmr_energy, hmr_error) = energies[0][complex_name], energies[1][complex_name]
+        difference = hmr_energy - energy
+        comparison.append({'complex': complex_name, 'energy': energy, 'hmr_energy': hmr_energy,
+                           'difference': difference, 'z_score': difference / np.sqrt(error ** 2 + hmr_error ** 2)})
+    return comparison
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Validation benchmark of hydrogen mass repartitioning')
+    parser.add_argument('-p', '--protein_folder', help='Folder with the transformation folders of a protein',
+                        default=os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'pytest', 'MCL1'))
+    parser.add_argument('-w', '--windows', help='Number of lambda windows', type=int, default=12)
+    parser.add_argument('-r', '--runs', help='Run without and run with HMR of the same transformations', nargs=2,
+                        required=False)
+    parser.add_argument('-o', '--output', help='JSON file to write the results to', required=False)
+
+    args = parser.parse_args()
+
+    results = {'topologies': {}, 'inputs': compare_inputs(args.windows)}
+    for folder, complex_name in find_systems(args.protein_folder):
+        result = results['topologies'][complex_name] = validate_topology(folder, complex_name)
+        print(f'{complex_name:>15s} {result["atoms"]:>7d} atoms, {result["hydrogens"]:>4d} hydrogens in '
+              f'{result["seconds"]:.3f} s, residue mass change {result["max_residue_mass_change"]:.1e} amu, '
+              f'lightest heavy atom {result["lightest_heavy_atom"]:.3f} amu, '
+              f'common atom mass difference {result["common_mass_difference_before"]} -> '
+              f'{result["common_mass_difference_after"]} amu')
+    for stage, row in results['inputs']['stages'].items():
+        print(f'{stage:>8s} {row["steps"]:>8d} steps -> {row["hmr_steps"]:>8d} steps, '
+              f'{row["time"]:.1f} ps -> {row["hmr_time"]:.1f} ps')
+    print(f'MD steps of a transformation with {args.windows} windows are {results["inputs"]["step_ratio"]:.2f} times '
+          f'fewer with HMR')
+
+    if args.runs:
+        from database_helper import get_db
+        db = get_db()
+        comparison = results['runs'] = compare_runs(db, *args.runs)
+        db.close()
+        for row in comparison:
+            print(f'{row["complex"]:>15s} {row["energy"]:8.3f} -> {row["hmr_energy"]:8.3f} kcal/mol, '
+                  f'difference {row["difference"]:6.3f} kcal/mol, z-score {row["z_score"]:5.2f}')
+        if comparison:
+            print(f'Mean absolute difference {np.mean([abs(row["difference"]) for row in comparison]):.3f} kcal/mol '
+                  f'over {len(comparison)} legs')
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
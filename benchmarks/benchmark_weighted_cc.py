@@ -0,0 +1,170 @@
+""" Benchmark of the scaling of the cycle closure of Weighted_cc.
+
+Synthetic perturbation networks with known ligand energies are generated (star maps, rings and random connected
+graphs), and the pair energies are the differences of the true energies with a random error. Cycle detection, the
+iterative closure, the path dependent error propagation and the least squares closure are timed for every network,
+and the cycled energies are compared with the true energies.
+
+Usage:
+    python3 benchmarks/benchmark_weighted_cc.py [-t topologies] [-n nodes] [-l max_cycle_length] [-r repeats]
+                                                 [-o output]
+
+Arguments:
+    -t, --topologies: Kinds of networks to benchmark (default is 'star ring random').
+    -n, --nodes: Numbers of ligands of the networks (default is '10 30 100 300 1000').
+    -e, --extra_edges: Edges of the random networks on top of a spanning tree, per ligand (default is '0.5').
+    -l, --max_cycle_length: Longest short cycles closed on top of the cycle basis (default is '6').
+    -r, --repeats: Number of timed repeats, the best one is reported (default is '1').
+    -o, --output: JSON file to write the results to (optional).
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'Weighted_cc'))
+
+from Graphs import Graph
+import CalLig
+
+TOPOLOGIES = ('star', 'ring', 'random')
+
+
+def make_network(topology, nodes, extra_edges=0.5, seed=0):
+    """Generate a synthetic perturbation network with known ligand energies.
+
+    Parameters
+    ----------
+    topology : str
+        'star' (every ligand is connected to the first one), 'ring' (a closed chain of the ligands) or 'random' (a
+        random spanning tree with extra random edges).
+    nodes : int
+        Number of ligands.
+    extra_edges : float
+        Edges of the random network on top of its spanning tree, per ligand.
+    seed : int
+        Seed of the random generator.
+
+    Returns
+    -------
+    tuple of (list, np.ndarray)
+        Rows of the pairs (ligand 1, ligand 2, energy, error, convergence) as the input of Weighted_cc, and the true
+        energies of the ligands.
+
+    """
+    rng = np.random.default_rng(seed)
+    energies = rng.normal(-8, 2, nodes)
+    if topology == 'star':
+        edges = [(0, i) for i in range(1, nodes)]
+    elif topology == 'ring':
+        edges = [(i, (i + 1) % nodes) for i in range(nodes)]
+    elif topology == 'random':
+        edges = [(int(rng.integers(i)), i) for i in range(1, nodes)]
+        known = set(edges)
+        while len(edges) < nodes - 1 + int(extra_edges * nodes):
+            i, j = (int(k) for k in rng.choice(nodes, 2, replace=False))
+            if (i, j) not in known and (j, i) not in known:
+                known.add((i, j))
+                edges.append((i, j))
+    else:
+        raise ValueError(f'Unknown topology {topology}')
+
+    errors = rng.uniform(0.1, 0.6, len(edges))
+    convergences = rng.uniform(0.1, 1.0, len(edges))
+    pairs = [[f'L{i}', f'L{j}', energies[j] - energies[i] + rng.normal(0, error), error, convergence]
+             for (i, j), error, convergence in zip(edges, errors, convergences)]
+    return pairs, energies
+
+
+def timed(function, repeats, setup=tuple):
+    """Return the best wall time of calling function with the arguments made by setup (not timed) and its result."""
+    best = float('inf')
+    for _ in range(repeats):
+        arguments = setup()
+        start = time.perf_counter()
+        result = function(*arguments)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def benchmark_network(pairs, energies, max_cycle_length=6, repeats=1):
+    """Time the stages of the cycle closure of a network and compare the cycled energies with the true ones.
+
+    Parameters
+    ----------
+    pairs : list of list
+        Rows of the pairs, as returned by make_network.
+    energies : np.ndarray
+        True energies of the ligands L0, L1, ...
+    max_cycle_length : int
+        Longest short cycles closed on top of the cycle basis.
+    repeats : int
+        Number of timed repeats.
+
+    Returns
+    -------
+    dict
+        Number of edges and cycles, the seconds of every stage and the root mean square error of the cycled energies
+        of every weight scheme, with the first ligand as the reference at its true energy.
+
+    """
+    def cycles(g):
+        g.getCycles(max_cycle_length)
+        return g
+
+    def closure(g):
+        g.iterateCycleClosure(minimum_cycles=2)
+        return g
+
+    cycle_seconds, g = timed(cycles, repeats, lambda: (Graph(None, pairs),))
+    closure_seconds, g = timed(closure, repeats, lambda: (cycles(Graph(None, pairs)),))
+    ref_node = g.nodeIndex['L0']
+    error_seconds, (path_dependent_error, path) = timed(
+        lambda: CalLig.cal_node_path_dependent_error(ref_node, g.V, CalLig.set_node_map(g)), repeats)
+    mol_ene = np.array(CalLig.calcMolEnes(energies[0], g, path))
+    lsq_seconds, (lsq_ene, lsq_err) = timed(lambda graph: CalLig.solveMolEnes(graph, ref_node, energies[0]), repeats,
+                                            lambda: (Graph(None, pairs),))
+
+    truth = energies[[int(name[1:]) for name in g.V]]
+    return {'edges': len(g.edges), 'cycles': len(g.cycles), 'cycle_seconds': cycle_seconds,
+            'closure_seconds': closure_seconds, 'error_seconds': error_seconds, 'lsq_seconds': lsq_seconds,
+            'closure_rmse': np.sqrt(np.mean((mol_ene - truth) ** 2, axis=1)).tolist(),
+            'lsq_rmse': np.sqrt(np.mean((np.array(lsq_ene) - truth) ** 2, axis=1)).tolist(),
+            'mean_path_error': float(np.mean(path_dependent_error))}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the scaling of the cycle closure of Weighted_cc')
+    parser.add_argument('-t', '--topologies', help='Kinds of networks', nargs='+', choices=TOPOLOGIES,
+                        default=list(TOPOLOGIES))
+    parser.add_argument('-n', '--nodes', help='Numbers of ligands of the networks', nargs='+', type=int,
+                        default=[10, 30, 100, 300, 1000])
+    parser.add_argument('-e', '--extra_edges', help='Extra edges of the random networks per ligand', type=float,
+                        default=0.5)
+    parser.add_argument('-l', '--max_cycle_length', help='Longest short cycles closed on top of the cycle basis',
+                        type=int, default=6)
+    parser.add_argument('-r', '--repeats', help='Number of timed repeats', type=int, default=1)
+    parser.add_argument('-o', '--output', help='JSON file to write the results to', required=False)
+
+    args = parser.parse_args()
+
+    results = []
+    for topology in args.topologies:
+        for nodes in args.nodes:
+            pairs, energies = make_network(topology, nodes, args.extra_edges, seed=nodes)
+            result = {'topology': topology, 'nodes': nodes,
+                      **benchmark_network(pairs, energies, args.max_cycle_length, args.repeats)}
+            results.append(result)
+            print(f'{topology:>6s} {nodes:>5d} ligands, {result["edges"]:>5d} edges, {result["cycles"]:>6d} cycles: '
+                  f'cycles {result["cycle_seconds"]:8.3f} s, closure {result["closure_seconds"]:8.3f} s, '
+                  f'errors {result["error_seconds"]:8.3f} s, lsq {result["lsq_seconds"]:8.3f} s, '
+                  f'RMSE {" ".join(f"{rmse:.3f}" for rmse in result["closure_rmse"])} kcal/mol')
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
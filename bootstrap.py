@@ -0,0 +1,95 @@
+""" Block bootstrap of the free energy from the dV/dλ series of all lambda windows.
+
+The analytical error of TI is computed from the decorrelated samples of every window. The bootstrap estimates the
+error from the whole series instead: every resample draws, in every window, blocks of consecutive dV/dλ values (longer
+than the correlation time) with replacement, and integrates the means of the resampled windows with the quadrature
+weights. All resamples of all windows are drawn as one array operation.
+
+The resamples are kept as deviations from their mean, so that the resamples of several replicas and of the complex
+and water legs can be combined by the averaging of the runs.
+
+Functions
+---------
+block_length(series)
+    Length of the bootstrap blocks of a dV/dλ series.
+
+block_bootstrap(windows, weights, n_resamples, block_lengths, seed)
+    Bootstrap resamples of the free energy integrated over the windows.
+"""
+
+import numpy as np
+from pymbar.timeseries import statistical_inefficiency
+
+# Number of bootstrap resamples of a transformation
+N_RESAMPLES = 2000
+
+# Maximal number of blocks drawn at once, to limit the memory used by long simulations
+MAX_BLOCKS = 1 << 22
+
+
+# Length of the bootstrap blocks in units of the statistical inefficiency of the series. Shorter blocks cut the
+# correlation between neighbouring blocks off and underestimate the error
+BLOCK_FACTOR = 3
+
+
+def block_length(series):
+    """Get the length of the bootstrap blocks of a series from its statistical inefficiency (see pymbar)."""
+    if np.ptp(series) == 0:
+        return BLOCK_FACTOR
+    return int(np.ceil(BLOCK_FACTOR * statistical_inefficiency(series)))
+
+
+def block_bootstrap(windows, weights, n_resamples=N_RESAMPLES, block_lengths=None, seed=None):
+    """
+    Calculate bootstrap resamples of the free energy integrated over the lambda windows.
+
+    Every window is resampled with the moving block bootstrap: as many blocks as are needed to cover the series are
+    drawn at random positions, and the mean of the resampled window is the mean of the values in the blocks.
+
+    Parameters
+    ----------
+    windows : list of np.ndarray
+        dV/dλ series of every window.
+    weights : np.ndarray
+        Quadrature weights of the windows.
+    n_resamples : int
+        Number of resamples.
+    block_lengths : list of int
+        Length of the blocks of every window (optional, see block_length).
+    seed : int
+        Seed of the random generator (optional).
+
+    Returns
+    -------
+    np.ndarray
+        Free energy of every resample in the units of the series.
+    """
+    rng = np.random.default_rng(seed)
+    windows = [np.asarray(series, dtype=float) for series in windows]
+    if block_lengths is None:
+        block_lengths = [block_length(series) for series in windows]
+    counts = np.array([len(series) for series in windows])
+    lengths = np.clip(np.asarray(block_lengths, dtype=int), 1, counts)
+
+    # Sums of all blocks of every window, concatenated, and the number of blocks each window can start at
+    sums = []
+    for series, length in zip(windows, lengths):
+        cumulative = np.concatenate(([0], np.cumsum(series)))
+        sums.append(cumulative[length:] - cumulative[:-length])
+    block_sums = np.concatenate(sums)
+    starts = counts - lengths + 1
+    offsets = np.concatenate(([0], np.cumsum(starts)[:-1]))
+
+    # Blocks drawn in every resample and the window they belong to
+    blocks = -(-counts // lengths)
+    block_window = np.repeat(np.arange(len(windows)), blocks)
+    first_block = np.concatenate(([0], np.cumsum(blocks)[:-1]))
+    scale = np.asarray(weights, dtype=float) / (blocks * lengths)
+
+    resamples = np.empty(n_resamples)
+    chunk = max(MAX_BLOCKS // len(block_window), 1)
+    for begin in range(0, n_resamples, chunk):
+        size = min(chunk, n_resamples - begin)
+        index = offsets[block_window] + (rng.random((size, len(block_window))) * starts[block_window]).astype(int)
+        resamples[begin:begin + size] = np.add.reduceat(block_sums[index], first_block, axis=1) @ scale
+    return resamples
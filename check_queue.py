@@ -2,7 +2,8 @@
 
 This script checks whether there are any molecular dynamics transformations to be sent in the queue. If there are, it
 will send them in the queue to wait for being called by slurm manager. The transformations can be sent to either GPU
-or CPU units, depending on the simulation and specified maximum limits.
+or CPU units, depending on the simulation and specified maximum limits. The analyses of the finished transformations
+are CPU jobs as well, but they have their own limit (max_analyses).
 
 The script is designed to manage the processing of transformations in a molecular dynamics simulation pipeline. It
 connects to a database, identifies available transformations, and schedules them for processing on the available
@@ -17,7 +18,8 @@ import os
 import sys
 
 from database_helper import update_job_status, get_db, update_run_summary, get_protein_pathway
-from settings_helper import get_max_cpus, get_max_gpus, find_between, get_amberti_path
+from parm7 import read_masks, read_parm7, check_transformation
+from settings_helper import get_max_cpus, get_max_gpus, get_max_analyses, get_amberti_path
 from simulation_id_helper import get_complex_name, get_ligand_one, get_mode, get_run_name
 
 lock_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'check_queue.lock')
@@ -41,13 +43,14 @@ def get_transformations(unit_type, max_type):
     Get a list of transformations to send based on unit type and maximum allowed.
 
     Parameters:
-        unit_type (str): The unit type ('gpu' or 'cpu').
+        unit_type (str): The unit type ('gpu', 'cpu' or 'analysis').
         max_type (int): Maximum allowed for the unit type.
 
     Returns:
         list: List of transformation IDs to send.
     """
     is_gpu = 1 if unit_type == 'gpu' else 0
+    is_analysis = unit_type == 'analysis'
 
     # Connect to the database
     db = get_db()
@@ -55,7 +58,8 @@ def get_transformations(unit_type, max_type):
 
     # Get number of transformations sent or running
     cursor.execute(f"SELECT simulation_id FROM simulations WHERE gpu={is_gpu} and (job_status=1 or job_status=2)")
-    transformations_sent_running = cursor.fetchall()
+    transformations_sent_running = [transformation for transformation in cursor.fetchall()
+                                    if (get_mode(transformation[0]) == 'analysis') == is_analysis]
     type_sent_running = len(transformations_sent_running)
 
     # Calculate the number of transformations to send
@@ -67,7 +71,8 @@ def get_transformations(unit_type, max_type):
     cursor.execute(f"SELECT simulation_id FROM simulations WHERE gpu={is_gpu} and job_status=0")
 
     # Get the transformations to send
-    transformations_to_send = cursor.fetchall()[:type_to_send]
+    transformations_to_send = [transformation for transformation in cursor.fetchall()
+                               if (get_mode(transformation[0]) == 'analysis') == is_analysis][:type_to_send]
     transformations_to_send = [transformation[0] for transformation in transformations_to_send]
     return transformations_to_send
 
@@ -98,18 +103,20 @@ def generate_xpus(transformations_to_send):
 
 
 def get_data_from_params(complex_name, simulation_id):
-    with open(f'params_{complex_name}.in', 'r') as f:
-        data = f.read()
-        timask1 = find_between(data, "timask1='", "'")
-        timask2 = find_between(data, "timask2='", "'")
-        scmask1 = find_between(data, "scmask1='", "'")
-        scmask2 = find_between(data, "scmask2='", "'")
+    timask1, timask2, scmask1, scmask2 = read_masks(f'params_{complex_name}.in')
 
     for i in timask1, timask2, scmask1, scmask2:
         if i[0] != ':':
             update_job_status(4, simulation_id)
             sys.exit('ERROR: timask1, timask2, scmask1, scmask2 must start with :')
 
+    # The masks of transformations queued before they were checked by run_several_sims.py
+    if os.path.isfile(f'{complex_name}.parm7'):
+        problems = check_transformation(read_parm7(f'{complex_name}.parm7'), timask1, timask2, scmask1, scmask2)
+        if problems:
+            update_job_status(4, simulation_id)
+            sys.exit(f'ERROR: {complex_name}: ' + '; '.join(problems))
+
     return timask1, timask2, scmask1, scmask2
 
 
@@ -128,6 +135,10 @@ if __name__ == '__main__':
             transformations_to_send = get_transformations('cpu', get_max_cpus())
             generate_xpus(transformations_to_send)
 
+            # Get and generate the analyses
+            transformations_to_send = get_transformations('analysis', get_max_analyses())
+            generate_xpus(transformations_to_send)
+
             update_run_summary()
 
         finally:
@@ -62,6 +62,15 @@ delete_all_data()
 cycle_averaged_data(combined_ids, cycle_id, ref_ligand, ref_value)
     Cycle average free energies and save cycled values.
 
+incremental_cycle_data(combined_ids, cycle_id, ref_ligand, ref_value)
+    Cycle average free energies and keep the closure to update it when pairs are added.
+
+update_cycle_closure(cycle_id)
+    Update an incremental cycle closure with the new or changed pairs.
+
+get_run_context(run_name)
+    Protein folder and modifications of a run, loaded once per run.
+
 transfer_databases(path_from_db, run_names)
     Transfer run data between databases.
 
@@ -73,9 +82,19 @@ import numpy as np
 import sys
 import ast
 
+from incremental_closure import build_state, update_state, state_energies, state_to_bytes, state_from_bytes
+from lambda_schedule import make_schedule, DEFAULT_SCHEDULE
+from mdin import read_modifications
 from settings_helper import get_home_pathway, get_amberti_path
-from simulation_id_helper import get_run_name, get_result_id, get_complex_name, get_ligand_one, \
-    get_run_name_from_result_id
+from simulation_id_helper import get_run_name, get_result_id
+
+# Weighted_cc is a folder of scripts, so its modules are imported from the folder itself (see cycle_averaged_data)
+WEIGHTED_CC_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'Weighted_cc')
+if WEIGHTED_CC_PATH not in sys.path:
+    sys.path.append(WEIGHTED_CC_PATH)
+
+# Contexts of the runs used by this process (see get_run_context)
+RUN_CONTEXTS = {}
 
 
 def get_db():
@@ -166,6 +185,9 @@ def delete_simulation(simulation_id):
     db.execute(f"DELETE FROM lambdas  WHERE result_id='{result_id}'")
     db.execute(f"DELETE FROM free_energies WHERE result_id='{result_id}'")
     db.execute(f"DELETE FROM convergences WHERE result_id='{result_id}'")
+    db.execute(f"DELETE FROM online_analysis WHERE result_id='{result_id}'")
+    db.execute(f"DELETE FROM window_statistics WHERE result_id='{result_id}'")
+    db.execute(f"DELETE FROM bootstrap_samples WHERE result_id='{result_id}'")
     db.execute(f"DELETE FROM run_info WHERE result_id='{result_id}'")
     db.commit()
     db.close()
@@ -187,10 +209,15 @@ def delete_run(run_name):
     db.execute(f"DELETE FROM lambdas  WHERE SUBSTR(result_id, INSTR(result_id, '_') + 1) = '{run_name}'")
     db.execute(f"DELETE FROM free_energies WHERE SUBSTR(result_id, INSTR(result_id, '_') + 1) = '{run_name}'")
     db.execute(f"DELETE FROM convergences WHERE SUBSTR(result_id, INSTR(result_id, '_') + 1) = '{run_name}'")
+    db.execute(f"DELETE FROM online_analysis WHERE SUBSTR(result_id, INSTR(result_id, '_') + 1) = '{run_name}'")
+    db.execute(f"DELETE FROM window_statistics WHERE SUBSTR(result_id, INSTR(result_id, '_') + 1) = '{run_name}'")
+    db.execute(f"DELETE FROM bootstrap_samples WHERE SUBSTR(result_id, INSTR(result_id, '_') + 1) = '{run_name}'")
     db.execute(f"DELETE FROM run_info WHERE run_name='{run_name}'")
     db.execute(f"DELETE FROM run_summary WHERE run_name='{run_name}'")
+    db.execute(f"DELETE FROM lambda_schedules WHERE run_name='{run_name}'")
     db.commit()
     db.close()
+    RUN_CONTEXTS.pop(run_name, None)
 
 
 def delete_all_non_started_runs(run_name):
@@ -348,6 +375,7 @@ def delete_all_errors():
     db.execute(f"DELETE FROM lambdas WHERE result_id=(SELECT result_id FROM run_info WHERE error=1)")
     db.execute(f"DELETE FROM free_energies WHERE result_id=(SELECT result_id FROM run_info WHERE error=1)")
     db.execute(f"DELETE FROM convergences WHERE result_id=(SELECT result_id FROM run_info WHERE error=1)")
+    db.execute(f"DELETE FROM bootstrap_samples WHERE result_id=(SELECT result_id FROM run_info WHERE error=1)")
     db.execute(f"DELETE FROM run_info WHERE error=1")
     db.commit()
     db.close()
@@ -365,20 +393,17 @@ def redo_analysis(result_id):
     os.system(f'python3 {os.path.join(get_amberti_path(), "analyse_data_after_run.py")} -r {simulation_id} --redo')
 
 
-def redo_error_analysis():
-    """Runs all analysis with error again."""
-    db = get_db()
-    cursor = db.cursor()
-    cursor.execute(f"SELECT result_id FROM run_info WHERE error=1")
-    result_ids = [result_id[0] for result_id in cursor.fetchall()]
-    db.commit()
-    db.close()
-    print(f'All error analyses are sent back to the queue:')
-    for result_id in result_ids:
-        os.chdir(os.path.join(get_protein_pathway(get_run_name_from_result_id(result_id)), get_ligand_one(result_id),
-                              get_complex_name(result_id)))
-        print('Redoing result: ' + result_id)
-        redo_analysis(result_id)
+def redo_error_analysis(processes=4):
+    """Runs all analysis with error again.
+
+    The analyses are run in parallel by batch_analysis.py and their results are written to the database at once.
+
+    Parameters
+    ----------
+    processes : int
+        Number of analyses run at once.
+    """
+    os.system(f'python3 {os.path.join(get_amberti_path(), "batch_analysis.py")} -e -j {processes}')
 
 
 def update_run_summary():
@@ -404,7 +429,8 @@ def update_run_summary():
     db.close()
 
 
-def create_run_summary(run_name, protein_name, modification_file=None):
+def create_run_summary(run_name, protein_name, modification_file=None, target_error=None, target_convergence=None,
+                       pilot_fraction=None, hmr=False):
     '''
     Create a new entry in the run_summary table.
 
@@ -416,13 +442,24 @@ def create_run_summary(run_name, protein_name, modification_file=None):
         The protein name for the run.
     modification_file : str
         The modification file for the run.
+    target_error : float
+        Error of the mean dV/dl (kcal/mol) at which a production window is stopped early (optional).
+    target_convergence : float
+        Forward/reverse convergence (R_c) a window also has to reach to be stopped early (optional).
+    pilot_fraction : float
+        Fraction of nstlim run by every window before the rest is distributed by adaptive sampling (optional).
+    hmr : bool
+        Whether the run uses hydrogen mass repartitioning with a 4 fs time step.
     '''
     db = get_db()
     db.execute(
-        f"INSERT INTO run_summary (run_name, protein_name, simulation_count, finished_count, error_count, modification_file) "
-        f"VALUES ('{run_name}', '{protein_name}', 0, 0, 0, '{modification_file}')")
+        "INSERT INTO run_summary (run_name, protein_name, simulation_count, finished_count, error_count, "
+        "modification_file, target_error, target_convergence, pilot_fraction, hmr) "
+        "VALUES (?, ?, 0, 0, 0, ?, ?, ?, ?, ?)",
+        (run_name, protein_name, str(modification_file), target_error, target_convergence, pilot_fraction, hmr))
     db.commit()
     db.close()
+    RUN_CONTEXTS.pop(run_name, None)
 
 
 def get_protein_name(run_name):
@@ -462,7 +499,7 @@ def get_protein_pathway(run_name):
         The pathway to the protein folder.
 
     '''
-    return os.path.join(get_home_pathway(), get_protein_name(run_name))
+    return get_run_context(run_name)['protein_pathway']
 
 
 def get_modification_file(run_name):
@@ -491,79 +528,183 @@ def get_modification_file(run_name):
     return modification_file
 
 
-def modify_run_input(run_name, run_input, run, run_section=None):
+def load_run_context(run_name):
     '''
-    Modify the run input based on the modification file.
+    Load the protein folder and the modifications of a run.
 
     Parameters
     ----------
     run_name : str
-        The run name to get the modification file for.
-    run_input : str
-        The run input to modify.
-    run : str
-        The run to modify.
-    run_section : str
-        The run section to modify.
+        The run name to load the context for.
 
     Returns
     -------
-    str
-        The modified run input.
+    dict
+        The protein name, the pathway to the protein folder, whether the run uses hydrogen mass repartitioning, the
+        pathway to the modification file (None without one), its modification time and the modifications of the stages
+        (see mdin.read_modifications).
     '''
-    # Get the modification file and checks if there is any modification for the given run
-    mod_file = get_modification_file(run_name)
-    if mod_file is not None:
-        mod_file = os.path.join(get_home_pathway(), mod_file)
-        with open(mod_file, 'r') as infile:
-            # Deleting spaces
-            lines = [i.strip().replace(" ", "").strip() for i in infile.readlines()]
-
-        # If no modification for the given run, return the original run input
-        if run not in lines:
-            return run_input
-        # Getting the header for the modifications
-        if run in ['ti1p1', 'ti1p2']:
-            if run_section in lines:
-                header = run_section
-            else:
-                return run_input
-        else:
-            header = run
-
-        # Getting the section to modify
-        header_index = lines.index(header)
-        end_index = lines[header_index:].index('&end') + header_index
-        current_section = lines[header_index+1:end_index]
-
-        # Modifying the run input to delete spaces around the '=' sign
-        run_input_lines = run_input.split('\n')
-        run_input_lines = [f'{i.split("=")[0].rstrip()}={i.split("=",1)[1].strip()}' if "=" in i else i for i in
-                           run_input_lines]
-        end_run_input_lines = [idx for idx, s in enumerate(run_input_lines) if '&end' in s][0]
-        first_text_line_before_end = [idx for idx, s in enumerate(run_input_lines[:end_run_input_lines]) if '=' in s][
-            -1]
-
-        # Get the correct number of leading spaces
-        leading_spaces = len(run_input_lines[first_text_line_before_end]) - len(
-            run_input_lines[first_text_line_before_end].lstrip())
-
-        # Modifying the run input
-        for line in current_section:
-            item = line.split('=')[0]
-            value = line.split('=', 1)[1]
-            if f'{item}=' in '\t'.join(run_input_lines):
-                if 'DELETE' in value:
-                    index = [idx for idx, s in enumerate(run_input_lines) if f'{item}=' in s][0]
-                    run_input_lines.pop(index)
-                else:
-                    index = [idx for idx, s in enumerate(run_input_lines) if f'{item}=' in s][0]
-                    run_input_lines[index] = f'{run_input_lines[index].split("=")[0]}={value},'
-            else:
-                run_input_lines.insert(end_run_input_lines, f'{leading_spaces * " "}{item}={value},')
-        run_input = '\n'.join(run_input_lines)
-
-    return run_input
+    db = get_db()
+    protein_name, modification_file, hmr = db.execute(
+        "SELECT protein_name, modification_file, hmr FROM run_summary WHERE run_name=?", (run_name,)).fetchone()
+    db.close()
+
+    home_pathway = get_home_pathway()
+    context = {'run_name': run_name, 'protein_name': protein_name,
+               'protein_pathway': os.path.join(home_pathway, protein_name), 'hmr': bool(hmr),
+               'modification_file': None, 'modification_time': None, 'modifications': {}}
+    if modification_file != 'None':
+        context['modification_file'] = os.path.join(home_pathway, modification_file)
+        context['modification_time'] = os.path.getmtime(context['modification_file'])
+        context['modifications'] = read_modifications(context['modification_file'])
+    return context
+
+
+def get_run_context(run_name):
+    '''
+    Get the protein folder and the modifications of a run.
+
+    The context is loaded once per run and kept for the rest of the process, the modifications are read again when the
+    modification file was changed since (by its modification time).
+
+    Parameters
+    ----------
+    run_name : str
+        The run name to get the context for.
+
+    Returns
+    -------
+    dict
+        The context of the run (see load_run_context).
+    '''
+    context = RUN_CONTEXTS.get(run_name)
+    if context is None:
+        context = RUN_CONTEXTS[run_name] = load_run_context(run_name)
+    elif context['modification_file'] is not None:
+        modification_time = os.path.getmtime(context['modification_file'])
+        if modification_time != context['modification_time']:
+            context['modification_time'] = modification_time
+            context['modifications'] = read_modifications(context['modification_file'])
+    return context
+
+
+def get_early_stopping_targets(run_name):
+    '''
+    Get the targets for early stopping of the production windows of a run.
+
+    Parameters
+    ----------
+    run_name : str
+        The run name to get the targets for.
+
+    Returns
+    -------
+    tuple of (float, float)
+        Target error and target convergence. Target error is None if early stopping is not enabled for the run,
+        target convergence is None if only the error is checked.
+    '''
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute("SELECT target_error, target_convergence FROM run_summary WHERE run_name=?", (run_name,))
+    targets = cursor.fetchone()
+    db.close()
+    return targets
+
+
+def get_pilot_fraction(run_name):
+    '''
+    Get the fraction of nstlim run by every window in the pilot pass of adaptive sampling.
+
+    Parameters
+    ----------
+    run_name : str
+        The run name to get the pilot fraction for.
+
+    Returns
+    -------
+    float
+        The pilot fraction, None if adaptive sampling is not enabled for the run.
+    '''
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute("SELECT pilot_fraction FROM run_summary WHERE run_name=?", (run_name,))
+    pilot_fraction = cursor.fetchone()
+    db.close()
+    return pilot_fraction[0] if pilot_fraction is not None else None
+
+
+def save_lambda_schedule(run_name, kind, lambdas, weights):
+    '''
+    Save the lambda schedule of a run.
+
+    Parameters
+    ----------
+    run_name : str
+        The run name to save the schedule for.
+    kind : str
+        Kind of the schedule ('gaussian', 'uniform' or 'adaptive' for the schedules planned by lambda_planner.py).
+    lambdas : list of float
+        Lambda values of the windows.
+    weights : list of float
+        Quadrature weights of the windows.
+    '''
+    db = get_db()
+    db.execute("UPDATE run_summary SET lambda_schedule=? WHERE run_name=?", (kind, run_name))
+    db.execute("DELETE FROM lambda_schedules WHERE run_name=?", (run_name,))
+    db.executemany("INSERT INTO lambda_schedules (run_name, lambda, clambda, weight) VALUES (?, ?, ?, ?)",
+                   [(run_name, i, float(clambda), float(weight)) for i, (clambda, weight) in
+                    enumerate(zip(lambdas, weights))])
+    db.commit()
+    db.close()
+
+
+def get_lambda_schedule(run_name):
+    '''
+    Get the lambda schedule of a run.
+
+    Runs without a saved schedule use the 12-point Gauss-Legendre lambda values, which were used before the schedule
+    was saved per run, and are integrated with the trapezoidal rule of alchemlyb.
+
+    Parameters
+    ----------
+    run_name : str
+        The run name to get the schedule for.
+
+    Returns
+    -------
+    tuple of (str, list, list)
+        Kind of the schedule (None if no schedule is saved for the run), lambda values and quadrature weights of the
+        windows.
+    '''
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute("SELECT clambda, weight FROM lambda_schedules WHERE run_name=? ORDER BY lambda", (run_name,))
+    rows = cursor.fetchall()
+    cursor.execute("SELECT lambda_schedule FROM run_summary WHERE run_name=?", (run_name,))
+    kind = cursor.fetchone()
+    db.close()
+
+    if len(rows) == 0:
+        lambdas, weights = make_schedule(*DEFAULT_SCHEDULE)
+        return None, lambdas.tolist(), weights.tolist()
+    return kind[0] if kind is not None else None, [row[0] for row in rows], [row[1] for row in rows]
+
+
+def get_run_modifications(run_name):
+    '''
+    Get the modifications of the stages of a run from its modification file.
+
+    Parameters
+    ----------
+    run_name : str
+        The run name to get the modifications for.
+
+    Returns
+    -------
+    dict
+        The modified parameters of every stage (see mdin.read_modifications), empty without a modification file.
+    '''
+    return get_run_context(run_name)['modifications']
 
 
 def run_name_exists(run_name):
@@ -610,11 +751,48 @@ def get_energy_data(result_ids, db):
         ','.join('?' * len(result_ids))), db, params=result_ids)
 
 
+def get_bootstrap_deviations(result_ids, db):
+    """Get the mean of the bootstrap resamples of several replicas.
+
+    The resamples of independent replicas are averaged index by index, which gives resamples of the mean of the
+    replicas.
+
+    Parameters
+    ----------
+    result_ids : list of str
+        List of result IDs of the replicas.
+    db : sqlite3.Connection
+        Database connection object.
+
+    Returns
+    -------
+    np.ndarray or None
+        Deviations of the resamples of the mean from their mean, None if a replica has no bootstrap resamples.
+
+    """
+    rows = db.execute('''SELECT deviations FROM bootstrap_samples WHERE result_id IN ({})'''.format(
+        ','.join('?' * len(result_ids))), result_ids).fetchall()
+    if len(rows) < len(result_ids):
+        return None
+    deviations = [np.frombuffer(row[0], dtype=np.float64) for row in rows]
+    size = min(len(deviation) for deviation in deviations)
+    return np.mean([deviation[:size] for deviation in deviations], axis=0)
+
+
+def combine_bootstrap(first, second):
+    """Get the resamples of the difference of two independent bootstrapped free energies (None if one is missing)."""
+    if first is None or second is None:
+        return None
+    size = min(len(first), len(second))
+    return first[:size] - second[:size]
+
+
 def make_averaged_energies(run_names, average_id):
     """Average free energies over runs and save to the database.
 
     Calculates forward and reverse averages for runs.
     Saves averaged values associated with an ID.
+    The bootstrap error of the average is calculated from the combined bootstrap resamples of all simulations.
 
     Parameters
     ----------
@@ -652,6 +830,7 @@ def make_averaged_energies(run_names, average_id):
         free_energy = [None] * 4
         error = [None] * 4
         convergence = [None] * 4
+        bootstrap = [None] * 4
 
         # Query free energies for the combination:
         # ligand_1, ligand_2, is_wat
@@ -682,6 +861,7 @@ def make_averaged_energies(run_names, average_id):
                 free_energy[i] = free_energy_data['total_free_energy'].mean()
                 error[i] = free_energy_data['total_error'].mean()
                 convergence[i] = free_energy_data['total_convergence'].mean()
+                bootstrap[i] = get_bootstrap_deviations(result_ids, db)
 
         # Calculate how many forward/reverse simulations have not been calculated
         forward_none_count = free_energy[:2].count(None)
@@ -689,7 +869,7 @@ def make_averaged_energies(run_names, average_id):
 
         # If none ligand_1 to ligand_2 simulations have been calculated
         if forward_none_count == 2:
-            forward_energy = forward_error = forward_convergence = None
+            forward_energy = forward_error = forward_convergence = forward_bootstrap = None
 
         # If only one ligand_1 to ligand_2 simulation has been calculated
         elif forward_none_count == 1:
@@ -703,9 +883,10 @@ def make_averaged_energies(run_names, average_id):
             forward_energy = free_energy[0] - free_energy[1]
             forward_error = np.sqrt(error[0] ** 2 + error[1] ** 2)
             forward_convergence = (convergence[0] + convergence[1]) / 2
+            forward_bootstrap = combine_bootstrap(bootstrap[0], bootstrap[1])
 
         if reverse_none_count == 2:
-            reverse_energy = reverse_error = reverse_convergence = None
+            reverse_energy = reverse_error = reverse_convergence = reverse_bootstrap = None
         elif reverse_none_count == 1:
             # Raise exception
             raise Exception('Reverse free energy calculation failed at ' + ligand_1 + '-' + ligand_2)
@@ -713,36 +894,48 @@ def make_averaged_energies(run_names, average_id):
             reverse_energy = free_energy[2] - free_energy[3]
             reverse_error = np.sqrt(error[2] ** 2 + error[3] ** 2)
             reverse_convergence = (convergence[2] + convergence[3]) / 2
+            reverse_bootstrap = combine_bootstrap(bootstrap[2], bootstrap[3])
 
         # Calculate final averaged values
         if forward_energy is not None and reverse_energy is not None:
             averaged_energy = (forward_energy - reverse_energy) / 2
             averaged_error = np.sqrt(forward_error ** 2 + reverse_error ** 2) / 2
             averaged_convergence = (forward_convergence + reverse_convergence) / 2
+            averaged_bootstrap = combine_bootstrap(forward_bootstrap, reverse_bootstrap)
+            averaged_bootstrap = averaged_bootstrap / 2 if averaged_bootstrap is not None else None
 
         # If only reverse, use reverse and negate
         elif forward_energy is None and reverse_energy is not None:
             averaged_energy = -reverse_energy
             averaged_error = reverse_error
             averaged_convergence = reverse_convergence
+            averaged_bootstrap = reverse_bootstrap
 
         # If only forward, use forward as average
         elif forward_energy is not None and reverse_energy is None:
             averaged_energy = forward_energy
             averaged_error = forward_error
             averaged_convergence = forward_convergence
+            averaged_bootstrap = forward_bootstrap
 
         # If neither forward nor reverse, raise exception
         else:
             raise Exception('Both forward and reverse free energy calculations failed')
 
-        # Insert averaged values into database
-        db.execute('''INSERT INTO averaged_free_energies (comb_result_id, ligand_1, ligand_2, total_free_energy_averaged, total_error_averaged, total_convergence_averaged)
-                        VALUES (?, ?, ?, ?, ?, ?)''', (
+        # Insert averaged values into database, replacing the previous average of the pair
+        db.execute('DELETE FROM averaged_free_energies WHERE comb_result_id=?',
+                   (ligand_1 + '-' + ligand_2 + '_' + average_id,))
+        db.execute('''INSERT INTO averaged_free_energies (comb_result_id, ligand_1, ligand_2, total_free_energy_averaged, total_error_averaged, total_convergence_averaged, bootstrap_error_averaged)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)''', (
             ligand_1 + '-' + ligand_2 + '_' + average_id, ligand_1, ligand_2, averaged_energy, averaged_error,
-            averaged_convergence))
+            averaged_convergence, float(np.std(averaged_bootstrap)) if averaged_bootstrap is not None else None))
         db.commit()
 
+    # Update the incremental cycle closures that use this average
+    for cycle_id, averaging_ids in db.execute('SELECT cycle_id, averaging_ids FROM cycle_closure_states').fetchall():
+        if average_id in ast.literal_eval(averaging_ids):
+            update_cycle_closure(cycle_id)
+
 
 def delete_all_data():
     """Delete all data from all database tables."""
@@ -755,19 +948,148 @@ def delete_all_data():
         "run_info",
         "averaged_free_energies",
         "cycle_closure",
-        "run_summary"
+        "run_summary",
+        "online_analysis",
+        "lambda_schedules",
+        "window_statistics",
+        "bootstrap_samples",
+        "cycle_closure_intervals",
+        "cycle_closure_states"
     ]
     for table in tables:
         db.execute(f"DELETE FROM {table}")
     db.commit()
     db.close()
+    RUN_CONTEXTS.clear()
 
 
-def cycle_averaged_data(averaging_ids, cycle_id, reference_ligand, reference_value):
+def cycle_averaged_data(averaging_ids, cycle_id, reference_ligand, reference_value, samples=0):
     """Cycle average free energies and save cycled values.
 
-        Uses an external Weighted_cc script to perform cycle closure on averages.
-        Saves the cycled values back to the database.
+        Performs the cycle closure of the averages with Weighted_cc in the same process and saves the cycled values
+        to the database and to the cycled_{cycle_id}.csv file in the home folder. Several cycle closures can be done
+        in one call, with a list of cycle_ids and a list of averaging ids for each of them.
+
+        Parameters
+        ----------
+        averaging_ids : list of str or list of list of str
+            List of combined result IDs to cycle, or one such list for every cycle_id.
+        cycle_id : str or list of str
+            ID (or IDs) to associate cycled values with.
+        reference_ligand : str
+            Ligand to use as reference for cycling.
+        reference_value : float
+            Binding energy of reference ligand to shift energies to.
+        samples : int
+            Number of Monte-Carlo samples of the pair energies drawn from their errors. If it is not 0, the mean,
+            standard deviation and 95 % confidence interval of every ligand are saved to the cycle_closure_intervals
+            table (optional).
+
+        """
+    from wcc_main import cycleClosure, cycleClosureSamples
+    from CalLig import outputMol
+
+    if isinstance(averaging_ids, str):
+        if '[' in averaging_ids:
+            # make list from string
+            averaging_ids = ast.literal_eval(averaging_ids)
+        else:
+            averaging_ids = [averaging_ids]
+    if isinstance(cycle_id, str):
+        cycle_ids = ast.literal_eval(cycle_id) if '[' in cycle_id else [cycle_id]
+    else:
+        cycle_ids = list(cycle_id)
+    # The same averages are used for all cycle ids, unless a list is given for every one of them
+    if len(averaging_ids) == 0 or not isinstance(averaging_ids[0], (list, tuple)):
+        averaging_ids = [averaging_ids] * len(cycle_ids)
+    if len(averaging_ids) != len(cycle_ids):
+        raise ValueError(f'{len(cycle_ids)} cycle ids were given with {len(averaging_ids)} lists of averaging ids')
+
+    db = get_db()
+    rows = []
+    interval_rows = []
+    for cycle_id, cycle_averaging_ids in zip(cycle_ids, averaging_ids):
+        all_data_to_cycle = pd.read_sql_query('''SELECT ligand_1, ligand_2, total_free_energy_averaged, total_error_averaged, total_convergence_averaged
+                              FROM averaged_free_energies
+                              WHERE SUBSTR(comb_result_id, INSTR(comb_result_id, '_') + 1) IN ({})'''.format(
+            ','.join('?' * len(cycle_averaging_ids))), db, params=list(cycle_averaging_ids))
+
+        ligands, cycled_energies, uncertainties = cycleClosure(all_data_to_cycle, reference_ligand,
+                                                               float(reference_value))
+        outputMol(ligands, cycled_energies, os.path.join(get_home_pathway(), f'cycled_{cycle_id}.csv'))
+        print(f'Cycle closure {cycle_id}:')
+        print(pd.DataFrame(np.transpose(cycled_energies), index=ligands,
+                           columns=['Cycled_no_error', 'Cycled_with_error1', 'Cycled_with_error2']).to_string())
+        rows += [(cycle_id, ligand, cycled_energies[0][i], cycled_energies[1][i], cycled_energies[2][i])
+                 for i, ligand in enumerate(ligands)]
+
+        if int(samples) > 0:
+            ligands, energy_samples = cycleClosureSamples(all_data_to_cycle, reference_ligand, float(reference_value),
+                                                          int(samples))
+            mean = energy_samples.mean(axis=1)
+            std = energy_samples.std(axis=1, ddof=1)
+            lower, upper = np.percentile(energy_samples, [2.5, 97.5], axis=1)
+            for k, weighting in enumerate(['no_error', 'error', 'convergence_error']):
+                interval_rows += [(cycle_id, ligand, weighting, float(mean[k, i]), float(std[k, i]),
+                                   float(lower[k, i]), float(upper[k, i])) for i, ligand in enumerate(ligands)]
+
+    # Save the cycled data of all cycle ids to the database
+    db.executemany('''INSERT INTO cycle_closure (cycle_id, ligand, no_error, error, convergence_error)
+                      VALUES (?, ?, ?, ?, ?)''', rows)
+    db.executemany('''INSERT OR REPLACE INTO cycle_closure_intervals (cycle_id, ligand, weighting, mean, std, lower,
+                      upper) VALUES (?, ?, ?, ?, ?, ?, ?)''', interval_rows)
+    db.commit()
+    db.close()
+
+
+def get_cycle_pairs(db, averaging_ids):
+    """Get the averaged pairs of the averaging ids.
+
+        If a pair was averaged in both directions, the first one is used, as by Weighted_cc.
+
+        Parameters
+        ----------
+        db : sqlite3.Connection
+            Database connection.
+        averaging_ids : list of str
+            Averaging IDs of the pairs.
+
+        Returns
+        -------
+        dict
+            Energy, error and convergence of every pair (ligand_1, ligand_2).
+
+        """
+    rows = db.execute('''SELECT ligand_1, ligand_2, total_free_energy_averaged, total_error_averaged, total_convergence_averaged
+                         FROM averaged_free_energies
+                         WHERE SUBSTR(comb_result_id, INSTR(comb_result_id, '_') + 1) IN ({})
+                         ORDER BY rowid'''.format(','.join('?' * len(averaging_ids))), list(averaging_ids)).fetchall()
+    pairs = {}
+    for ligand_1, ligand_2, energy, error, convergence in rows:
+        if ligand_1 != ligand_2 and (ligand_2, ligand_1) not in pairs:
+            pairs[(ligand_1, ligand_2)] = (energy, error, convergence)
+    return pairs
+
+
+def save_cycle_closure(db, cycle_id, averaging_ids, reference_value, state):
+    """Save the state of an incremental cycle closure and replace the cycled values of the cycle_id."""
+    energies = state_energies(state, reference_value)
+    db.execute('DELETE FROM cycle_closure WHERE cycle_id=?', (cycle_id,))
+    db.executemany('''INSERT INTO cycle_closure (cycle_id, ligand, no_error, error, convergence_error)
+                      VALUES (?, ?, ?, ?, ?)''', [(cycle_id, ligand, *map(float, energies[:, i]))
+                                                  for i, ligand in enumerate(state['ligands'])])
+    db.execute('''INSERT OR REPLACE INTO cycle_closure_states (cycle_id, averaging_ids, reference_value, state)
+                  VALUES (?, ?, ?, ?)''', (cycle_id, str(list(averaging_ids)), reference_value, state_to_bytes(state)))
+    db.commit()
+
+
+def incremental_cycle_data(averaging_ids, cycle_id, reference_ligand, reference_value):
+    """Cycle average free energies and keep the factorised closure to update it when pairs are added.
+
+        The cycle closure is the weighted least squares fit of Weighted_cc (lsq method), which gives the values of the
+        converged iterative closure. Its state is saved to the cycle_closure_states table, and the cycled values of the
+        cycle_id are updated by update_cycle_closure when the averages change, without solving the whole network again.
+        make_averaged_energies does this automatically for every cycle_id that uses its average_id.
 
         Parameters
         ----------
@@ -789,30 +1111,31 @@ def cycle_averaged_data(averaging_ids, cycle_id, reference_ligand, reference_val
             averaging_ids = [averaging_ids]
 
     db = get_db()
-    all_data_to_cycle = pd.read_sql_query('''SELECT ligand_1, ligand_2, total_free_energy_averaged, total_error_averaged, total_convergence_averaged
-                          FROM averaged_free_energies
-                          WHERE SUBSTR(comb_result_id, INSTR(comb_result_id, '_') + 1) IN ({})'''.format(
-        ','.join('?' * len(averaging_ids))), db, params=averaging_ids)
-
-    # Make the DataFrame into csv file
-    all_data_to_cycle.to_csv(os.path.join(get_home_pathway(), f'to_cycle_{cycle_id}.csv'), index=False,
-                             sep=' ', header=False)
-    os.system(
-        f'python3 {os.path.join(os.path.dirname(os.path.realpath(__file__)), "Weighted_cc", "wcc_main.py")} -f {os.path.join(get_home_pathway(), f"to_cycle_{cycle_id}.csv")} -r {reference_ligand} -e {reference_value} -o {os.path.join(get_home_pathway(), f"cycled_{cycle_id}.csv")}')
-
-    # Read the cycled data back into a DataFrame
-    cycled_data = pd.read_csv(os.path.join(get_home_pathway(), f'cycled_{cycle_id}.csv'))
-
-    # Remove the csv files
-    os.remove(os.path.join(get_home_pathway(), f'to_cycle_{cycle_id}.csv'))
-
-    # Save the cycled data to the database
-    for i, row in cycled_data.iterrows():
-        db.execute('''INSERT INTO cycle_closure (cycle_id, ligand, no_error, error, convergence_error)
-                        VALUES (?, ?, ?, ?, ?)''', (
-            cycle_id, row['Ligand'], row['Cycled_no_error'], row['Cycled_with_error1'], row['Cycled_with_error2']))
-    db.commit()
+    state = build_state(reference_ligand, get_cycle_pairs(db, averaging_ids))
+    save_cycle_closure(db, cycle_id, averaging_ids, float(reference_value), state)
+    db.close()
+    print(f'Cycle closure {cycle_id}: {len(state["ligands"])} ligands, {len(state["keys"])} pairs')
+
+
+def update_cycle_closure(cycle_id):
+    """Update an incremental cycle closure with the pairs that were added or changed since the last update.
+
+        Parameters
+        ----------
+        cycle_id : str
+            ID of a cycle closure made by incremental_cycle_data.
+
+        """
+    db = get_db()
+    averaging_ids, reference_value, data = db.execute('''SELECT averaging_ids, reference_value, state
+                                                          FROM cycle_closure_states WHERE cycle_id=?''',
+                                                       (cycle_id,)).fetchone()
+    averaging_ids = ast.literal_eval(averaging_ids)
+    state, updates = update_state(state_from_bytes(data), get_cycle_pairs(db, averaging_ids))
+    if updates > 0:
+        save_cycle_closure(db, cycle_id, averaging_ids, reference_value, state)
     db.close()
+    print(f'Cycle closure {cycle_id}: {updates} pairs updated')
 
 
 def transfer_database(path_from_database, run_names):
@@ -870,19 +1193,24 @@ def transfer_database(path_from_database, run_names):
         # Get result_ids for the synchronized run_names
         result_ids = [row[0] for row in data_to_sync]
 
-        # Synchronize data from lambdas, convergences, and free_energies tables where result_id is in result_ids
-        tables_to_sync = ['lambdas', 'convergences', 'free_energies']
+        # Synchronize data from lambdas, convergences, free_energies and bootstrap_samples tables where result_id is
+        # in result_ids. Tables that an older source database does not have are skipped
+        tables_to_sync = ['lambdas', 'convergences', 'free_energies', 'bootstrap_samples']
+        source_tables = [row[0] for row in cursor_source.execute("SELECT name FROM sqlite_master WHERE type='table'")]
         for table_name in tables_to_sync:
+            if table_name not in source_tables:
+                continue
             cursor_source.execute(
                 f'SELECT * FROM {table_name} WHERE result_id IN ({{seq}})'.format(
                     seq=','.join(['?'] * len(result_ids))),
                 result_ids)
             data_to_sync = cursor_source.fetchall()
+            columns = ','.join(column[0] for column in cursor_source.description)
 
-            # Insert data into the destination database
+            # Insert data into the destination database, by column name, since older databases have fewer columns
             for row in data_to_sync:
                 placeholders = ','.join(['?'] * len(row))
-                query = f'INSERT INTO {table_name} VALUES ({placeholders})'
+                query = f'INSERT INTO {table_name} ({columns}) VALUES ({placeholders})'
                 cursor_destination.execute(query, row)
 
         # Commit the changes in the destination database
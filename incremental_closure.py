@@ -0,0 +1,232 @@
+""" Incremental cycle closure of a growing perturbation network.
+
+The cycle closure is the weighted least squares fit of the ligand energies to the averaged pair energies, as done by
+Weighted_cc with the lsq method, for the three weightings of the cycle_closure table (no error, error and convergence).
+Instead of solving the whole network again whenever a transformation finishes, the state of a closure keeps the
+inverse of the normal matrix (the covariance of the ligands) and the right-hand side of every weighting, and a new or
+changed pair updates them:
+
+- a pair between two ligands of the network changes the normal matrix by a rank-one term, and the covariance is
+  updated with the Sherman-Morrison formula,
+- a pair that brings a new ligand adds a row and a column to the covariance, which are those of the ligand it is
+  connected to,
+- a pair whose energy changed, but not its weight, only changes the right-hand side.
+
+Pairs that are removed, or connect ligands that are not in the network yet on both sides, make the state be built
+again (or wait until they are connected).
+
+Functions
+---------
+build_state(reference, pairs)
+    Factorised state of the closure of a network.
+
+update_state(state, pairs)
+    Update the state with the pairs that were added or changed.
+
+state_energies(state, reference_value)
+    Energies of the ligands of every weighting.
+
+state_to_bytes(state), state_from_bytes(data)
+    Serialise the state for the database.
+"""
+
+import io
+
+import numpy as np
+
+# Weightings of the cycle_closure table, the weight of a pair is 1, 1 / error^2 and 1 / convergence^2
+WEIGHTINGS = ('no_error', 'error', 'convergence_error')
+
+
+def pair_weights(errors, convergences):
+    """Get the weights of pairs with every weighting (array of shape weightings x pairs)."""
+    errors = np.asarray(errors, dtype=float)
+    return np.array([np.ones(len(errors)), 1 / errors ** 2, 1 / np.asarray(convergences, dtype=float) ** 2])
+
+
+def build_state(reference, pairs):
+    """
+    Build the factorised state of the closure of a network.
+
+    Only the pairs connected to the reference ligand are used.
+
+    Parameters
+    ----------
+    reference : str
+        Reference ligand, whose energy is fixed.
+    pairs : dict
+        Energy, error and convergence of every pair (ligand_1, ligand_2), the energy is the one from ligand_1 to
+        ligand_2.
+
+    Returns
+    -------
+    dict
+        State of the closure: ligands, reference, pairs and their values, covariance and right-hand side of every
+        weighting.
+
+    Raises
+    ------
+    ValueError
+        If the reference is not in the network.
+    """
+    pairs = connected_pairs(reference, pairs)
+    if len(pairs) == 0:
+        raise ValueError(f'The reference {reference} is not in the network')
+    ligands = ligands_of(pairs)
+    index = {ligand: i for i, ligand in enumerate(ligands)}
+    keys = list(pairs)
+    edges = np.array([(index[ligand_1], index[ligand_2]) for ligand_1, ligand_2 in keys], dtype=int)
+    values = np.array([pairs[key] for key in keys], dtype=float)
+    weights = pair_weights(values[:, 1], values[:, 2])
+
+    n = len(ligands)
+    incidence = np.zeros((len(edges), n))
+    incidence[np.arange(len(edges)), edges[:, 0]] = -1
+    incidence[np.arange(len(edges)), edges[:, 1]] = 1
+    # The row and column of the reference stay zero, so that its energy is not changed by the fit
+    free = np.delete(np.arange(n), index[reference])
+    covariance = np.zeros((len(WEIGHTINGS), n, n))
+    rhs = np.zeros((len(WEIGHTINGS), n))
+    for k, w in enumerate(weights):
+        normal = incidence.T @ (w[:, None] * incidence)
+        inverse_factor = np.linalg.inv(np.linalg.cholesky(normal[np.ix_(free, free)]))
+        covariance[k][np.ix_(free, free)] = inverse_factor.T @ inverse_factor
+        rhs[k] = incidence.T @ (w * values[:, 0])
+    return {'ligands': ligands, 'reference': reference, 'keys': keys, 'values': values, 'covariance': covariance,
+            'rhs': rhs}
+
+
+def add_ligand(state, ligand, neighbour, pair, values):
+    """
+    Add a ligand connected to the network by one pair.
+
+    The new row and column of the covariance are those of the neighbour, and the variance of the new ligand is the
+    variance of the neighbour plus the one of the pair.
+    """
+    i = state['ligands'].index(neighbour)
+    weights = pair_weights([values[1]], [values[2]])[:, 0]
+    covariance = state['covariance']
+    n = len(state['ligands'])
+    expanded = np.zeros((len(WEIGHTINGS), n + 1, n + 1))
+    expanded[:, :n, :n] = covariance
+    expanded[:, n, :n] = expanded[:, :n, n] = covariance[:, i]
+    expanded[:, n, n] = covariance[:, i, i] + 1 / weights
+    state['covariance'] = expanded
+    state['rhs'] = np.concatenate((state['rhs'], np.zeros((len(WEIGHTINGS), 1))), axis=1)
+    state['ligands'].append(ligand)
+
+    a = np.zeros(n + 1)
+    a[state['ligands'].index(pair[0])], a[state['ligands'].index(pair[1])] = -1, 1
+    state['rhs'] += np.outer(weights * values[0], a)
+    state['keys'].append(pair)
+    state['values'] = np.vstack((state['values'], values))
+
+
+def set_pair(state, pair, values):
+    """Add a pair between two ligands of the network, or change the values of a pair, with rank-one updates."""
+    a = np.zeros(len(state['ligands']))
+    a[state['ligands'].index(pair[0])], a[state['ligands'].index(pair[1])] = -1, 1
+    new_weights = pair_weights([values[1]], [values[2]])[:, 0]
+    if pair in state['keys']:
+        p = state['keys'].index(pair)
+        old_values = state['values'][p].copy()
+        old_weights = pair_weights([old_values[1]], [old_values[2]])[:, 0]
+        state['values'][p] = values
+    else:
+        old_values, old_weights = np.zeros(3), np.zeros(len(WEIGHTINGS))
+        state['keys'].append(pair)
+        state['values'] = np.vstack((state['values'], values))
+
+    for k in range(len(WEIGHTINGS)):
+        state['rhs'][k] += a * (new_weights[k] * values[0] - old_weights[k] * old_values[0])
+        change = new_weights[k] - old_weights[k]
+        if change != 0:
+            # Sherman-Morrison: (N + c a a^T)^-1 = C - c (C a)(C a)^T / (1 + c a^T C a)
+            ca = state['covariance'][k] @ a
+            state['covariance'][k] -= change * np.outer(ca, ca) / (1 + change * (a @ ca))
+
+
+def update_state(state, pairs):
+    """
+    Update the state of a closure with the current pairs of the network.
+
+    Parameters
+    ----------
+    state : dict
+        State of the closure (see build_state), changed in place.
+    pairs : dict
+        Energy, error and convergence of every pair (ligand_1, ligand_2).
+
+    Returns
+    -------
+    tuple of (dict, int)
+        Updated state (a new one if it had to be built again) and the number of pairs that were added or changed.
+    """
+    if any(key not in pairs for key in state['keys']):
+        state = build_state(state['reference'], pairs)
+        return state, len(state['keys'])
+
+    updates = 0
+    position = {key: p for p, key in enumerate(state['keys'])}
+    pending = {key: tuple(values) for key, values in pairs.items()
+               if key not in position or state['values'][position[key]].tolist() != list(values)}
+    while pending:
+        progress = False
+        for pair, values in list(pending.items()):
+            known = [ligand in state['ligands'] for ligand in pair]
+            if all(known):
+                set_pair(state, pair, values)
+            elif known[0] or known[1]:
+                new, neighbour = (pair[1], pair[0]) if known[0] else (pair[0], pair[1])
+                add_ligand(state, new, neighbour, pair, values)
+            else:
+                continue
+            del pending[pair]
+            updates += 1
+            progress = True
+        if not progress:
+            # The pairs left are not connected to the network yet
+            break
+    return state, updates
+
+
+def ligands_of(pairs):
+    """Get the ligands of the pairs in the order they appear."""
+    return list(dict.fromkeys(ligand for pair in pairs for ligand in pair))
+
+
+def connected_pairs(reference, pairs):
+    """Get the pairs connected to the reference ligand."""
+    ligands = {reference}
+    connected = {}
+    remaining = dict(pairs)
+    while True:
+        new = {pair: values for pair, values in remaining.items() if pair[0] in ligands or pair[1] in ligands}
+        if not new:
+            return connected
+        for pair in new:
+            ligands.update(pair)
+            del remaining[pair]
+        connected.update(new)
+
+
+def state_energies(state, reference_value):
+    """Get the energies of the ligands with every weighting (array of shape weightings x ligands)."""
+    return reference_value + np.einsum('kij,kj->ki', state['covariance'], state['rhs'])
+
+
+def state_to_bytes(state):
+    """Serialise the state of a closure."""
+    buffer = io.BytesIO()
+    np.savez(buffer, ligands=np.array(state['ligands'], dtype=str), reference=np.array(state['reference']),
+             keys=np.array(state['keys'], dtype=str).reshape(-1, 2), values=state['values'],
+             covariance=state['covariance'], rhs=state['rhs'])
+    return buffer.getvalue()
+
+
+def state_from_bytes(data):
+    """Read the state of a closure serialised by state_to_bytes."""
+    with np.load(io.BytesIO(data)) as arrays:
+        return {'ligands': arrays['ligands'].tolist(), 'reference': str(arrays['reference']),
+                'keys': [tuple(key) for key in arrays['keys'].tolist()], 'values': arrays['values'],
+                'covariance': arrays['covariance'], 'rhs': arrays['rhs']}
@@ -0,0 +1,268 @@
+""" Plans lambda schedules from previous dV/dλ curves.
+
+The default schedules place the windows in the same way for every transformation. Most of the integration error
+comes from the parts of the dV/dλ curve with a large curvature or noise, so the planner moves the windows there:
+
+1. Reads the dV/dλ curves of the analysed results of the given transformations from the lambdas table, or of a cheap
+   pilot run from its output files.
+2. Places the windows at the Gauss-Legendre points of a warped lambda axis, on which the windows are denser where the
+   curve bends or is noisy, and integrates with the weights of the warped quadrature.
+3. Tries several strengths of the warping and keeps the schedule with the smallest expected error (integration error
+   on the averaged curve combined with the statistical error of the windows). The plain Gauss-Legendre schedule is one
+   of the candidates, and it is kept unless the warping lowers the expected error noticeably.
+4. Writes the schedule to a JSON file, which is used by run_several_sims.py with --lambda_plan.
+
+Usage:
+    python3 lambda_planner.py (-t transformation [transformation ...] | -d folder) -o plan_file [-w windows]
+                              [-e target_error]
+
+Arguments:
+    -t, --transformations: Plan from the analysed results of these transformations (e.g. L89-L97 L89-L97-wat).
+    -d, --directory: Plan from a pilot run, read from the production output files of the transformation folder.
+    -o, --output: JSON file the schedule is written to (required).
+    -w, --windows: Number of lambda windows (default is '12').
+    -e, --target_error: Use the smallest number of windows (up to --windows) whose expected error is below this value.
+"""
+
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+from scipy.interpolate import PchipInterpolator
+
+from adaptive_sampling import window_variance_statistics
+from amber_parser import read_dvdl
+from database_helper import get_db, get_lambda_schedule
+from lambda_schedule import trapezoid_weights
+from simulation_id_helper import get_complex_name, get_run_name_from_result_id
+
+# Strengths of the warping by the curvature and by the noise of the curve tried by the planner
+WARP_STRENGTHS = (0, 0.25, 0.5, 1, 2, 4)
+
+# A warped schedule is only used if its expected error is smaller than this fraction of the error of the plain
+# Gauss-Legendre schedule, since the interpolated curve is itself only an estimate
+MIN_IMPROVEMENT = 0.9
+
+
+def read_result_curve(db, result_id):
+    """
+    Read the dV/dλ curve of an analysed result from the lambdas table.
+
+    With a saved lambda schedule, every row is the contribution of a window (weight times mean dV/dλ). Without it,
+    every row is the free energy of a segment between two windows (trapezoidal rule), which gives dV/dλ at the middle
+    of the segment.
+
+    Parameters
+    ----------
+    db : sqlite3.Connection
+        Database connection.
+    result_id : str
+        Id of the result.
+
+    Returns
+    -------
+    tuple of (np.ndarray, np.ndarray, np.ndarray)
+        Lambda values, mean dV/dλ and its error in kcal/mol.
+
+    Raises
+    ------
+    ValueError
+        If the rows do not match the lambda schedule of the run.
+    """
+    schedule, clambdas, weights = get_lambda_schedule(get_run_name_from_result_id(result_id))
+    rows = np.array(db.execute('SELECT lambda_result, error FROM lambdas WHERE result_id=? ORDER BY lambda',
+                               (result_id,)).fetchall(), dtype=float).reshape(-1, 2)
+    clambdas = np.array(clambdas)
+    if schedule is not None:
+        lambdas, widths = clambdas, np.array(weights)
+    else:
+        lambdas, widths = (clambdas[1:] + clambdas[:-1]) / 2, np.diff(clambdas)
+    if len(rows) != len(lambdas):
+        raise ValueError(f'{result_id} has {len(rows)} lambda rows, but {len(lambdas)} were expected')
+    return lambdas, rows[:, 0] / widths, rows[:, 1] / widths
+
+
+def read_pilot_curve(directory):
+    """
+    Read the dV/dλ curve of a pilot run from the production output files of its windows.
+
+    Parameters
+    ----------
+    directory : str
+        Folder of the transformation, containing one folder per lambda window.
+
+    Returns
+    -------
+    tuple of (np.ndarray, np.ndarray, np.ndarray)
+        Lambda values, mean dV/dλ and its error in kcal/mol.
+    """
+    windows = []
+    for file in glob.glob(os.path.join(directory, '*', '*_prod_*.out')):
+        times, dvdl, header = read_dvdl(file)
+        if len(dvdl) > 2:
+            variance, g, effective_samples, error = window_variance_statistics(dvdl)
+            windows.append((header['clambda'], np.mean(dvdl), error))
+    if len(windows) < 3:
+        raise ValueError(f'Too few lambda windows with dV/dl data in {directory}')
+    return tuple(np.array(values) for values in zip(*sorted(windows)))
+
+
+def get_transformation_results(transformations):
+    """Get the ids of the results of the transformations that were analysed without an error."""
+    db = get_db()
+    result_ids = [row[0] for row in db.execute('SELECT result_id FROM run_info WHERE error=0 ORDER BY result_id')]
+    db.close()
+    return [result_id for result_id in result_ids if get_complex_name(result_id) in transformations]
+
+
+def combine_curves(curves, points=1001):
+    """
+    Interpolate the dV/dλ curves on a fine lambda grid and average them.
+
+    Parameters
+    ----------
+    curves : list of tuple
+        Lambda values, mean dV/dλ and its error of every curve.
+    points : int
+        Number of points of the grid.
+
+    Returns
+    -------
+    tuple of (np.ndarray, np.ndarray, np.ndarray)
+        Lambda grid from 0 to 1, mean dV/dλ and the typical error of a window (root mean square of the errors).
+    """
+    x = np.linspace(0, 1, points)
+    means = [PchipInterpolator(lambdas, mean)(x) for lambdas, mean, error in curves]
+    errors = [np.interp(x, lambdas, error) for lambdas, mean, error in curves]
+    return x, np.mean(means, axis=0), np.sqrt(np.mean(np.square(errors), axis=0))
+
+
+def window_density(x, f, sigma, curvature_strength, noise_strength):
+    """
+    Get the density of the windows along lambda.
+
+    The density is one plus the cube root of the curvature (the optimal density for the integration error of a
+    smooth curve) and the error of the curve, both scaled to a mean of one and weighted by the strengths.
+    """
+    curvature = np.cbrt(np.abs(np.gradient(np.gradient(f, x), x)))
+    density = np.ones(len(x))
+    for values, strength in ((curvature, curvature_strength), (sigma, noise_strength)):
+        if strength > 0 and np.mean(values) > 0:
+            density += strength * values / np.mean(values)
+
+    # Smooth the density, so that the warped quadrature stays accurate
+    half_width = len(x) // 25
+    kernel = np.exp(-0.5 * (np.arange(-half_width, half_width + 1) / (half_width / 2)) ** 2)
+    return np.convolve(np.pad(density, half_width, mode='edge'), kernel / kernel.sum(), mode='valid')
+
+
+def warped_schedule(x, density, n):
+    """
+    Get the n-point Gauss-Legendre schedule on the lambda axis warped by the density of the windows.
+
+    The lambda axis is mapped to u = C(λ), the normalised cumulative density, and the Gauss-Legendre points are placed
+    on u. The weights are those of the integral over u, multiplied by dλ/du.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Lambda grid from 0 to 1.
+    density : np.ndarray
+        Density of the windows on the grid (positive).
+    n : int
+        Number of windows.
+
+    Returns
+    -------
+    tuple of (np.ndarray, np.ndarray)
+        Lambda values (rounded to 5 decimals) and the quadrature weights.
+    """
+    nodes, weights = np.polynomial.legendre.leggauss(n)
+    cumulative = np.concatenate(([0], np.cumsum((density[1:] + density[:-1]) / 2 * np.diff(x))))
+    total = cumulative[-1]
+    lambdas = np.interp((nodes + 1) / 2, cumulative / total, x)
+    return np.round(lambdas, 5), weights / 2 * total / np.interp(lambdas, x, density)
+
+
+def expected_error(x, f, sigma, lambdas, weights):
+    """Get the expected error of a schedule: its integration error on the curve combined with the statistical error."""
+    integration_error = weights @ np.interp(lambdas, x, f) - trapezoid_weights(x) @ f
+    statistical_error = np.sqrt(np.sum((weights * np.interp(lambdas, x, sigma)) ** 2))
+    return np.sqrt(integration_error ** 2 + statistical_error ** 2)
+
+
+def plan_schedule(curves, n):
+    """
+    Plan the lambda schedule with the smallest expected error for the given number of windows.
+
+    Parameters
+    ----------
+    curves : list of tuple
+        Lambda values, mean dV/dλ and its error in kcal/mol of every curve.
+    n : int
+        Number of windows.
+
+    Returns
+    -------
+    tuple of (np.ndarray, np.ndarray, float)
+        Lambda values, quadrature weights and the expected error in kcal/mol.
+    """
+    if n < 2:
+        raise ValueError(f'Too few lambda windows for a schedule: {n}')
+    x, f, sigma = combine_curves(curves)
+    lambdas, weights = warped_schedule(x, np.ones(len(x)), n)
+    plain = (lambdas, weights, expected_error(x, f, sigma, lambdas, weights))
+    best = plain
+    for curvature_strength in WARP_STRENGTHS:
+        for noise_strength in WARP_STRENGTHS:
+            lambdas, weights = warped_schedule(x, window_density(x, f, sigma, curvature_strength, noise_strength), n)
+            if len(np.unique(lambdas)) < n:
+                continue
+            error = expected_error(x, f, sigma, lambdas, weights)
+            if error < best[2]:
+                best = (lambdas, weights, error)
+    return best if best[2] < MIN_IMPROVEMENT * plain[2] else plain
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='This script plans the lambda windows from previous dV/dl curves')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-t', '--transformations', help='Plan from the results of these transformations', nargs='+')
+    source.add_argument('-d', '--directory', help='Plan from a pilot run in this transformation folder')
+    parser.add_argument('-o', '--output', help='JSON file the schedule is written to', required=True)
+    parser.add_argument('-w', '--windows', help='Number of lambda windows', default=12, type=int)
+    parser.add_argument('-e', '--target_error', help='Use the fewest windows with an expected error below this value',
+                        type=float)
+
+    args = parser.parse_args()
+
+    if args.transformations:
+        sources = get_transformation_results(args.transformations)
+        if len(sources) == 0:
+            print('No analysed results of the transformations were found')
+            exit(1)
+        db = get_db()
+        curves = [read_result_curve(db, result_id) for result_id in sources]
+        db.close()
+    else:
+        sources = [args.directory]
+        curves = [read_pilot_curve(args.directory)]
+    print(f'Planning from {len(curves)} dV/dl curves')
+
+    counts = range(3, args.windows + 1) if args.target_error is not None else [args.windows]
+    for n in counts:
+        lambdas, weights, error = plan_schedule(curves, n)
+        print(f'{n} windows: expected error {error:.4f} kcal/mol')
+        if args.target_error is not None and error <= args.target_error:
+            break
+    else:
+        if args.target_error is not None:
+            print(f'The target error is not reached with {args.windows} windows')
+
+    with open(args.output, 'w') as outfile:
+        json.dump({'lambdas': lambdas.tolist(), 'weights': weights.tolist(), 'expected_error': float(error),
+                   'sources': sources}, outfile, indent=4)
+    print(f'Lambda values: {" ".join(str(clambda) for clambda in lambdas)}')
+    print(f'Schedule written to {args.output}')
@@ -0,0 +1,157 @@
+""" Lambda schedules and the quadrature of thermodynamic integration.
+
+A lambda schedule is a list of lambda values of the windows and the quadrature weights used to integrate dV/dλ over
+them. Two kinds of schedules are supported:
+
+- gaussian: the n-point Gauss-Legendre schedule. The integral over the windows is exact for polynomials up to the
+  order 2n-1, so fewer windows are needed than with a uniform schedule.
+- uniform: n equally spaced windows from 0 to 1 integrated with the trapezoidal rule.
+
+Schedules fitted to previous dV/dλ curves are planned by lambda_planner.py and saved with the kind 'adaptive'.
+
+Functions
+---------
+gaussian_schedule(n)
+    Lambda values and weights of the n-point Gauss-Legendre schedule.
+
+uniform_schedule(n)
+    Lambda values and trapezoidal weights of n equally spaced windows.
+
+make_schedule(kind, n)
+    Lambda values and weights of a schedule of the given kind.
+
+window_statistics(samples)
+    Mean and squared standard error of the mean of dV/dλ in every window.
+
+quadrature_ti(means, variances, weights)
+    Free energy and its error integrated with the quadrature weights.
+"""
+
+import numpy as np
+
+SCHEDULE_KINDS = ('gaussian', 'uniform')
+
+# The schedule of the runs created before the schedule was stored per run
+DEFAULT_SCHEDULE = ('gaussian', 12)
+
+
+def gaussian_schedule(n):
+    """
+    Get the lambda values and weights of the n-point Gauss-Legendre schedule.
+
+    Parameters
+    ----------
+    n : int
+        Number of lambda windows.
+
+    Returns
+    -------
+    tuple of (np.ndarray, np.ndarray)
+        Lambda values (rounded to 5 decimals, as written to the AMBER input) and the quadrature weights on [0, 1].
+    """
+    nodes, weights = np.polynomial.legendre.leggauss(n)
+    return np.round((nodes + 1) / 2, 5), weights / 2
+
+
+def uniform_schedule(n):
+    """
+    Get the lambda values and trapezoidal weights of n equally spaced windows from 0 to 1.
+
+    Parameters
+    ----------
+    n : int
+        Number of lambda windows, at least 2.
+
+    Returns
+    -------
+    tuple of (np.ndarray, np.ndarray)
+        Lambda values and the quadrature weights.
+    """
+    lambdas = np.round(np.linspace(0, 1, n), 5)
+    return lambdas, trapezoid_weights(lambdas)
+
+
+def trapezoid_weights(lambdas):
+    """Get the weights of the trapezoidal rule on the given lambda values."""
+    lambdas = np.asarray(lambdas, dtype=float)
+    weights = np.zeros(len(lambdas))
+    steps = np.diff(lambdas) / 2
+    weights[:-1] += steps
+    weights[1:] += steps
+    return weights
+
+
+def make_schedule(kind, n):
+    """
+    Get the lambda values and weights of a schedule.
+
+    Parameters
+    ----------
+    kind : str
+        'gaussian' or 'uniform'.
+    n : int
+        Number of lambda windows.
+
+    Returns
+    -------
+    tuple of (np.ndarray, np.ndarray)
+        Lambda values and the quadrature weights.
+
+    Raises
+    ------
+    ValueError
+        If the kind is unknown or there are too few windows.
+    """
+    if kind not in SCHEDULE_KINDS:
+        raise ValueError(f'Unknown lambda schedule "{kind}", use one of {", ".join(SCHEDULE_KINDS)}')
+    if n < 2:
+        raise ValueError(f'Too few lambda windows for a {kind} schedule: {n}')
+    if kind == 'gaussian':
+        return gaussian_schedule(n)
+    return uniform_schedule(n)
+
+
+def window_statistics(samples):
+    """
+    Calculate the mean and the squared standard error of the mean of dV/dλ in every window.
+
+    Parameters
+    ----------
+    samples : list of np.ndarray
+        Decorrelated dV/dλ samples of every window.
+
+    Returns
+    -------
+    tuple of (np.ndarray, np.ndarray)
+        Means and squared standard errors of the mean (sample variance with ddof=1 divided by the sample count).
+    """
+    counts = np.array([len(sample) for sample in samples])
+    values = np.concatenate(samples)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    means = np.add.reduceat(values, starts) / counts
+    squared_deviations = np.add.reduceat((values - np.repeat(means, counts)) ** 2, starts)
+    return means, squared_deviations / (counts - 1) / counts
+
+
+def quadrature_ti(means, variances, weights):
+    """
+    Integrate dV/dλ over lambda with the quadrature weights of the schedule.
+
+    The last axis is the lambda window, so many transformations can be integrated at once.
+
+    Parameters
+    ----------
+    means : np.ndarray
+        Mean dV/dλ of every window.
+    variances : np.ndarray
+        Squared standard error of the mean of every window.
+    weights : np.ndarray
+        Quadrature weights of the windows.
+
+    Returns
+    -------
+    tuple of (np.ndarray, np.ndarray)
+        Free energy difference and its error.
+    """
+    weights = np.asarray(weights, dtype=float)
+    return np.asarray(means) @ weights, np.sqrt(np.asarray(variances) @ weights ** 2)
@@ -0,0 +1,326 @@
+""" Declarative model of the AMBER input files (mdin) of the stages of a transformation.
+
+Every stage is a set of namelists (&cntrl, &ewald and further ones, e.g. &wt of the heating), kept as dictionaries of
+their parameters. A stage is defined by the changes of its parameters against a parent stage, so that the parameters
+shared by the minimisations, the equilibrations and the production are written once. The modifications of the run
+(modification file) are merged into the parameters of the stage, and the input is rendered once at the end, instead of
+being edited as text.
+
+The stages are:
+    01_min - 05_min: minimisations of ti1p1 with weaker position restraints
+    06_heat: heating of ti1p1
+    07_equi - 09_equi: NPT equilibrations of ti1p2
+    ti2p1: equilibration of every lambda window
+    ti2p2: production of every lambda window
+
+Functions
+---------
+transformation_parameters(timask1, timask2, scmask1, scmask2)
+    TI masks of a transformation as parameters of the stages.
+
+read_modifications(file)
+    Read the modifications of the stages from a modification file.
+
+ewald_parameters(lengths, angles, cut)
+    &ewald parameters (PME grid and skin) for a periodic box.
+
+hmr_parameters(cntrl, dt)
+    &cntrl parameters for a longer time step with hydrogen mass repartitioning and SHAKE.
+
+stage_input(stage, modifications, box, hmr, parameters)
+    Namelists of a stage with the parameters of the transformation and the modifications of the run.
+
+render_input(namelists)
+    Text of the input file of a stage.
+"""
+
+import copy
+import math
+
+TITLE_NVT = 'NVT MD w/No position restraints and PME (sander)'
+TITLE_NPT = 'NPT MD w/No position restraints and PME (sander)'
+
+# Runs of the modification file, the sections of ti1p1 and ti1p2 are their stages and the sections of ti2p1 and ti2p2
+# are the runs themselves
+RUNS = ('ti1p1', 'ti1p2', 'ti2p1', 'ti2p2')
+
+
+class Literal(str):
+    """Value written to the input as it is (e.g. a value from the modification file), not as a quoted string."""
+
+
+# &ewald parameters used without the box of the system
+EWALD = {'skinnb': 2, 'nfft1': 96, 'nfft2': 96, 'nfft3': 96}
+
+# Largest spacing of the PME grid (A) and the largest skin of the pair list (A)
+GRID_SPACING = 1.0
+SKINNB = 2.0
+
+# With hydrogen mass repartitioning, the equilibrations and the production run with SHAKE and this time step (ps).
+# The minimisations and the heating are run as they are
+HMR_TIME_STEP = 0.004
+HMR_STAGES = ('07_equi', '08_equi', '09_equi', 'ti2p1', 'ti2p2')
+
+# &cntrl parameters counted in steps, which are rescaled with the time step to keep the simulated times
+STEP_PARAMETERS = ('nstlim', 'ntpr', 'ntwx', 'ntwe', 'ntwr', 'ntave', 'nscm')
+
+MINIMISATION = {'imin': 1, 'maxcyc': 20000, 'ntmin': 2, 'ntpr': 1000, 'ntwx': 10000, 'ntwe': 1000,
+                'cut': 9.0, 'iwrap': 1, 'nsnb': 10,
+                'ioutfm': 1, 'icfe': 1, 'ifsc': 1, 'timask1': '', 'timask2': '', 'scmask1': '', 'scmask2': '',
+                'clambda': 0.5}
+
+MOLECULAR_DYNAMICS = {'ntx': 1, 'irest': 0, 'ntpr': 1000, 'ntwx': 10000, 'ntwe': 1000, 'ig': -1,
+                      'ntf': 1, 'ntb': 1, 'cut': 9.0, 'iwrap': 1, 'nsnb': 10,
+                      'nstlim': 1000000, 't': 0.0, 'nscm': 1000, 'dt': 0.001,
+                      'temp0': 300.0, 'tempi': 300.0, 'ntt': 3, 'tautp': 2.0,
+                      'ntc': 1, 'ioutfm': 1, 'ntwv': -1, 'ntave': 1000,
+                      'icfe': 1, 'ifsc': 1, 'timask1': '', 'timask2': '', 'scmask1': '', 'scmask2': '', 'clambda': 0.5}
+
+# Stages as (parent stage, title, changes of the &cntrl parameters, further namelists). A parameter set to None is
+# deleted from the parent
+STAGES = {
+    'minimisation': (None, TITLE_NVT, MINIMISATION, []),
+    '01_min': ('minimisation', None, {'ntr': 1, 'restraintmask': '!(:WAT,NA,CL)', 'restraint_wt': 100.0}, []),
+    '02_min': ('minimisation', None, {'ntr': 1, 'restraintmask': '!(:WAT,NA,CL) & !@H=', 'restraint_wt': 100.0}, []),
+    '03_min': ('minimisation', None, {'ntr': 1, 'restraintmask': '@CA,C,O,N', 'restraint_wt': 100.0}, []),
+    '04_min': ('minimisation', None, {'ntr': 1, 'restraintmask': '@CA,C,O', 'restraint_wt': 100.0}, []),
+    '05_min': ('minimisation', None, {}, []),
+    'molecular_dynamics': (None, TITLE_NVT, MOLECULAR_DYNAMICS, []),
+    '06_heat': ('molecular_dynamics', None,
+                {'tempi': 0.0, 'gamma_ln': 2, 'nmropt': 1, 'ntr': 1, 'restraintmask': '!(:WAT,NA,CL)',
+                 'restraint_wt': 5.0},
+                [('wt', {'type': 'TEMP0', 'istep1': 0, 'istep2': 950000, 'value1': 0.0, 'value2': 300.0}),
+                 ('wt', {'type': 'TEMP0', 'istep1': 950001, 'istep2': 1000000, 'value1': 300.0, 'value2': 300.0}),
+                 ('wt', {'type': 'END'})]),
+    'equilibration': ('molecular_dynamics', TITLE_NPT,
+                      {'ntx': 5, 'irest': 1, 'ntb': 2, 'ntp': 1, 'pres0': 1.0, 'taup': 2.0, 'gamma_ln': 2.0,
+                       'nstlim': 200000}, []),
+    '07_equi': ('equilibration', None, {'ntr': 1, 'restraintmask': '!(:WAT,NA,CL)', 'restraint_wt': 5.0}, []),
+    '08_equi': ('equilibration', None, {'ntr': 1, 'restraintmask': '!(:WAT,NA,CL)', 'restraint_wt': 2.0}, []),
+    '09_equi': ('equilibration', None, {'nstlim': 600000}, []),
+    'ti2p1': ('molecular_dynamics', None, {'ntwx': 50000, 'nstlim': 500000, 'ntt': 1}, []),
+    'ti2p2': ('molecular_dynamics', None, {'ntwx': 50000, 'nstlim': 715000, 'ntt': 1}, []),
+}
+
+
+def transformation_parameters(timask1, timask2, scmask1, scmask2):
+    """Get the TI masks of a transformation as parameters of the stages (the softcore masks end with a comma)."""
+    return {'timask1': timask1, 'timask2': timask2, 'scmask1': f'{scmask1},', 'scmask2': f'{scmask2},'}
+
+
+def read_modifications(file):
+    """
+    Read the modifications of the stages from a modification file.
+
+    The file has a line with the run (ti1p1, ti1p2, ti2p1 or ti2p2), for ti1p1 and ti1p2 followed by the stage
+    (e.g. 01_min), then the parameters as parameter=value and &end. A value DELETE deletes the parameter.
+
+    Parameters
+    ----------
+    file : str
+        Path to the modification file.
+
+    Returns
+    -------
+    dict
+        Modified parameters (as they are written in the file) of every stage.
+    """
+    modifications = {}
+    run = section = None
+    with open(file, 'r') as infile:
+        for line in infile:
+            line = line.replace(' ', '').strip()
+            if not line:
+                continue
+            if line in RUNS:
+                run = line
+                section = None if run in ('ti1p1', 'ti1p2') else run
+            elif line == '&end':
+                section = None
+            elif '=' in line:
+                if section is not None:
+                    item, value = line.split('=', 1)
+                    modifications.setdefault(section, {})[item] = Literal(value.rstrip(','))
+            elif run in ('ti1p1', 'ti1p2'):
+                section = line
+    return modifications
+
+
+def fft_size(length, spacing=GRID_SPACING):
+    """Get the smallest even number of grid points of at most spacing apart along a box length, with only the factors
+    2, 3 and 5 (which the FFT of pmemd is fast for)."""
+    size = max(math.ceil(length / spacing - 1e-6), 2)
+    while True:
+        rest = size
+        for factor in (2, 3, 5):
+            while rest % factor == 0:
+                rest //= factor
+        if rest == 1 and size % 2 == 0:
+            return size
+        size += 1
+
+
+def box_widths(lengths, angles):
+    """Get the distances between the opposite faces of a box."""
+    a, b, c = lengths
+    cos_alpha, cos_beta, cos_gamma = (math.cos(math.radians(angle)) for angle in angles)
+    volume = a * b * c * math.sqrt(1 - cos_alpha ** 2 - cos_beta ** 2 - cos_gamma ** 2 +
+                                   2 * cos_alpha * cos_beta * cos_gamma)
+    return [volume / (b * c * math.sqrt(1 - cos_alpha ** 2)), volume / (a * c * math.sqrt(1 - cos_beta ** 2)),
+            volume / (a * b * math.sqrt(1 - cos_gamma ** 2))]
+
+
+def ewald_parameters(lengths, angles=(90.0, 90.0, 90.0), cut=9.0):
+    """
+    Get the &ewald parameters for a periodic box.
+
+    The PME grid has at most GRID_SPACING between its points along every box vector, with sizes the FFT is fast for,
+    so that a small box (e.g. a water leg) gets a small grid. The skin of the pair list is SKINNB, but the cutoff and
+    the skin have to fit into half of the box.
+
+    Parameters
+    ----------
+    lengths : list of float
+        Lengths of the box (A).
+    angles : list of float
+        Angles of the box (degrees).
+    cut : float
+        Cutoff of the nonbonded interactions (A).
+
+    Returns
+    -------
+    dict
+        skinnb, nfft1, nfft2 and nfft3.
+
+    Raises
+    ------
+    ValueError
+        If the box is too small for the cutoff.
+    """
+    skinnb = round(min(SKINNB, min(box_widths(lengths, angles)) / 2 - cut), 2)
+    if skinnb <= 0:
+        raise ValueError(f'The box {lengths} is too small for a cutoff of {cut} A')
+    return {'skinnb': skinnb, 'nfft1': fft_size(lengths[0]), 'nfft2': fft_size(lengths[1]),
+            'nfft3': fft_size(lengths[2])}
+
+
+def hmr_parameters(cntrl, dt=HMR_TIME_STEP):
+    """
+    Change &cntrl parameters to a longer time step with hydrogen mass repartitioning.
+
+    The bonds with hydrogens are constrained by SHAKE (ntc=2) and their forces are not calculated (ntf=2). The
+    parameters counted in steps (STEP_PARAMETERS) are divided by the ratio of the time steps, so that the simulated
+    time and the time between the outputs stay the same.
+
+    Parameters
+    ----------
+    cntrl : dict
+        &cntrl parameters, changed in place.
+    dt : float
+        New time step (ps).
+
+    Returns
+    -------
+    dict
+        The changed parameters.
+    """
+    ratio = float(cntrl.get('dt', 0.001)) / dt
+    for key in STEP_PARAMETERS:
+        if key in cntrl and int(cntrl[key]) > 0:
+            cntrl[key] = max(round(int(cntrl[key]) * ratio), 1)
+    cntrl.update({'dt': dt, 'ntc': 2, 'ntf': 2})
+    return cntrl
+
+
+def stage_namelists(stage):
+    """Get the title and the namelists of a stage, with the changes of all its parent stages merged."""
+    parent, title, cntrl, namelists = STAGES[stage]
+    if parent is None:
+        merged = {'title': title, 'namelists': [('cntrl', {}), ('ewald', dict(EWALD))]}
+    else:
+        merged = stage_namelists(parent)
+    if title is not None:
+        merged['title'] = title
+    parameters = merged['namelists'][0][1]
+    for key, value in cntrl.items():
+        if value is None:
+            parameters.pop(key, None)
+        else:
+            parameters[key] = value
+    merged['namelists'] += copy.deepcopy(namelists)
+    return merged
+
+
+def apply_modifications(namelists, modifications):
+    """
+    Merge modifications into the namelists of a stage.
+
+    A parameter is changed in the namelist it is in (&cntrl first), a new parameter is added to &cntrl and the value
+    DELETE deletes the parameter.
+    """
+    for key, value in modifications.items():
+        owner = next((parameters for name, parameters in namelists['namelists'] if key in parameters),
+                     namelists['namelists'][0][1])
+        if value == 'DELETE':
+            owner.pop(key, None)
+        else:
+            owner[key] = value
+    return namelists
+
+
+def stage_input(stage, modifications=None, box=None, hmr=False, **parameters):
+    """
+    Get the namelists of a stage with the parameters of the transformation and the modifications of the run.
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage (see STAGES).
+    modifications : dict
+        Modifications of the stages (see read_modifications), only the ones of this stage are used.
+    box : tuple of (list, list)
+        Lengths and angles of the box of the system (see parm7.read_box), the &ewald parameters are set for it. The
+        default parameters (EWALD) are used without a box. The modifications of &ewald are kept either way.
+    hmr : bool
+        Whether the topology has hydrogen mass repartitioning, the stages of HMR_STAGES then run with HMR_TIME_STEP
+        (see hmr_parameters). The step counts of the modifications are rescaled as well.
+    parameters
+        &cntrl parameters of the transformation, e.g. the masks and clambda.
+
+    Returns
+    -------
+    dict
+        Title and namelists of the stage.
+    """
+    namelists = stage_namelists(stage)
+    cntrl = namelists['namelists'][0][1]
+    cntrl.update(parameters)
+    stage_modifications = modifications.get(stage, {}) if modifications else {}
+    if box is not None:
+        # the skin depends on the cutoff after the modifications (8 A is the default of pmemd)
+        cut = stage_modifications.get('cut', cntrl.get('cut', 8.0))
+        cut = 8.0 if cut == 'DELETE' else float(cut)
+        namelists['namelists'][1][1].update(ewald_parameters(*box, cut=cut))
+    apply_modifications(namelists, stage_modifications)
+    if hmr and stage in HMR_STAGES:
+        hmr_parameters(cntrl)
+    return namelists
+
+
+def format_value(value):
+    """Format a parameter value for a namelist, strings are quoted."""
+    if isinstance(value, Literal):
+        return str(value)
+    if isinstance(value, str):
+        return f"'{value}'"
+    return str(value)
+
+
+def render_input(namelists):
+    """Get the text of the input file of a stage."""
+    lines = [namelists['title']]
+    for i, (name, parameters) in enumerate(namelists['namelists']):
+        lines.append(f' &{name}')
+        lines += [f'  {key} = {format_value(value)},' for key, value in parameters.items()]
+        lines.append(' &end' if i == 0 else ' /')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,215 @@
+""" Plans the next transformations of a perturbation network from the uncertainties of its ligands.
+
+The cycled energies of the ligands are the weighted least squares fit to the averaged pairs (see
+incremental_closure.py), and the covariance of the fit tells how uncertain every ligand is relative to the reference.
+A new transformation between two ligands changes the covariance by a rank-one term, so the reduction of the
+uncertainty it brings can be predicted before it is simulated. The planner performs the following tasks:
+
+1. Reads the averaged pairs of the given averaging ids and builds the covariance of the fit with the error weighting.
+   Ligands that are not connected to the reference yet get a prior uncertainty (--prior_error).
+2. Reads the candidate pairs, either as a list of pairs or from the score file of LOMAP. The error of a candidate is
+   predicted from the errors of the pairs done so far, divided by its LOMAP score, and its cost is the given number of
+   GPU hours.
+3. Picks, one after another, the candidate with the largest reduction of the summed variance of the ligands per GPU
+   hour, until the GPU budget is used up, and updates the covariance after every pick.
+4. Writes the picked pairs to an input file of run_several_sims.py.
+
+Usage:
+    python3 network_planner.py -a averaging_id [averaging_id ...] -r reference -c candidates -b budget -o output
+                               [-g gpu_hours] [-p prior_error] [-s min_score]
+
+Arguments:
+    -a, --averaging_ids: Averaging ids of the pairs done so far (required).
+    -r, --reference: Reference ligand of the network (required).
+    -c, --candidates: File with the candidate pairs (required). Every line is a pair L1-L2 (or L1 L2), optionally
+                      followed by its LOMAP score and its GPU hours, or the file is the score file of LOMAP.
+    -b, --budget: GPU hours to spend (required).
+    -o, --output: Input file of run_several_sims.py the picked pairs are written to (required).
+    -g, --gpu_hours: GPU hours of a transformation (complex and water) without its own cost (default is '24').
+    -p, --prior_error: Uncertainty of a ligand that is not connected to the reference in kcal/mol (default is '5').
+    -s, --min_score: LOMAP score below which the candidates are not used (default is '0.4').
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+from database_helper import get_db, get_cycle_pairs
+from incremental_closure import WEIGHTINGS, build_state
+
+
+def read_candidates(file, gpu_hours=24.0, min_score=0.4):
+    """
+    Read the candidate pairs.
+
+    Every line is a pair 'L1-L2' or 'L1 L2', optionally followed by its LOMAP score and its cost in GPU hours. The score
+    file of LOMAP (columns Index_1, Index_2, Filename_1, Filename_2, Str_sim, Eff_sim, Loose_sim, Connect) can be used
+    directly, the ligands are then the names of the files without extension and the score is Eff_sim.
+
+    Parameters
+    ----------
+    file : str
+        Path to the file of the candidates.
+    gpu_hours : float
+        GPU hours of a candidate without its own cost.
+    min_score : float
+        Candidates with a lower score are left out.
+
+    Returns
+    -------
+    list of tuple
+        Ligand 1, ligand 2, score and GPU hours of every candidate.
+    """
+    candidates = []
+    with open(file, 'r') as infile:
+        for line in infile:
+            columns = line.split()
+            if len(columns) == 0 or columns[0].startswith('#'):
+                continue
+            if len(columns) >= 8 and columns[-1] in ('Yes', 'No'):
+                # score file of LOMAP
+                ligand_1, ligand_2 = (os.path.splitext(name)[0] for name in columns[2:4])
+                values = [columns[5]]
+            elif '-' in columns[0]:
+                ligand_1, ligand_2 = columns[0].split('-', 1)
+                values = columns[1:]
+            else:
+                ligand_1, ligand_2 = columns[:2]
+                values = columns[2:]
+            score = float(values[0]) if len(values) > 0 else 1.0
+            hours = float(values[1]) if len(values) > 1 else gpu_hours
+            if score >= min_score and score > 0 and ligand_1 != ligand_2:
+                candidates.append((ligand_1, ligand_2, score, hours))
+    return candidates
+
+
+def network_covariance(reference, pairs, ligands=(), prior_error=5.0):
+    """
+    Get the covariance of the cycled energies of the ligands with the error weighting.
+
+    Parameters
+    ----------
+    reference : str
+        Reference ligand, which has no uncertainty.
+    pairs : dict
+        Energy, error and convergence of every pair (ligand_1, ligand_2).
+    ligands : list of str
+        Further ligands, e.g. of the candidates. They and the ligands not connected to the reference get the prior
+        variance and no covariance with the other ligands.
+    prior_error : float
+        Prior uncertainty of the ligands that are not connected to the reference.
+
+    Returns
+    -------
+    tuple of (list, np.ndarray)
+        Ligands and their covariance matrix.
+    """
+    if any(reference in pair for pair in pairs):
+        state = build_state(reference, pairs)
+        known, covariance = state['ligands'], state['covariance'][WEIGHTINGS.index('error')]
+    else:
+        known, covariance = [reference], np.zeros((1, 1))
+    new = [ligand for ligand in dict.fromkeys([ligand for pair in pairs for ligand in pair] + list(ligands))
+           if ligand not in known]
+    expanded = np.diag(np.concatenate((np.zeros(len(known)), np.full(len(new), prior_error ** 2))))
+    expanded[:len(known), :len(known)] = covariance
+    return known + new, expanded
+
+
+def plan_network(ligands, covariance, candidates, errors, hours, budget):
+    """
+    Pick the candidate pairs with the largest reduction of the uncertainty of the ligands per GPU hour.
+
+    Adding a pair i-j with the variance s^2 changes the covariance C to C - (C a)(C a)^T / (s^2 + a^T C a), where a is
+    -1 at i and 1 at j, so the summed variance of the ligands goes down by |C a|^2 / (s^2 + a^T C a). The reductions of
+    all candidates are computed at once, the best one per GPU hour is picked and the covariance is updated, until no
+    candidate fits into the rest of the budget.
+
+    Parameters
+    ----------
+    ligands : list of str
+        Ligands of the covariance matrix.
+    covariance : np.ndarray
+        Covariance of the ligands.
+    candidates : list of tuple
+        Ligand 1 and ligand 2 of every candidate.
+    errors : np.ndarray
+        Predicted error of every candidate.
+    hours : np.ndarray
+        GPU hours of every candidate.
+    budget : float
+        GPU hours to spend.
+
+    Returns
+    -------
+    list of tuple
+        Index of the picked candidates, the reduction of the summed variance and the summed variance after the pick.
+    """
+    index = {ligand: i for i, ligand in enumerate(ligands)}
+    first = np.array([index[ligand_1] for ligand_1, ligand_2 in candidates], dtype=int)
+    second = np.array([index[ligand_2] for ligand_1, ligand_2 in candidates], dtype=int)
+    variances = np.asarray(errors, dtype=float) ** 2
+    hours = np.asarray(hours, dtype=float)
+    covariance = np.array(covariance, dtype=float)
+    available = np.ones(len(candidates), dtype=bool)
+
+    picked = []
+    while True:
+        available &= hours <= budget
+        if not available.any():
+            return picked
+        projected = covariance[:, second] - covariance[:, first]
+        denominator = variances + projected[second, np.arange(len(candidates))] - \
+            projected[first, np.arange(len(candidates))]
+        reductions = np.sum(projected ** 2, axis=0) / denominator
+        best = int(np.argmax(np.where(available, reductions / hours, -np.inf)))
+        covariance -= np.outer(projected[:, best], projected[:, best]) / denominator[best]
+        budget -= hours[best]
+        available[best] = False
+        picked.append((best, float(reductions[best]), float(np.trace(covariance))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='This script plans the next transformations of the network')
+    parser.add_argument('-a', '--averaging_ids', help='Averaging ids of the pairs done so far', nargs='+',
+                        required=True)
+    parser.add_argument('-r', '--reference', help='Reference ligand of the network', required=True)
+    parser.add_argument('-c', '--candidates', help='File with the candidate pairs or the score file of LOMAP',
+                        required=True)
+    parser.add_argument('-b', '--budget', help='GPU hours to spend', type=float, required=True)
+    parser.add_argument('-o', '--output', help='Input file of run_several_sims.py', required=True)
+    parser.add_argument('-g', '--gpu_hours', help='GPU hours of a transformation', type=float, default=24.0)
+    parser.add_argument('-p', '--prior_error', help='Uncertainty of a ligand not connected to the reference',
+                        type=float, default=5.0)
+    parser.add_argument('-s', '--min_score', help='Lowest LOMAP score of the candidates', type=float, default=0.4)
+
+    args = parser.parse_args()
+
+    db = get_db()
+    pairs = get_cycle_pairs(db, args.averaging_ids)
+    db.close()
+    candidates = read_candidates(args.candidates, args.gpu_hours, args.min_score)
+    if len(candidates) == 0:
+        print('No candidate pairs were found')
+        exit(1)
+
+    # The error of a candidate is the typical error of the pairs done so far, larger for a less similar pair
+    pair_error = float(np.median([values[1] for values in pairs.values()])) if pairs else 1.0
+    errors = [pair_error / score for _, _, score, _ in candidates]
+    ligands, covariance = network_covariance(args.reference, pairs,
+                                             [ligand for candidate in candidates for ligand in candidate[:2]],
+                                             args.prior_error)
+    print(f'{len(pairs)} pairs done, summed variance of the ligands {np.trace(covariance):.4f} kcal^2/mol^2')
+
+    picked = plan_network(ligands, covariance, [candidate[:2] for candidate in candidates], errors,
+                          [candidate[3] for candidate in candidates], args.budget)
+    print(f'{"Pair":20s} {"Error":>8s} {"GPU h":>8s} {"Reduction":>10s} {"Variance":>10s}')
+    for best, reduction, variance in picked:
+        ligand_1, ligand_2, score, hours = candidates[best]
+        print(f'{ligand_1 + "-" + ligand_2:20s} {errors[best]:8.3f} {hours:8.1f} {reduction:10.4f} {variance:10.4f}')
+
+    with open(args.output, 'w') as outfile:
+        outfile.writelines(f'{candidates[best][0]}-{candidates[best][1]}\n' for best, _, _ in picked)
+    print(f'{len(picked)} pairs for {sum(candidates[best][3] for best, _, _ in picked):.1f} GPU hours written to '
+          f'{args.output}')
@@ -22,6 +22,12 @@ def update_tables(db):
     db.execute('''DROP TABLE IF EXISTS simulations''')
     db.execute('''DROP TABLE IF EXISTS convergences''')
     db.execute('''DROP TABLE IF EXISTS run_summary''')
+    db.execute('''DROP TABLE IF EXISTS online_analysis''')
+    db.execute('''DROP TABLE IF EXISTS lambda_schedules''')
+    db.execute('''DROP TABLE IF EXISTS window_statistics''')
+    db.execute('''DROP TABLE IF EXISTS bootstrap_samples''')
+    db.execute('''DROP TABLE IF EXISTS cycle_closure_intervals''')
+    db.execute('''DROP TABLE IF EXISTS cycle_closure_states''')
 
 
     # TODO find a way to update the tables without dropping them
@@ -57,14 +63,16 @@ def main():
                     (result_id text NOT NULL,
                     total_free_energy float NOT NULL,
                     total_error float NOT NULL,
-                    total_convergence float)''')
+                    total_convergence float,
+                    bootstrap_error float)''')
     conn.execute('''CREATE TABLE IF NOT EXISTS averaged_free_energies
                     (comb_result_id text NOT NULL,
                     ligand_1 text NOT NULL,
                     ligand_2 text NOT NULL,
                     total_free_energy_averaged float NOT NULL,
                     total_error_averaged float NOT NULL,
-                    total_convergence_averaged float)''')
+                    total_convergence_averaged float,
+                    bootstrap_error_averaged float)''')
     conn.execute('''CREATE TABLE IF NOT EXISTS cycle_closure
                     (cycle_id text NOT NULL,
                     ligand text NOT NULL,
@@ -83,7 +91,55 @@ def main():
                     simulation_count int NOT NULL,
                     error_count int NOT NULL,
                     finished_count int NOT NULL,
-                    modification_file text)''')
+                    modification_file text,
+                    target_error float,
+                    target_convergence float,
+                    lambda_schedule text,
+                    pilot_fraction float,
+                    hmr bool DEFAULT 0)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS online_analysis
+                    (result_id text NOT NULL,
+                    lambda int NOT NULL,
+                    simulation_time float NOT NULL,
+                    sample_count int NOT NULL,
+                    lambda_result float NOT NULL,
+                    error float NOT NULL,
+                    convergence float,
+                    stopped bool NOT NULL,
+                    PRIMARY KEY (result_id, lambda))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS lambda_schedules
+                    (run_name text NOT NULL,
+                    lambda int NOT NULL,
+                    clambda float NOT NULL,
+                    weight float NOT NULL,
+                    PRIMARY KEY (run_name, lambda))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS window_statistics
+                    (result_id text NOT NULL,
+                    lambda int NOT NULL,
+                    sample_count int NOT NULL,
+                    variance float NOT NULL,
+                    statistical_inefficiency float NOT NULL,
+                    effective_samples float NOT NULL,
+                    error float NOT NULL,
+                    extension_steps int NOT NULL,
+                    PRIMARY KEY (result_id, lambda))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS bootstrap_samples
+                    (result_id text PRIMARY KEY,
+                    deviations blob NOT NULL)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS cycle_closure_intervals
+                    (cycle_id text NOT NULL,
+                    ligand text NOT NULL,
+                    weighting text NOT NULL,
+                    mean float NOT NULL,
+                    std float NOT NULL,
+                    lower float NOT NULL,
+                    upper float NOT NULL,
+                    PRIMARY KEY (cycle_id, ligand, weighting))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS cycle_closure_states
+                    (cycle_id text PRIMARY KEY,
+                    averaging_ids text NOT NULL,
+                    reference_value float NOT NULL,
+                    state blob NOT NULL)''')
     conn.commit()
     conn.close()
 
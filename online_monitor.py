@@ -0,0 +1,221 @@
+""" Online analysis and early stopping of a production lambda window.
+
+The ti2p2 job starts this script in the background next to every pmemd.cuda run. It performs the following tasks:
+
+1. Tails the growing output file of the window and reads the new dV/dl records.
+2. Keeps the decorrelated mean and error of dV/dl and the forward/reverse convergence of the window up to date in
+   the online_analysis table.
+3. If early stopping is enabled for the run (target_error in run_summary) and the window reached the targets, it
+   writes the stop file and terminates pmemd.cuda, so that the job moves on to the next window.
+
+Usage:
+    python3 online_monitor.py -r simulation_id -l lambda -f output_file -p pid -s stop_file [-i interval]
+                              [-m min_samples]
+
+Arguments:
+    -r, --simulation_id: Id of the ti2p2 simulation (required).
+    -l, --lambda_index: Index of the lambda window (required).
+    -f, --file: Output file of the window (required).
+    -p, --pid: Process id of the pmemd.cuda run (required).
+    -s, --stop_file: File written when the window is stopped early (required).
+    -i, --interval: Seconds between two reads of the output file (default is '60').
+    -m, --min_samples: Minimal number of decorrelated samples before a window can be stopped (default is '50').
+"""
+
+import argparse
+import os
+import signal
+import time
+
+import numpy as np
+from alchemlyb.convergence import fwdrev_cumavg_Rc
+from alchemlyb.preprocessing import decorrelate_dhdl, dhdl2series
+
+from amber_parser import read_dvdl_since, dvdl_to_dataframe, k_b
+from database_helper import get_db, get_early_stopping_targets
+from simulation_id_helper import get_result_id, get_run_name
+
+
+def is_running(pid):
+    """Check whether a process is still running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def analyse_window(times, dvdl, clambda, T=300):
+    """
+    Calculate the decorrelated mean and error of dV/dl and the convergence of a window.
+
+    Parameters
+    ----------
+    times : np.ndarray
+        Times of the dV/dl records in ps.
+    dvdl : np.ndarray
+        dV/dl records in kcal/mol.
+    clambda : float
+        Lambda value of the window.
+    T : float
+        Temperature in Kelvin.
+
+    Returns
+    -------
+    tuple of (float, float, float, int)
+        Mean and error of dV/dl in kcal/mol, convergence R_c and the number of decorrelated samples.
+    """
+    dhdl = dvdl_to_dataframe(times, dvdl, clambda, T)
+    decorrelated = dhdl2series(decorrelate_dhdl(dhdl, remove_burnin=True))
+    R_c, running_average = fwdrev_cumavg_Rc(decorrelated, tol=2)
+    samples = len(decorrelated)
+    kT = k_b * T
+    mean = decorrelated.mean() * kT
+    error = np.sqrt(decorrelated.var() / samples) * kT
+    return mean, error, R_c, samples
+
+
+def targets_reached(error, convergence, samples, target_error, target_convergence, min_samples):
+    """
+    Check whether a window reached the early stopping targets.
+
+    Parameters
+    ----------
+    error : float
+        Error of the mean dV/dl in kcal/mol.
+    convergence : float
+        Forward/reverse convergence R_c.
+    samples : int
+        Number of decorrelated samples.
+    target_error : float
+        Target error, None if early stopping is disabled.
+    target_convergence : float
+        Target convergence, None if it is not checked.
+    min_samples : int
+        Minimal number of decorrelated samples.
+
+    Returns
+    -------
+    bool
+        True if the window can be stopped.
+    """
+    if target_error is None or samples < min_samples:
+        return False
+    if target_convergence is not None and convergence > target_convergence:
+        return False
+    return error <= target_error
+
+
+def save_online_analysis(db, result_id, lambda_index, simulation_time, samples, mean, error, convergence, stopped):
+    """
+    Save the current state of a running window to the database.
+
+    Parameters
+    ----------
+    db : sqlite3.Connection
+        Database connection.
+    result_id : str
+        Id of the result.
+    lambda_index : int
+        Index of the lambda window.
+    simulation_time : float
+        Simulated time of the window in ps.
+    samples : int
+        Number of decorrelated samples.
+    mean : float
+        Mean dV/dl in kcal/mol.
+    error : float
+        Error of the mean dV/dl in kcal/mol.
+    convergence : float
+        Forward/reverse convergence R_c.
+    stopped : bool
+        Whether the window was stopped early.
+    """
+    db.execute('''INSERT OR REPLACE INTO online_analysis (result_id, lambda, simulation_time, sample_count,
+                  lambda_result, error, convergence, stopped) VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+               (result_id, lambda_index, simulation_time, samples, mean, error, convergence, stopped))
+    db.commit()
+
+
+def monitor_window(simulation_id, lambda_index, file, pid, stop_file, interval=60, min_samples=50):
+    """
+    Follow a running production window until it ends or reaches the early stopping targets.
+
+    Parameters
+    ----------
+    simulation_id : str
+        Id of the ti2p2 simulation.
+    lambda_index : int
+        Index of the lambda window.
+    file : str
+        Output file of the window.
+    pid : int
+        Process id of the pmemd.cuda run.
+    stop_file : str
+        File written when the window is stopped early.
+    interval : float
+        Seconds between two reads of the output file.
+    min_samples : int
+        Minimal number of decorrelated samples before the window can be stopped.
+
+    Returns
+    -------
+    bool
+        True if the window was stopped early.
+    """
+    result_id = get_result_id(simulation_id)
+    target_error, target_convergence = get_early_stopping_targets(get_run_name(simulation_id))
+
+    dvdl = None
+    count = 0
+    offset = 0
+    last_nstep = None
+    while True:
+        running = is_running(pid)
+        new_dvdl, header, offset, last_nstep = read_dvdl_since(file, offset, last_nstep)
+        if header is not None and len(new_dvdl) > 0:
+            if dvdl is None:
+                dvdl = np.empty(header['nstlim'] // header['ntpr'] + 1)
+            if count + len(new_dvdl) > len(dvdl):
+                dvdl = np.resize(dvdl, 2 * (count + len(new_dvdl)))
+            dvdl[count:count + len(new_dvdl)] = new_dvdl
+            count += len(new_dvdl)
+
+            # Equilibration detection needs a few samples to work with
+            if count >= 20:
+                times = header['t0'] + np.arange(1, count + 1) * header['dt'] * header['ntpr']
+                mean, error, convergence, samples = analyse_window(times, dvdl[:count], header['clambda'],
+                                                                   header['T'])
+                stop = running and targets_reached(error, convergence, samples, target_error, target_convergence,
+                                                   min_samples)
+                db = get_db()
+                save_online_analysis(db, result_id, lambda_index, count * header['dt'] * header['ntpr'], samples,
+                                     mean, error, convergence, stop)
+                db.close()
+                if stop:
+                    with open(stop_file, 'w') as outfile:
+                        outfile.write(str(pid))
+                    os.kill(pid, signal.SIGTERM)
+                    print(f'Window {lambda_index} stopped early: error {error:.4f}, convergence {convergence:.3f}')
+                    return True
+
+        if not running:
+            return False
+        time.sleep(interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='This script analyses a running production window')
+    parser.add_argument('-r', '--simulation_id', help='Id of the ti2p2 simulation', required=True)
+    parser.add_argument('-l', '--lambda_index', help='Index of the lambda window', required=True, type=int)
+    parser.add_argument('-f', '--file', help='Output file of the window', required=True)
+    parser.add_argument('-p', '--pid', help='Process id of the pmemd.cuda run', required=True, type=int)
+    parser.add_argument('-s', '--stop_file', help='File written when the window is stopped early', required=True)
+    parser.add_argument('-i', '--interval', help='Seconds between two reads of the output file', default=60,
+                        type=float)
+    parser.add_argument('-m', '--min_samples', help='Minimal number of decorrelated samples before stopping',
+                        default=50, type=int)
+
+    args = parser.parse_args()
+    monitor_window(args.simulation_id, args.lambda_index, args.file, args.pid, args.stop_file, args.interval,
+                   args.min_samples)
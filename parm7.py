@@ -0,0 +1,450 @@
+""" Reads AMBER topologies (parm7) and checks the TI masks of a transformation against them.
+
+A mistake in the masks of params_*.in (an atom that is not in the ligand, a softcore region that leaves a different
+number of common atoms in the two ligands) is otherwise found by pmemd only after the job waited in the GPU queue. The
+masks are resolved against the topology when the transformations are queued, and bad transformations are not sent.
+
+Only the sections of the topology needed for the masks are parsed. The masks of params_*.in are residue and atom lists
+(e.g. :151@S1,CL4,), masks with operators (&, |, !, distances) are left to pmemd.
+
+Functions
+---------
+read_parm7(file, flags)
+    Read sections of a topology.
+
+read_masks(file)
+    Read the TI masks from a params_*.in file.
+
+resolve_mask(topology, mask)
+    Atoms selected by a mask.
+
+check_transformation(topology, timask1, timask2, scmask1, scmask2)
+    Problems of the TI masks of a transformation.
+
+check_transformation_folder(folder, complex_name)
+    Problems of the TI masks of a transformation folder.
+
+read_box(rst7_file, parm7_file)
+    Periodic box of a system from its restart file.
+
+read_stage_box(rst7_files, parm7_file)
+    Periodic box of the restart file a stage starts from.
+
+repartition_hydrogen_masses(parm7_file, output_file, hydrogen_mass)
+    Write a topology with hydrogen mass repartitioning.
+
+prepare_topology(complex_name, hmr)
+    Topology of a complex used by the simulations.
+"""
+
+import fnmatch
+import math
+import os
+import re
+
+from scipy.io import netcdf_file
+
+# Sections of the topology needed to resolve the masks
+MASK_FLAGS = ('POINTERS', 'ATOM_NAME', 'RESIDUE_LABEL', 'RESIDUE_POINTER')
+
+MASK_NAMES = ('timask1', 'timask2', 'scmask1', 'scmask2')
+
+# Mass of the hydrogens (amu) with hydrogen mass repartitioning, the mass is taken from the bonded heavy atoms
+HYDROGEN_MASS = 3.024
+
+# Residues of water, which is rigid and keeps its masses
+WATER_RESIDUES = ('WAT', 'HOH', 'TP3', 'TIP3', 'SOL')
+
+
+def read_parm7(file, flags=MASK_FLAGS):
+    """
+    Read sections of an AMBER topology.
+
+    Parameters
+    ----------
+    file : str
+        Path to the parm7 file.
+    flags : tuple of str
+        Sections (%FLAG) to read, the other ones are skipped without being parsed.
+
+    Returns
+    -------
+    dict
+        Values of every section that was found, strings for the character formats and numbers otherwise.
+    """
+    with open(file, 'r') as infile:
+        return parse_parm7(infile.read(), flags)
+
+
+def parse_parm7(text, flags=MASK_FLAGS):
+    """Parse sections of the text of a topology (see read_parm7)."""
+    topology = {}
+    for section in text.split('%FLAG ')[1:]:
+        lines = section.splitlines()
+        flag = lines[0].strip()
+        if flag not in flags:
+            continue
+        fmt = next(line for line in lines[1:] if line.startswith('%FORMAT'))
+        kind, width = re.search(r'\(\d+([aIEF])(\d+)', fmt).groups()
+        width = int(width)
+        fields = [line[i:i + width] for line in lines[1:] if not line.startswith('%')
+                  for i in range(0, len(line), width)]
+        if kind == 'a':
+            topology[flag] = [field.strip() for field in fields if field.strip()]
+        elif kind == 'I':
+            topology[flag] = [int(field) for field in fields if field.strip()]
+        else:
+            topology[flag] = [float(field) for field in fields if field.strip()]
+    return topology
+
+
+def read_masks(file):
+    """
+    Read the TI masks from a params_*.in file.
+
+    Parameters
+    ----------
+    file : str
+        Path to the params file.
+
+    Returns
+    -------
+    tuple of str
+        timask1, timask2, scmask1 and scmask2.
+
+    Raises
+    ------
+    ValueError
+        If a mask is missing.
+    """
+    with open(file, 'r') as infile:
+        data = infile.read()
+    masks = []
+    for name in MASK_NAMES:
+        match = re.search(rf"{name}\s*=\s*'(.*?)'", data)
+        if match is None:
+            raise ValueError(f'{file} has no {name}')
+        masks.append(match.group(1))
+    return tuple(masks)
+
+
+def residue_of_atoms(topology):
+    """Get the residue (0-based) of every atom."""
+    natom, nres = topology['POINTERS'][0], topology['POINTERS'][11]
+    bounds = topology['RESIDUE_POINTER'][:nres] + [natom + 1]
+    return [residue for residue in range(nres) for _ in range(bounds[residue + 1] - bounds[residue])]
+
+
+def match_items(items, names, candidates):
+    """
+    Get the indices (0-based) of the candidates selected by every item of a list of numbers (from 1), ranges and names
+    with wildcards.
+    """
+    allowed = set(candidates)
+    selected = {}
+    for item in items:
+        numbers = re.fullmatch(r'(\d+)(?:-(\d+))?', item)
+        if numbers is not None:
+            first, last = int(numbers.group(1)), int(numbers.group(2) or numbers.group(1))
+            selected[item] = [i for i in range(first - 1, last) if i in allowed]
+        else:
+            pattern = item.replace('=', '*')
+            selected[item] = [i for i in candidates if fnmatch.fnmatchcase(names[i], pattern)]
+    return selected
+
+
+def resolve_mask(topology, mask):
+    """
+    Get the atoms selected by a mask of residues and atoms, e.g. :151@S1,CL4, or :1-2 or @CA.
+
+    Residues and atoms are given by their numbers (from 1), ranges or names with the wildcards * (or =) and ?.
+
+    Parameters
+    ----------
+    topology : dict
+        Sections of the topology (see read_parm7).
+    mask : str
+        AMBER mask.
+
+    Returns
+    -------
+    tuple of (list, list)
+        Selected atoms (0-based) and the items of the mask that do not select anything.
+
+    Raises
+    ------
+    ValueError
+        If the mask uses operators, which are not resolved here.
+    """
+    match = re.fullmatch(r'(?::([^@:]*))?(?:@([^@:]*))?', mask.strip())
+    if match is None or not mask.strip() or any(character in mask for character in '&|!()<>'):
+        raise ValueError(f'The mask {mask} can not be resolved')
+    residue_part, atom_part = match.groups()
+    residue_of = residue_of_atoms(topology)
+    atom_names = topology['ATOM_NAME'][:len(residue_of)]
+
+    unmatched = []
+    atoms = list(range(len(atom_names)))
+    if residue_part is not None:
+        residue_labels = topology['RESIDUE_LABEL'][:topology['POINTERS'][11]]
+        selected = match_items([item for item in residue_part.split(',') if item], residue_labels,
+                               range(len(residue_labels)))
+        unmatched += [f':{item}' for item, residues in selected.items() if not residues]
+        residues = {residue for residue_list in selected.values() for residue in residue_list}
+        atoms = [atom for atom, residue in enumerate(residue_of) if residue in residues]
+    if atom_part is not None:
+        # atom numbers are the numbers in the whole topology, names are looked up in the selected residues
+        selected = match_items([item for item in atom_part.split(',') if item], atom_names, atoms)
+        unmatched += [f'@{item}' for item, indices in selected.items() if not indices]
+        atoms = sorted({atom for indices in selected.values() for atom in indices})
+    return atoms, unmatched
+
+
+def check_transformation(topology, timask1, timask2, scmask1, scmask2):
+    """
+    Check the TI masks of a transformation against its topology.
+
+    The masks have to start with ':' and select existing residues and atoms, the softcore atoms have to be in the TI
+    region of their ligand, the two TI regions can not overlap and the atoms that are not softcore (which pmemd pairs
+    one to one) have to be as many in both ligands.
+
+    Parameters
+    ----------
+    topology : dict
+        Sections of the topology (see read_parm7).
+    timask1, timask2, scmask1, scmask2 : str
+        TI masks of the transformation.
+
+    Returns
+    -------
+    list of str
+        Problems of the masks, empty if the masks are fine.
+    """
+    problems = []
+    atoms = {}
+    for name, mask in zip(MASK_NAMES, (timask1, timask2, scmask1, scmask2)):
+        if not mask.startswith(':'):
+            problems.append(f'{name} {mask} does not start with :')
+            continue
+        try:
+            selected, unmatched = resolve_mask(topology, mask)
+        except ValueError:
+            continue
+        atoms[name] = set(selected)
+        problems += [f'{name} {mask}: {item} is not in the topology' for item in unmatched]
+        if name.startswith('timask') and not selected:
+            problems.append(f'{name} {mask} selects no atoms')
+
+    for ligand in '12':
+        timask, scmask = atoms.get(f'timask{ligand}'), atoms.get(f'scmask{ligand}')
+        if timask is not None and scmask is not None and not scmask <= timask:
+            problems.append(f'scmask{ligand} has {len(scmask - timask)} atoms outside of timask{ligand}')
+    if 'timask1' in atoms and 'timask2' in atoms and atoms['timask1'] & atoms['timask2']:
+        problems.append('timask1 and timask2 overlap')
+    if len(atoms) == len(MASK_NAMES) and atoms['timask1'] and atoms['timask2']:
+        common_1, common_2 = len(atoms['timask1'] - atoms['scmask1']), len(atoms['timask2'] - atoms['scmask2'])
+        if common_1 != common_2:
+            problems.append(f'The softcore regions do not line up: {common_1} atoms of timask1 are not softcore, but '
+                            f'{common_2} atoms of timask2')
+    return problems
+
+
+def check_transformation_folder(folder, complex_name):
+    """
+    Check the TI masks in params_{complex_name}.in against {complex_name}.parm7 of a transformation folder.
+
+    Parameters
+    ----------
+    folder : str
+        Folder of the transformation.
+    complex_name : str
+        Name of the complex (e.g. L21-L36 or L21-L36-wat).
+
+    Returns
+    -------
+    list of str
+        Problems of the masks or missing files, empty if the transformation can be run.
+    """
+    params_file = os.path.join(folder, f'params_{complex_name}.in')
+    parm7_file = os.path.join(folder, f'{complex_name}.parm7')
+    for file in (params_file, parm7_file):
+        if not os.path.isfile(file):
+            return [f'{file} does not exist']
+    try:
+        masks = read_masks(params_file)
+    except ValueError as error:
+        return [str(error)]
+    return check_transformation(read_parm7(parm7_file), *masks)
+
+
+
+def read_box(rst7_file, parm7_file=None):
+    """
+    Read the periodic box of a system from its restart file.
+
+    pmemd writes NetCDF restart files unless ntxo=1, their box is read with scipy.
+
+    Parameters
+    ----------
+    rst7_file : str
+        Path to the rst7 file.
+    parm7_file : str
+        Path to the topology, whose number of atoms has to be the one of the restart file (optional).
+
+    Returns
+    -------
+    tuple of (list, list) or None
+        Lengths (A) and angles (degrees) of the box, None for a NetCDF-4 (HDF5) restart file, which is not read here.
+
+    Raises
+    ------
+    ValueError
+        If the restart file has no box or other atoms than the topology.
+    """
+    with open(rst7_file, 'rb') as infile:
+        magic = infile.read(4)[:3]
+    if magic == b'\x89HD':
+        return None
+    if magic == b'CDF':
+        with netcdf_file(rst7_file, 'r', mmap=False) as restart:
+            atoms = restart.dimensions['atom']
+            if 'cell_lengths' not in restart.variables:
+                raise ValueError(f'{rst7_file} has no periodic box')
+            box = ([float(length) for length in restart.variables['cell_lengths'][:]],
+                   [float(angle) for angle in restart.variables['cell_angles'][:]])
+    else:
+        with open(rst7_file, 'r') as infile:
+            lines = infile.read().splitlines()
+        atoms = int(lines[1].split()[0])
+        box = None
+    if parm7_file is not None:
+        topology_atoms = read_parm7(parm7_file, ('POINTERS',))['POINTERS'][0]
+        if atoms != topology_atoms:
+            raise ValueError(f'{rst7_file} has {atoms} atoms, but {parm7_file} has {topology_atoms}')
+    if box is not None:
+        return box
+    # coordinates (and velocities) are written six numbers per line, the box is the line after them
+    coordinate_lines = math.ceil(atoms / 2)
+    if (len(lines) - 2) % coordinate_lines != 1:
+        raise ValueError(f'{rst7_file} has no periodic box')
+    box = [float(lines[-1][i:i + 12]) for i in range(0, len(lines[-1].rstrip()), 12)]
+    return box[:3], box[3:6] or [90.0, 90.0, 90.0]
+
+
+def read_stage_box(rst7_files, parm7_file=None):
+    """
+    Read the periodic box of the restart file a stage starts from.
+
+    The box of a system changes in the NPT equilibrations, so the PME grid of a stage is sized for the restart file it
+    starts from. Restart files of stages that have not run yet are skipped.
+
+    Parameters
+    ----------
+    rst7_files : list of str
+        Restart files to read the box from, the first one that exists and can be read is used (e.g. the restart file
+        of the previous stage, then the initial rst7 file of the system).
+    parm7_file : str
+        Path to the topology (optional, see read_box).
+
+    Returns
+    -------
+    tuple of (list, list) or None
+        Lengths (A) and angles (degrees) of the box, None if none of the restart files can be read.
+    """
+    for rst7_file in rst7_files:
+        if os.path.isfile(rst7_file):
+            box = read_box(rst7_file, parm7_file)
+            if box is not None:
+                return box
+    return None
+
+
+def repartition_hydrogen_masses(parm7_file, output_file, hydrogen_mass=HYDROGEN_MASS):
+    """
+    Write a topology with hydrogen mass repartitioning.
+
+    Every hydrogen bonded to a heavy atom gets hydrogen_mass, and the mass it gains is taken from the heavy atom, so
+    that the mass of every molecule stays the same. Water keeps its masses, and hydrogens that already have the mass
+    are left as they are, so a repartitioned topology does not change again. Only the MASS section is written anew.
+
+    Parameters
+    ----------
+    parm7_file : str
+        Path to the topology.
+    output_file : str
+        Path to the repartitioned topology.
+    hydrogen_mass : float
+        Mass of the hydrogens (amu).
+
+    Returns
+    -------
+    int
+        Number of repartitioned hydrogens.
+
+    Raises
+    ------
+    ValueError
+        If a heavy atom would be left with no mass.
+    """
+    with open(parm7_file, 'r') as infile:
+        text = infile.read()
+    topology = parse_parm7(text, MASK_FLAGS + ('MASS', 'ATOMIC_NUMBER', 'BONDS_INC_HYDROGEN'))
+    masses = topology['MASS'][:topology['POINTERS'][0]]
+    if 'ATOMIC_NUMBER' in topology:
+        hydrogens = [number == 1 for number in topology['ATOMIC_NUMBER']]
+    else:
+        hydrogens = [mass < 2.0 for mass in masses]
+    residue_of = residue_of_atoms(topology)
+    labels = topology['RESIDUE_LABEL']
+
+    repartitioned = 0
+    bonds = topology.get('BONDS_INC_HYDROGEN', [])
+    # the bonds are written as 3 * atom index of both atoms and the bond type
+    for first, second in zip(bonds[0::3], bonds[1::3]):
+        first, second = first // 3, second // 3
+        if hydrogens[first] == hydrogens[second]:
+            continue
+        hydrogen, heavy = (first, second) if hydrogens[first] else (second, first)
+        shift = hydrogen_mass - masses[hydrogen]
+        if labels[residue_of[hydrogen]] in WATER_RESIDUES or shift <= 0:
+            continue
+        masses[heavy] -= shift
+        masses[hydrogen] = hydrogen_mass
+        if masses[heavy] <= 0:
+            raise ValueError(f'Atom {heavy + 1} of {parm7_file} has no mass left after the repartitioning')
+        repartitioned += 1
+
+    values = ''.join('%16.8E' % mass + ('\n' if (i + 1) % 5 == 0 else '') for i, mass in enumerate(masses))
+    section = re.compile(r'(%FLAG MASS\s*\n%FORMAT\(5E16\.8\)\s*\n).*?(?=%FLAG)', re.DOTALL)
+    text = section.sub(lambda match: match.group(1) + values.rstrip('\n') + '\n', text, count=1)
+    with open(output_file, 'w') as outfile:
+        outfile.write(text)
+    return repartitioned
+
+
+def prepare_topology(complex_name, hmr=False):
+    """
+    Get the topology of a complex used by the simulations, in the folder of the transformation.
+
+    With hydrogen mass repartitioning, the repartitioned topology {complex_name}_hmr.parm7 is written by the first stage
+    that needs it. It is written to a temporary file first, so that the jobs of other runs never read a part of it.
+
+    Parameters
+    ----------
+    complex_name : str
+        Name of the complex.
+    hmr : bool
+        Whether the run uses hydrogen mass repartitioning.
+
+    Returns
+    -------
+    str
+        Name of the topology file.
+    """
+    if not hmr:
+        return f'{complex_name}.parm7'
+    parm7_file = f'{complex_name}_hmr.parm7'
+    if not os.path.isfile(parm7_file):
+        repartition_hydrogen_masses(f'{complex_name}.parm7', f'{parm7_file}.{os.getpid()}')
+        os.replace(f'{parm7_file}.{os.getpid()}', parm7_file)
+    return parm7_file
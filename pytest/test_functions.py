@@ -1,28 +1,61 @@
+import json
+import shutil
+import subprocess
 import sys
-import textwrap
+import tempfile
+import time
 
 import on_database_created
 
 sys.path.append('../')
+sys.path.append('../Weighted_cc')
 
 import os
 import unittest.mock
 from unittest.mock import patch
 import pytest
+import scipy.io
 import sqlite3
+import numpy as np
+import pandas as pd
+from alchemlyb.parsing.amber import extract_dHdl as alchemlyb_extract_dHdl
 
 from check_queue import get_transformations, generate_xpus, get_data_from_params
 from database_helper import add_job_id, update_job_status, get_db, insert_into_simulations, delete_simulation, \
     delete_run, delete_all_data, delete_all_non_started_runs, run_command, run_select_command, make_averaged_energies, \
     cycle_averaged_data, redo_simulation, transfer_database, check_if_job_id_null, create_run_summary, get_protein_name, \
-    modify_run_input, update_run_summary, get_modification_file
-from run_several_sims import get_all_lines_stripped, convert_lines_to_modes, write_to_file
+    update_run_summary, get_modification_file, get_early_stopping_targets, save_lambda_schedule, \
+    get_lambda_schedule, incremental_cycle_data, update_cycle_closure, get_run_modifications, get_run_context, \
+    get_protein_pathway, redo_error_analysis
+from mdin import transformation_parameters, stage_input, render_input, Literal, EWALD, ewald_parameters, fft_size
+from incremental_closure import build_state, update_state, state_energies
+from run_several_sims import get_all_lines_stripped, convert_lines_to_modes, write_to_file, read_lambda_plan, \
+    check_masks
+from parm7 import read_parm7, read_masks, resolve_mask, check_transformation, read_box, repartition_hydrogen_masses, \
+    prepare_topology, read_stage_box
 from simulation_id_helper import get_complex_name, get_ligand_one, get_ligand_two, get_is_wat, get_mode, get_run_name, \
     get_result_id, get_run_name_from_result_id
 from settings_helper import get_gpu_settings, get_cpu_settings, get_home_pathway, get_environment, \
-    get_max_cpus, get_max_gpus, set_settings_path, find_between
+    get_max_cpus, get_max_gpus, set_settings_path, find_between, get_max_analyses, get_settings, parse_settings
 from analyse_data_after_run import save_lambdas, save_analysis_errorless, save_run_info
 from simulation_id_helper import get_updated_simulation_id
+from amber_parser import extract_dHdl, read_dvdl, read_dvdl_since
+from online_monitor import targets_reached
+import analysis_cache
+import settings_helper
+from batch_analysis import analyse_items, save_items, report, collect_items
+from lambda_schedule import make_schedule, window_statistics, quadrature_ti
+from analysis_workflow import quadrature_summary, run_workflow
+from adaptive_sampling import window_variance_statistics, allocate_extensions, extension_input
+from lambda_planner import plan_schedule, read_result_curve, combine_curves, expected_error
+from network_planner import read_candidates, network_covariance, plan_network
+import bootstrap
+from benchmarks.benchmark_amber_parser import write_synthetic_out
+from benchmarks.benchmark_weighted_cc import make_network, benchmark_network
+from benchmarks.benchmark_hmr import validate_topology, compare_inputs, compare_runs
+from Graphs import Graph
+import CalLig
+from wcc_main import cycleClosure, cycleClosureSamples, optParser
 
 gpu_settings = f'''#SBATCH --partition=compchemq
 #SBATCH --qos=compchem
@@ -78,6 +111,16 @@ class TestClass(unittest.TestCase):
         add_job_id(4658, 'L89-L44_2_ti1p2_some_id')
         assert len(get_transformations('cpu', 3)) == 2
 
+        # The analyses are CPU jobs with their own limit
+        insert_into_simulations('L21-L36_5_all_myid', 0)
+        insert_into_simulations('L21-L36-wat_5_all_myid', 0)
+        assert get_transformations('analysis', 1) == ['L21-L36_5_all_myid']
+        assert 'L21-L36_5_all_myid' not in get_transformations('cpu', 10)
+        add_job_id(4659, 'L21-L36_5_all_myid')
+        assert get_transformations('analysis', 1) == []
+        assert get_transformations('analysis', 2) == ['L21-L36-wat_5_all_myid']
+        assert len(get_transformations('cpu', 3)) == 2
+
     def test_find_between(self):
         assert find_between('abc123def', 'abc', 'def') == '123'
 
@@ -216,6 +259,39 @@ class TestClass(unittest.TestCase):
         assert get_environment() == environment
         assert get_max_gpus() == 15
         assert get_max_cpus() == 14
+        assert get_max_analyses() == 14
+
+    def test_settings_cache(self):
+        original = os.path.join(get_home_pathway(), 'simulation_settings.in')
+        with open(original, 'r') as infile:
+            data = infile.read()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'simulation_settings.in')
+            with open(path, 'w') as outfile:
+                outfile.write(data)
+            set_settings_path(path)
+            try:
+                # The settings file is parsed once while it does not change
+                with patch('settings_helper.get_settings_data', wraps=settings_helper.get_settings_data) as mock_data:
+                    settings = get_settings()
+                    assert get_max_gpus() == 15 and get_max_cpus() == 14 and get_environment() == environment
+                    assert get_settings() is settings and mock_data.call_count == 1
+
+                # max_GPUs changed while running
+                with open(path, 'w') as outfile:
+                    outfile.write(data.replace('max_GPUs="15"', 'max_GPUs="3"'))
+                state = os.stat(path)
+                os.utime(path, ns=(state.st_atime_ns, state.st_mtime_ns + 10 ** 9))
+                assert get_max_gpus() == 3 and get_settings() is not settings
+            finally:
+                set_settings_path(original)
+
+        assert parse_settings(data + 'max_analyses="4"').max_analyses == 4
+        assert parse_settings(data).analysis_cache_size == 2000
+        with pytest.raises(ValueError):
+            parse_settings(data.replace('max_GPUs="15"', 'max_GPUs="many"'))
+        with pytest.raises(ValueError):
+            parse_settings(data.replace('environment=', 'env='))
 
     def test_simulation_id_helper(self):
         assert get_ligand_one('L21-L36_1_ti1p1_myid') == 'L21'
@@ -226,8 +302,9 @@ class TestClass(unittest.TestCase):
         assert get_mode('L21-L36_2_ti1p1_myid') == 'ti1p2'
         assert get_mode('L21-L36_3_ti1p1_myid') == 'ti2p1'
         assert get_mode('L21-L36_4_ti1p1_myid') == 'ti2p2'
+        assert get_mode('L21-L36_5_ti1p1_myid') == 'analysis'
         with pytest.raises(ValueError):
-            get_mode('L21-L36_5_ti1p1_myid')
+            get_mode('L21-L36_6_ti1p1_myid')
 
     def test_get_data_from_params(self):
         os.chdir('MCL1/L21')
@@ -235,6 +312,141 @@ class TestClass(unittest.TestCase):
         assert get_data_from_params('L21-L36', 'L21-L36_1_all_id') == (':151', ':152', ':151@S1,CL4,', ':152@H1,N1,H,')
         os.chdir('..')
 
+    def test_parm7_masks(self):
+        folder = os.path.join(get_home_pathway(), 'MCL1', 'L23', 'L23-L27-wat')
+        topology = read_parm7(os.path.join(folder, 'L23-L27-wat.parm7'))
+        assert len(topology['ATOM_NAME']) == topology['POINTERS'][0] == 14185
+        assert topology['RESIDUE_LABEL'][:3] == ['L24', 'L7E', 'Cl-']
+        masks = read_masks(os.path.join(folder, 'params_L23-L27-wat.in'))
+        assert masks == (':1', ':2', ':1@CW1,CW2,CW3,HW1,HW2,HW3,', ':2@CP1,OP1,HP1,HP2,HP3,')
+        assert check_transformation(topology, *masks) == []
+
+        assert len(resolve_mask(topology, ':1')[0]) == 47 and len(resolve_mask(topology, ':L7E')[0]) == 46
+        assert resolve_mask(topology, ':1@CW1,XX1,') == ([resolve_mask(topology, '@CW1')[0][0]], ['@XX1'])
+        assert resolve_mask(topology, '@1-3') == ([0, 1, 2], [])
+        with pytest.raises(ValueError):
+            resolve_mask(topology, ':1&!@H=')
+
+        # An atom missing from a softcore region leaves different numbers of common atoms
+        problems = check_transformation(topology, ':1', ':2', ':1@CW1,CW2,CW3,HW1,HW2,', ':2@CP1,OP1,HP1,HP2,HP3,')
+        assert len(problems) == 1 and '42 atoms of timask1' in problems[0]
+        problems = check_transformation(topology, ':1', ':1-2', ':1@CW9,', '2@CP1')
+        assert problems == ['scmask1 :1@CW9,: @CW9 is not in the topology', 'scmask2 2@CP1 does not start with :',
+                            'timask1 and timask2 overlap']
+        assert check_transformation(topology, ':5000', ':2', ':5000@CW1', ':2@CP1') == \
+               ['timask1 :5000: :5000 is not in the topology', 'timask1 :5000 selects no atoms',
+                'scmask1 :5000@CW1: :5000 is not in the topology', 'scmask1 :5000@CW1: @CW1 is not in the topology']
+
+        # Transformations are checked before they are queued
+        protein_pathway = os.path.join(get_home_pathway(), 'MCL1')
+        assert check_masks(['L23-L27-wat_1_ti1p1_my_id'], protein_pathway, wat=True) == []
+        problems = check_masks(['L23-L27_1_ti1p1_my_id'], protein_pathway)
+        assert len(problems) == 1 and problems[0].startswith('L23-L27: ') and 'does not exist' in problems[0]
+
+    def test_ewald_grid(self):
+        folder = os.path.join(get_home_pathway(), 'MCL1', 'L23', 'L23-L27-wat')
+        box = read_box(os.path.join(folder, 'L23-L27-wat.rst7'), os.path.join(folder, 'L23-L27-wat.parm7'))
+        assert box == ([52.621, 56.082, 51.942], [90.0, 90.0, 90.0])
+        assert [fft_size(length) for length in (52.621, 56.082, 96, 97, 37.1)] == [54, 60, 96, 100, 40]
+
+        # The water leg gets a smaller grid than the default one
+        assert ewald_parameters(*box) == {'skinnb': 2.0, 'nfft1': 54, 'nfft2': 60, 'nfft3': 54}
+        assert ewald_parameters([80, 80, 80], [109.4712206] * 3)['skinnb'] == 2.0
+        assert ewald_parameters([21, 21, 21], cut=9.0)['skinnb'] == 1.5
+        with pytest.raises(ValueError):
+            ewald_parameters([17, 17, 17], cut=9.0)
+
+        # The skin uses the modified cutoff and the modifications of &ewald are kept
+        masks = transformation_parameters(':1', ':2', ':1@CW1', ':2@CP1')
+        ewald = stage_input('ti2p2', None, box, **masks)['namelists'][1][1]
+        assert ewald == {'skinnb': 2.0, 'nfft1': 54, 'nfft2': 60, 'nfft3': 54}
+        modifications = {'ti2p2': {'cut': Literal('12.0'), 'nfft3': Literal('64')}}
+        small_box = ([30.0, 30.0, 30.0], [90.0, 90.0, 90.0])
+        ewald = stage_input('ti2p2', modifications, small_box, **masks)['namelists'][1][1]
+        assert ewald == {'skinnb': 2.0, 'nfft1': 30, 'nfft2': 30, 'nfft3': '64'}
+        modifications['ti2p2']['cut'] = Literal('13.5')
+        assert stage_input('ti2p2', modifications, small_box, **masks)['namelists'][1][1]['skinnb'] == 1.5
+        assert stage_input('ti2p2', None, None, **masks)['namelists'][1][1] == EWALD
+
+        with tempfile.TemporaryDirectory() as directory:
+            rst7_file = os.path.join(directory, 'wrong.rst7')
+            with open(rst7_file, 'w') as outfile:
+                outfile.write('title\n     2\n' + '%12.7f' * 6 % (0, 0, 0, 1, 1, 1) + '\n')
+            with pytest.raises(ValueError):
+                read_box(rst7_file)
+            with pytest.raises(ValueError):
+                read_box(rst7_file, os.path.join(folder, 'L23-L27-wat.parm7'))
+
+            # The NetCDF restart files written by pmemd after the NPT equilibration
+            parm7_file = os.path.join(folder, 'L23-L27-wat.parm7')
+            netcdf_file = os.path.join(directory, 'L23-L27-wat_ti_equi.rst7')
+            with scipy.io.netcdf_file(netcdf_file, 'w', version=2) as restart:
+                restart.createDimension('atom', read_parm7(parm7_file, ('POINTERS',))['POINTERS'][0])
+                restart.createDimension('cell_spatial', 3)
+                restart.createDimension('cell_angular', 3)
+                restart.createVariable('cell_lengths', 'd', ('cell_spatial',))[:] = [53.5, 57.0, 52.8]
+                restart.createVariable('cell_angles', 'd', ('cell_angular',))[:] = [90.0, 90.0, 90.0]
+            assert read_box(netcdf_file, parm7_file) == ([53.5, 57.0, 52.8], [90.0, 90.0, 90.0])
+
+            # A stage is sized for the restart file it starts from, if it exists
+            initial_file = os.path.join(folder, 'L23-L27-wat.rst7')
+            missing_file = os.path.join(directory, 'L23-L27-wat_equi_0.rst7')
+            assert read_stage_box([missing_file, netcdf_file, initial_file], parm7_file)[0] == [53.5, 57.0, 52.8]
+            assert read_stage_box([missing_file, initial_file], parm7_file) == box
+            assert read_stage_box([missing_file]) is None
+            assert ewald_parameters(*read_stage_box([netcdf_file]))['nfft2'] == 60
+
+    def test_hmr(self):
+        folder = os.path.join(get_home_pathway(), 'MCL1', 'L23', 'L23-L27-wat')
+        parm7_file = os.path.join(folder, 'L23-L27-wat.parm7')
+        with tempfile.TemporaryDirectory() as directory:
+            hmr_file = os.path.join(directory, 'L23-L27-wat_hmr.parm7')
+            assert repartition_hydrogen_masses(parm7_file, hmr_file) == 42
+            before, after = read_parm7(parm7_file, ('MASS',))['MASS'], read_parm7(hmr_file, ('MASS',))['MASS']
+            assert sum(after) == pytest.approx(sum(before))
+            assert after[26] == 3.024 and after[0] == pytest.approx(12.01 - 3 * 2.016) and after[-1] == before[-1]
+            # Only the masses are written anew, and a repartitioned topology is not changed again
+            assert read_parm7(hmr_file, ('ATOM_NAME',)) == read_parm7(parm7_file, ('ATOM_NAME',))
+            assert repartition_hydrogen_masses(hmr_file, os.path.join(directory, 'again.parm7')) == 0
+
+            # The topology of the simulations is written once per transformation folder
+            shutil.copy(parm7_file, directory)
+            os.chdir(directory)
+            assert prepare_topology('L23-L27-wat') == 'L23-L27-wat.parm7'
+            os.remove(hmr_file)
+            assert prepare_topology('L23-L27-wat', True) == 'L23-L27-wat_hmr.parm7' and os.path.isfile(hmr_file)
+            os.chdir(get_home_pathway())
+
+        # The equilibrations and the production run with SHAKE and 4 fs for the same time
+        masks = transformation_parameters(':1', ':2', ':1@CW1', ':2@CP1')
+        cntrl = stage_input('ti2p2', None, None, True, **masks)['namelists'][0][1]
+        assert (cntrl['dt'], cntrl['ntc'], cntrl['ntf'], cntrl['nstlim'], cntrl['ntpr']) == (0.004, 2, 2, 178750, 250)
+        modifications = {'09_equi': {'nstlim': Literal('400000')}}
+        assert stage_input('09_equi', modifications, None, True)['namelists'][0][1]['nstlim'] == 100000
+        assert stage_input('06_heat', None, None, True)['namelists'][0][1]['dt'] == 0.001
+        assert stage_input('ti2p2', None, None, False)['namelists'][0][1]['ntc'] == 1
+
+        result = validate_topology(folder, 'L23-L27-wat')
+        assert result['hydrogens'] == 42 and result['hydrogens_repartitioned']
+        assert result['max_residue_mass_change'] < 1e-6 and result['common_mass_difference_after'] == 0
+        inputs = compare_inputs(12)
+        assert all(row['time'] == pytest.approx(row['hmr_time']) for row in inputs['stages'].values())
+        assert inputs['step_ratio'] == pytest.approx((2e6 + 12 * 1215000) / (1.25e6 + 12 * 303750))
+
+        delete_all_data()
+        create_run_summary('my_id', 'MCL1', None, hmr=True)
+        create_run_summary('my_id2', 'MCL1', None)
+        assert get_run_context('my_id')['hmr'] and not get_run_context('my_id2')['hmr']
+        db = get_db()
+        db.execute("INSERT INTO free_energies (result_id, total_free_energy, total_error) VALUES "
+                   "('L21-L36_my_id2', -1.0, 0.3), ('L21-L36_my_id', -1.5, 0.4), ('L21-L38_my_id', 2.0, 0.1)")
+        db.commit()
+        comparison = compare_runs(db, 'my_id2', 'my_id')
+        db.close()
+        assert len(comparison) == 1 and comparison[0]['complex'] == 'L21-L36'
+        assert comparison[0]['difference'] == pytest.approx(-0.5) and comparison[0]['z_score'] == pytest.approx(-1)
+        delete_all_data()
+
     def test_update_job_status(self):
         insert_into_simulations('L21-L36_1_ti1p1_myid', 0)
         update_job_status(2, 'L21-L36_1_ti1p1_myid')
@@ -479,6 +691,119 @@ class TestClass(unittest.TestCase):
         assert db.execute("SELECT error from cycle_closure WHERE cycle_id='cycleid' and ligand = 'L45'").fetchone()[
                    0] < -4
 
+        # Several cycle closures in one call
+        cycle_averaged_data([['aveid', 'aveid1'], ['aveid', 'aveid1']], ['cycleid2', 'cycleid3'], 'L21', -5)
+        assert len(db.execute("SELECT * from cycle_closure").fetchall()) == 12
+        assert db.execute("SELECT no_error, error, convergence_error from cycle_closure WHERE cycle_id='cycleid3' and "
+                          "ligand = 'L45'").fetchone() == db.execute(
+            "SELECT no_error, error, convergence_error from cycle_closure WHERE cycle_id='cycleid' and "
+            "ligand = 'L45'").fetchone()
+        with pytest.raises(ValueError):
+            cycle_averaged_data([['aveid'], ['aveid1']], ['cycleid4'], 'L21', -5)
+
+        # Confidence intervals from Monte-Carlo samples of the pairs
+        cycle_averaged_data(['aveid', 'aveid1'], 'cycleid5', 'L21', -5, samples=2000)
+        assert len(db.execute("SELECT * from cycle_closure_intervals WHERE cycle_id='cycleid5'").fetchall()) == 12
+        mean, std, lower, upper = db.execute("SELECT mean, std, lower, upper from cycle_closure_intervals WHERE "
+                                             "cycle_id='cycleid5' and ligand='L45' and weighting='error'").fetchone()
+        error = db.execute("SELECT error from cycle_closure WHERE cycle_id='cycleid5' and ligand='L45'").fetchone()[0]
+        assert lower < error < upper and abs(mean - error) < 0.1 and 0.2 < std < 0.6
+        assert db.execute("SELECT std from cycle_closure_intervals WHERE cycle_id='cycleid5' and ligand='L21'").fetchone()[
+                   0] == 0
+        db.close()
+
+        # The cycle closure takes arrays as well as DataFrames
+        pairs = np.array([['L21', 'L36', 2.8, 0.565, 0.3375], ['L36', 'L45', 0.85, 0.44, 0.5],
+                          ['L45', 'L21', 0.88, 0.5, 0.45], ['L21', 'L58', 1.85, 0.44, 1], ['L58', 'L36', 0.95, 0.4, 0.4]],
+                         dtype=object)
+        ligands, energies, uncertainties = cycleClosure(pairs, 'L21', -5)
+        frame_ligands, frame_energies, frame_uncertainties = cycleClosure(pd.DataFrame(pairs), 'L21', -5)
+        assert ligands == ['L21', 'L36', 'L45', 'L58'] and uncertainties is None
+        assert np.allclose(energies, frame_energies) and energies[0][0] == -5
+        assert len(cycleClosure(pairs, 'L21', -5, method='lsq')[2]) == 3
+
+    def test_cycle_closure_samples(self):
+        # Random network of 120 ligands and 200 pairs with known energies
+        rng = np.random.default_rng(3)
+        ligands = [f'L{i}' for i in range(120)]
+        energies = rng.normal(0, 2, len(ligands))
+        pairs = [(i, i + 1) for i in range(len(ligands) - 1)]
+        while len(pairs) < 200:
+            i, j = sorted(rng.choice(len(ligands), 2, replace=False))
+            if (i, j) not in pairs:
+                pairs.append((i, j))
+        errors = rng.uniform(0.1, 0.5, len(pairs))
+        data = pd.DataFrame({'ligand_1': [ligands[i] for i, j in pairs], 'ligand_2': [ligands[j] for i, j in pairs],
+                             'energy': [energies[j] - energies[i] + rng.normal(0, error) for (i, j), error in
+                                        zip(pairs, errors)], 'error': errors, 'convergence': rng.uniform(0.1, 1, len(pairs))})
+
+        start = time.time()
+        nodes, samples = cycleClosureSamples(data, 'L0', energies[0], 10000, seed=1)
+        assert time.time() - start < 10
+        assert samples.shape == (3, 10000, 120) and nodes == ligands
+        # The weights of the second scheme are the variances of the pairs, so the spread of the samples is the
+        # covariance of the weighted least squares fit
+        g = Graph(None, data)
+        lsq_ene, lsq_err = CalLig.solveMolEnes(g, 0, energies[0])
+        assert np.allclose(samples[1].std(axis=0), lsq_err[1], rtol=0.05, atol=1e-9)
+        assert np.allclose(samples[1].mean(axis=0), lsq_ene[1], atol=0.05)
+        assert np.all(samples[:, :, 0] == energies[0])
+        with pytest.raises(Exception):
+            CalLig.sampleMolEnes(Graph(None, data[['ligand_1', 'ligand_2', 'energy']]), 0)
+
+    def test_incremental_cycle_closure(self):
+        delete_all_data()
+        db = get_db()
+        rows = [('L21-L36_aveid', 'L21', 'L36', 2.8, 0.565, 0.3375), ('L36-L45_aveid', 'L36', 'L45', 0.85, 0.44, 0.5),
+                ('L45-L21_aveid1', 'L45', 'L21', 0.88, 0.5, 0.45), ('L21-L58_aveid', 'L21', 'L58', 1.85, 0.44, 1),
+                ('L58-L36_aveid1', 'L58', 'L36', 0.95, 0.4, 0.4)]
+        db.executemany("INSERT INTO averaged_free_energies (comb_result_id, ligand_1, ligand_2, total_free_energy_averaged, "
+                       "total_error_averaged, total_convergence_averaged) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        db.commit()
+
+        def cycled(cycle_id):
+            return db.execute("SELECT ligand, no_error, error, convergence_error FROM cycle_closure WHERE cycle_id=? "
+                              "ORDER BY ligand", (cycle_id,)).fetchall()
+
+        # The incremental closure is the weighted least squares fit of Weighted_cc
+        incremental_cycle_data(['aveid', 'aveid1'], 'inc', 'L21', -5)
+        lsq_ene, lsq_err = CalLig.solveMolEnes(Graph(None, [row[1:] for row in rows]), 0, -5)
+        assert np.allclose([row[1:] for row in cycled('inc')], np.array(lsq_ene).T)
+
+        # A new ligand, a new pair between known ligands and a changed pair are updated without a rebuild
+        db.execute("INSERT INTO averaged_free_energies (comb_result_id, ligand_1, ligand_2, total_free_energy_averaged, "
+                   "total_error_averaged, total_convergence_averaged) VALUES ('L58-L60_aveid', 'L58', 'L60', -1.2, 0.3, 0.2)")
+        db.execute("INSERT INTO averaged_free_energies (comb_result_id, ligand_1, ligand_2, total_free_energy_averaged, "
+                   "total_error_averaged, total_convergence_averaged) VALUES ('L45-L60_aveid1', 'L45', 'L60', -2.1, 0.6, 0.7)")
+        db.execute("UPDATE averaged_free_energies SET total_free_energy_averaged=1.1, total_error_averaged=0.3 WHERE "
+                   "comb_result_id='L36-L45_aveid'")
+        db.commit()
+        update_cycle_closure('inc')
+        incremental_cycle_data(['aveid', 'aveid1'], 'full', 'L21', -5)
+        assert len(cycled('inc')) == 5
+        assert np.allclose([row[1:] for row in cycled('inc')], [row[1:] for row in cycled('full')])
+
+        # A removed pair builds the closure again
+        db.execute("DELETE FROM averaged_free_energies WHERE comb_result_id='L45-L60_aveid1'")
+        db.commit()
+        update_cycle_closure('inc')
+        incremental_cycle_data(['aveid', 'aveid1'], 'full', 'L21', -5)
+        assert np.allclose([row[1:] for row in cycled('inc')], [row[1:] for row in cycled('full')])
+        db.close()
+
+        # Many updates of a random network keep the state of a full build
+        rng = np.random.default_rng(5)
+        pairs = {(f'L{i}', f'L{i + 1}'): (rng.normal(), rng.uniform(0.1, 0.5), rng.uniform(0.1, 1)) for i in range(30)}
+        state = build_state('L0', pairs)
+        for step in range(40):
+            i, j = rng.choice(40, 2, replace=False)
+            pairs[(f'L{i}', f'L{j}')] = (rng.normal(), rng.uniform(0.1, 0.5), rng.uniform(0.1, 1))
+            state, updates = update_state(state, pairs)
+        full = build_state('L0', pairs)
+        order = [state['ligands'].index(ligand) for ligand in full['ligands']]
+        assert np.allclose(state_energies(state, 0)[:, order], state_energies(full, 0), atol=1e-9)
+        assert np.allclose(state['covariance'][:, order][:, :, order], full['covariance'], atol=1e-9)
+
     def test_redo_simulation(self):
         delete_all_data()
         insert_into_simulations('L21-L36_1_ti1p1_redo_test', 0)
@@ -601,137 +926,92 @@ class TestClass(unittest.TestCase):
         assert get_protein_name('my_id2') == 'BACE'
 
 
-    def test_modify_run_input(self):
-        run1 = textwrap.dedent(f'''\
-    NVT MD w/No position restraints and PME (sander)
-     &cntrl
-      imin=1,
-      maxcyc=20000,
-      ntmin=2,
-      ntpr   = 1000,
-      ntwx   = 10000,
-      ntwe   = 1000,
-    
-      cut    = 9.0,
-      iwrap=1,
-      nsnb   = 10,
-    
-      ioutfm=1,
-      icfe = 1, 
-      ifsc = 1,
-      timask1=':L21',
-      timask2=':L36',
-      scmask1=':L21@H1,H2,',
-      scmask2=':L36@J5,K6,J3,',
-      clambda=0.5,
-    
-      ntr=1,
-      restraintmask = '!(:WAT,NA,CL)',
-      restraint_wt = 100.0
-    
-    &end
-     &ewald
-       skinnb=2,
-       nfft1=96,
-       nfft2=96,
-       nfft3=96,
-     /
-    ''')
-        correct_run1 = textwrap.dedent(f'''\
-            NVT MD w/No position restraints and PME (sander)
-             &cntrl
-              imin=1,
-              maxcyc=100,
-              ntmin=2,
-              ntpr   = 1000,
-              ntwx   = 10000,
-              ntwe   = 1000,
-
-              cut=10.0,
-              iwrap=2,
-              nsnb   = 10,
-
-              ioutfm=1,
-              icfe = 1, 
-              ifsc = 1,
-              timask1=':L21',
-              timask2=':L36',
-              scmask1=':L21@H1,H2,',
-              scmask2=':L36@J5,K6,J3,',
-              clambda=0.5,
-
-              ntr=1,
-              restraintmask = '!(:WAT,NA,CL)',
-              restraint_wt = 100.0
-
-            &end
-             &ewald
-               skinnb=2,
-               nfft1=96,
-               nfft2=96,
-               nfft3=96,
-             /
-            ''')
+    def test_apply_modifications(self):
+        delete_all_data()
         create_run_summary('my_id', 'MCL1', 'mod_file.in')
-        assert modify_run_input('my_id', run1, 'ti1p1', '01_min').replace(" ", "") == correct_run1.replace(" ", "")
-
-        run2 = textwrap.dedent(f'''\
-           NVT MD w/No position restraints and PME (sander)
-            &cntrl
-             imin=1,
-             maxcyc=20000,
-             ntmin=2,
-             ntpr   = 1000,
-             ntwx   = 10000,
-             ntwe   = 1000,
-             
-           &end
-            &ewald
-              skinnb=2,
-              nfft1=96,
-              nfft2=96,
-              nfft3=96,
-            /
-           ''')
-        correct_run2 = textwrap.dedent(f'''\
-           NVT MD w/No position restraints and PME (sander)
-            &cntrl
-             imin=1,
-             maxcyc=100,
-             ntmin=2,
-             ntpr   = 1000,
-             ntwx   = 10000,
-             ntwe   = 1000,
-             
-             iwrap=2,
-           &end
-            &ewald
-              skinnb=2,
-              nfft1=96,
-              nfft2=96,
-              nfft3=96,
-            /
-           ''')
-        assert modify_run_input('my_id', run2, 'ti1p1', '02_min').replace(" ", "") == correct_run2.replace(" ", "")
-        correct_run3 = textwrap.dedent(f'''\
-                   NVT MD w/No position restraints and PME (sander)
-                    &cntrl
-                     imin=1,
-                     maxcyc=100,
-                     ntmin=2,
-                     ntpr   = 1000,
-                     ntwe   = 1000,
-
-                   &end
-                    &ewald
-                      skinnb=2,
-                      nfft1=96,
-                      nfft2=96,
-                      nfft3=96,
-                    /
-                   ''')
-        assert modify_run_input('my_id', run2, 'ti2p1').replace(" ", "") == correct_run3.replace(" ", "")
+        modifications = get_run_modifications('my_id')
+        masks = transformation_parameters(':L21', ':L36', ':L21@H1,H2', ':L36@J5,K6,J3')
+
+        def changes(stage, **parameters):
+            original = stage_input(stage, **parameters)['namelists'][0][1]
+            modified = stage_input(stage, modifications, **parameters)['namelists'][0][1]
+            return {key: modified.get(key) for key in set(original) | set(modified)
+                    if original.get(key) != modified.get(key)}
+
+        assert changes('01_min', **masks, clambda=0.5) == {'maxcyc': '100', 'cut': '10.0', 'iwrap': '2'}
+        assert changes('02_min') == {'maxcyc': '100', 'iwrap': '2'}
+        assert changes('03_min') == {}
+        assert changes('ti2p1', **masks, clambda=0.5) == {'maxcyc': '100', 'ntwx': None}
+
+        # Changed parameters keep their place, new ones are added at the end of &cntrl
+        text = render_input(stage_input('ti2p1', modifications, **masks, clambda=0.5))
+        assert '  ntwx' not in text and '  maxcyc = 100,\n &end\n' in text
+        text = render_input(stage_input('01_min', modifications, **masks, clambda=0.5))
+        assert text.index('  maxcyc = 100,') < text.index('  cut = 10.0,') < text.index('  iwrap = 2,')
+        delete_all_data()
 
+    def test_mdin(self):
+        delete_all_data()
+        create_run_summary('my_id', 'MCL1', 'mod_file.in')
+        modifications = get_run_modifications('my_id')
+        assert modifications['01_min'] == {'iwrap': '2', 'cut': '10.0', 'maxcyc': '100'}
+        assert modifications['ti2p1'] == {'maxcyc': '100', 'ntwx': 'DELETE'}
+        create_run_summary('my_id2', 'MCL1', None)
+        assert get_run_modifications('my_id2') == {}
+
+        masks = transformation_parameters(':L21', ':L36', ':L21@H1,H2', ':L36@J5,K6,J3')
+        cntrl, ewald = stage_input('01_min', modifications, **masks)['namelists']
+        assert cntrl[1]['maxcyc'] == '100' and cntrl[1]['cut'] == '10.0' and cntrl[1]['restraint_wt'] == 100.0
+        assert cntrl[1]['scmask2'] == ':L36@J5,K6,J3,' and ewald == ('ewald', EWALD)
+        assert stage_input('05_min', modifications)['namelists'][0][1].get('ntr') is None
+        namelists = stage_input('ti2p1', modifications, **masks, clambda=0.00922)
+        assert 'ntwx' not in namelists['namelists'][0][1] and namelists['namelists'][0][1]['maxcyc'] == '100'
+        assert [name for name, _ in stage_input('06_heat')['namelists']] == ['cntrl', 'ewald', 'wt', 'wt', 'wt']
+
+        # Parameters are matched by name, not as text, and may be in any namelist
+        namelists = stage_input('ti2p2', {'ti2p2': {'t': Literal('10.0'), 'nfft1': Literal('64'), 'ntc': 'DELETE'}})
+        cntrl, ewald = (parameters for _, parameters in namelists['namelists'])
+        assert cntrl['t'] == '10.0' and cntrl['irest'] == 0 and 'ntc' not in cntrl and ewald['nfft1'] == '64'
+
+        text = render_input(stage_input('ti2p2', modifications, **masks, clambda=0.00922))
+        assert text.startswith('NVT MD') and "  clambda = 0.00922,\n &end\n &ewald\n" in text
+        assert "  timask1 = ':L21',\n" in text and text.endswith('  nfft3 = 96,\n /\n')
+        extension = extension_input(5000, 0.00922, masks, modifications)
+        assert extension == text.replace('  ntx = 1,', '  ntx = 5,').replace('  irest = 0,', '  irest = 1,') \
+            .replace('  nstlim = 715000,', '  nstlim = 5000,')
+        # With HMR, the steps of the extension are not rescaled again
+        extension = extension_input(5000, 0.00922, masks, modifications, hmr=True)
+        assert '  nstlim = 5000,\n' in extension and '  dt = 0.004,\n' in extension
+        delete_all_data()
+
+    def test_run_context(self):
+        delete_all_data()
+        with tempfile.TemporaryDirectory() as directory:
+            mod_file = os.path.join(directory, 'mod_file.in')
+            with open(mod_file, 'w') as outfile:
+                outfile.write('ti2p1\nmaxcyc=100\n&end\n')
+            create_run_summary('my_id', 'MCL1', mod_file)
+
+            # The run summary is read once per run
+            with patch('database_helper.get_db', wraps=get_db) as mock_get_db:
+                context = get_run_context('my_id')
+                assert get_run_context('my_id') is context
+                assert get_protein_pathway('my_id') == os.path.join(get_home_pathway(), 'MCL1')
+                assert get_run_modifications('my_id') == {'ti2p1': {'maxcyc': '100'}}
+                assert mock_get_db.call_count == 1
+
+            # A changed modification file is read again
+            with open(mod_file, 'w') as outfile:
+                outfile.write('ti2p1\nmaxcyc=200\n&end\n')
+            os.utime(mod_file, (context['modification_time'] + 10, context['modification_time'] + 10))
+            assert get_run_modifications('my_id') == {'ti2p1': {'maxcyc': '200'}}
+
+            # A run created again is loaded again
+            delete_run('my_id')
+            create_run_summary('my_id', 'MCL1', None)
+            assert get_run_context('my_id') is not context
+            assert get_run_modifications('my_id') == {}
+        delete_all_data()
 
     def test_update_run_summary(self):
         delete_all_data()
@@ -763,6 +1043,507 @@ class TestClass(unittest.TestCase):
         create_run_summary('my_id', 'MCL1', None)
         assert get_modification_file('my_id') is None
 
+    def test_extract_dHdl(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'L89-L97_prod_myid_0.out')
+            dvdl = write_synthetic_out(file, 0.00922, 200, t0=500.0)
+            pd.testing.assert_frame_equal(extract_dHdl(file, 300), alchemlyb_extract_dHdl(file, 300))
+            times, parsed_dvdl, header = read_dvdl(file)
+            assert list(parsed_dvdl) == list(dvdl)
+            assert times[0] == 501.0
+            assert header['clambda'] == 0.0092
+            with pytest.raises(ValueError):
+                extract_dHdl(file, 310)
+
+    def test_read_dvdl_since(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'L89-L97_prod_myid_0.out')
+            dvdl = write_synthetic_out(file, 0.5, 100)
+            with open(file, 'rb') as infile:
+                content = infile.read()
+            growing_file = os.path.join(tmpdir, 'L89-L97_prod_myid_1.out')
+            assert read_dvdl_since(growing_file)[1] is None
+
+            parsed_dvdl = []
+            offset, last_nstep = 0, None
+            for cut in (100, len(content) // 3, len(content) // 3 + 7, 2 * len(content) // 3, len(content)):
+                with open(growing_file, 'wb') as outfile:
+                    outfile.write(content[:cut])
+                new_dvdl, header, offset, last_nstep = read_dvdl_since(growing_file, offset, last_nstep)
+                parsed_dvdl.extend(new_dvdl)
+            assert header['clambda'] == 0.5
+            assert parsed_dvdl == list(dvdl)
+
+    def test_early_stopping_targets(self):
+        delete_all_data()
+        create_run_summary('my_id', 'MCL1', None, 0.05, 0.3)
+        create_run_summary('my_id2', 'MCL1', None)
+        assert get_early_stopping_targets('my_id') == (0.05, 0.3)
+        assert get_early_stopping_targets('my_id2') == (None, None)
+        assert targets_reached(0.04, 0.2, 100, 0.05, 0.3, 50)
+        assert not targets_reached(0.06, 0.2, 100, 0.05, 0.3, 50)
+        assert not targets_reached(0.04, 0.4, 100, 0.05, 0.3, 50)
+        assert not targets_reached(0.04, 0.2, 20, 0.05, 0.3, 50)
+        assert targets_reached(0.04, 0.4, 100, 0.05, None, 50)
+        assert not targets_reached(0.04, 0.2, 100, None, None, 50)
+
+    def test_analysis_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                patch('analysis_cache.get_home_pathway', return_value=tmpdir), \
+                patch('analysis_cache.get_analysis_cache_size', return_value=100):
+            file = os.path.join(tmpdir, 'L89-L97_prod_myid_0.out')
+            write_synthetic_out(file, 0.5, 300)
+            pd.testing.assert_frame_equal(analysis_cache.extract_dHdl(file, 300), extract_dHdl(file, 300))
+            decorrelated = analysis_cache.decorrelated_dHdl(file, 300, 10, 50)
+            convergence = analysis_cache.window_convergence(file, 300)
+
+            # Unchanged files are not parsed again
+            with patch('analysis_cache.read_dvdl', side_effect=AssertionError):
+                pd.testing.assert_frame_equal(analysis_cache.extract_dHdl(file, 300), extract_dHdl(file, 300))
+                pd.testing.assert_frame_equal(analysis_cache.decorrelated_dHdl(file, 300, 10, 50), decorrelated)
+                assert analysis_cache.window_convergence(file, 300) == convergence
+                with pytest.raises(ValueError):
+                    analysis_cache.extract_dHdl(file, 310)
+
+            # Changed files are
+            write_synthetic_out(file, 0.5, 300, seed=1)
+            pd.testing.assert_frame_equal(analysis_cache.extract_dHdl(file, 300), extract_dHdl(file, 300))
+
+            db = analysis_cache.get_cache_db()
+            assert db.execute('SELECT COUNT(*) FROM entries').fetchone()[0] == 4
+            analysis_cache.evict(db, 0)
+            assert db.execute('SELECT COUNT(*) FROM entries').fetchone()[0] == 0
+            assert [name for name in os.listdir(analysis_cache.get_cache_dir()) if name.endswith('.npz')] == []
+            db.close()
+
+    def test_batch_analysis(self):
+        delete_all_data()
+        create_run_summary('myid', 'MCL1', None)
+        clambdas = [0.00922, 0.04794, 0.11505, 0.20634, 0.31608, 0.43738, 0.56262, 0.68392, 0.79366, 0.88495,
+                    0.95206, 0.99078]
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                patch('analysis_cache.get_home_pathway', return_value=tmpdir), \
+                patch('analyse_data_after_run.get_result_pathway', side_effect=lambda result_id: os.path.join(
+                    tmpdir, result_id.split('_')[0])), \
+                patch('batch_analysis.get_result_pathway', side_effect=lambda result_id: os.path.join(
+                    tmpdir, result_id.split('_')[0])):
+            for i, clambda in enumerate(clambdas):
+                os.makedirs(os.path.join(tmpdir, 'L89-L97', str(i)))
+                write_synthetic_out(os.path.join(tmpdir, 'L89-L97', str(i), f'L89-L97_prod_myid_{i}.out'), clambda,
+                                    200, seed=i)
+
+            items = analyse_items(['L89-L97_myid', 'L21-L36_myid'])
+            assert items[0]['error'] is None
+            assert len(items[0]['lambdas']) == 11
+            assert len(items[0]['convergences']) == 12
+            assert items[1]['error'] is not None
+            assert len(items[0]['bootstrap']) == bootstrap.N_RESAMPLES
+
+            db = get_db()
+            save_items(db, items)
+            save_items(db, items)
+            assert db.execute("SELECT COUNT(*) FROM lambdas WHERE result_id='L89-L97_myid'").fetchone()[0] == 11
+            assert db.execute("SELECT COUNT(*) FROM convergences WHERE result_id='L89-L97_myid'").fetchone()[0] == 12
+            assert db.execute("SELECT total_free_energy FROM free_energies WHERE result_id='L89-L97_myid'").fetchone()[
+                       0] == items[0]['free_energy'][0]
+            assert db.execute("SELECT error FROM run_info WHERE result_id='L89-L97_myid'").fetchone()[0] == 0
+            assert db.execute("SELECT bootstrap_error FROM free_energies WHERE result_id='L89-L97_myid'").fetchone()[
+                       0] == pytest.approx(np.std(items[0]['bootstrap']))
+            assert db.execute("SELECT error FROM run_info WHERE result_id='L21-L36_myid'").fetchone()[0] == 1
+            db.close()
+            assert report(items) == ['L21-L36_myid']
+
+            folder = os.path.join(tmpdir, 'batch')
+            os.makedirs(folder)
+            with open(os.path.join(folder, 'result_ids.txt'), 'w') as outfile:
+                outfile.write('L89-L97_myid\nL21-L36_myid\n')
+            with open(os.path.join(folder, 'L89-L97_myid.json'), 'w') as outfile:
+                json.dump(items[:1], outfile)
+            collected = collect_items(folder)
+            assert collected[0]['free_energy'] == list(items[0]['free_energy'])
+            assert collected[1]['error'] is not None
+
+            # With a saved schedule, the windows are integrated with its quadrature
+            save_lambda_schedule('myid', 'gaussian', *make_schedule('gaussian', 12))
+            items = analyse_items(['L89-L97_myid'])
+            assert len(items[0]['lambdas']) == 12
+            assert np.isclose(sum(row[1] for row in items[0]['lambdas']), items[0]['free_energy'][0], atol=1e-5)
+
+    def test_redo_error_analysis(self):
+        delete_all_data()
+        create_run_summary('myid', 'MCL1', None)
+        with patch('os.system') as mock_os_system:
+            redo_error_analysis(2)
+        command = mock_os_system.call_args[0][0].split()
+        assert command[2:] == ['-e', '-j', '2']
+
+        # The command line of batch_analysis.py accepts -e without a selection of results
+        command[0] = sys.executable
+        result = subprocess.run(command, capture_output=True, text=True)
+        assert result.returncode == 0, result.stderr
+        assert 'No results to analyse' in result.stdout
+
+        db = get_db()
+        save_run_info(db, 'L89-L97_4_all_myid')
+        db.close()
+        result = subprocess.run(command, capture_output=True, text=True)
+        assert 'Analysing 1 results with 2 processes' in result.stdout
+        assert 'ERROR  L89-L97_myid' in result.stdout
+
+        result = subprocess.run(command[:2], capture_output=True, text=True)
+        assert result.returncode == 2
+        assert 'is required' in result.stderr
+        delete_all_data()
+
+    def test_lambda_schedule(self):
+        lambdas, weights = make_schedule('gaussian', 12)
+        assert list(lambdas) == [0.00922, 0.04794, 0.11505, 0.20634, 0.31608, 0.43738, 0.56262, 0.68392, 0.79366,
+                                 0.88495, 0.95206, 0.99078]
+        lambdas, weights = make_schedule('gaussian', 5)
+        assert np.isclose(quadrature_ti(lambdas ** 9, np.zeros(5), weights)[0], 0.1, atol=1e-4)
+        lambdas, weights = make_schedule('uniform', 5)
+        assert list(lambdas) == [0, 0.25, 0.5, 0.75, 1]
+        assert list(weights) == [0.125, 0.25, 0.25, 0.25, 0.125]
+        with pytest.raises(ValueError):
+            make_schedule('gaussian', 1)
+        with pytest.raises(ValueError):
+            make_schedule('simpson', 5)
+
+        samples = [np.random.default_rng(i).normal(i, 1, 50 + i) for i in range(5)]
+        means, variances = window_statistics(samples)
+        assert np.allclose(means, [sample.mean() for sample in samples])
+        assert np.allclose(variances, [sample.var(ddof=1) / len(sample) for sample in samples])
+        means, errors = quadrature_ti(np.array([means, 2 * means]), np.array([variances, 4 * variances]), weights)
+        assert np.allclose(means[1], 2 * means[0]) and np.allclose(errors[1], 2 * errors[0])
+
+        dhdl = [pd.DataFrame({'dHdl': sample}) for sample in samples]
+        summary = quadrature_summary(dhdl, weights, 300)
+        assert len(summary) == 7
+        assert np.isclose(summary['TI'].iloc[:5].sum(), summary.loc[('Stages', 'TOTAL'), 'TI'])
+        with pytest.raises(ValueError):
+            quadrature_summary(dhdl[:4], weights, 300)
+
+        delete_all_data()
+        create_run_summary('my_id', 'MCL1', None)
+        assert get_lambda_schedule('my_id')[0] is None
+        assert len(get_lambda_schedule('my_id')[1]) == 12
+        save_lambda_schedule('my_id', 'uniform', *make_schedule('uniform', 5))
+        assert get_lambda_schedule('my_id') == ('uniform', [0, 0.25, 0.5, 0.75, 1],
+                                                [0.125, 0.25, 0.25, 0.25, 0.125])
+
+    def test_run_workflow(self):
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                patch('analysis_cache.get_home_pathway', return_value=tmpdir), \
+                patch('analysis_cache.get_analysis_cache_size', return_value=100):
+            directory = os.path.join(tmpdir, 'L89-L97')
+            clambdas = [0.0, 0.25, 0.5, 0.75, 1.0]
+            for i, clambda in enumerate(clambdas):
+                os.makedirs(os.path.join(directory, str(i)))
+                write_synthetic_out(os.path.join(directory, str(i), f'L89-L97_prod_myid_{i}.out'), clambda, 200,
+                                    seed=i)
+            weights = [0.125, 0.25, 0.25, 0.25, 0.125]
+            with patch('analysis_workflow.window_dHdl', wraps=analysis_cache.window_dHdl) as mock_window_dHdl:
+                summary = run_workflow(directory, 'L89-L97_prod_myid', weights=weights)
+            assert mock_window_dHdl.call_count == 5
+            assert len(summary) == 7
+            assert np.isclose(summary.loc[('Stages', 'TOTAL'), 'TI'], summary['TI'].iloc[:5].sum())
+
+            # The extension segment of a window is analysed with its production
+            write_synthetic_out(os.path.join(directory, '0', 'L89-L97_ext_myid_0.out'), 0.0, 200, t0=1200.0, seed=9)
+            extended = run_workflow(directory, 'L89-L97_prod_myid', weights=weights)
+            assert extended.loc[('States', '0'), 'TI'] != summary.loc[('States', '0'), 'TI']
+            assert extended.loc[('States', '1'), 'TI'] == summary.loc[('States', '1'), 'TI']
+
+    def test_adaptive_sampling(self):
+        from pymbar.timeseries import statistical_inefficiency as pymbar_statistical_inefficiency
+        rng = np.random.default_rng(0)
+        x = np.zeros(2000)
+        for i in range(1, len(x)):
+            x[i] = 0.9 * x[i - 1] + rng.normal()
+        variance, g, effective_samples, error = window_variance_statistics(x)
+        assert g == pymbar_statistical_inefficiency(x) and np.isclose(effective_samples, len(x) / g)
+        assert np.isclose(error, np.sqrt(np.var(x, ddof=1) * g / len(x)))
+        assert window_variance_statistics(np.ones(100))[1] == 1
+        assert bootstrap.block_length(x) == np.ceil(bootstrap.BLOCK_FACTOR * g)
+        assert bootstrap.block_length(np.ones(100)) == bootstrap.BLOCK_FACTOR
+
+        extensions = allocate_extensions([1, 4, 0.1, 2], 1000, 4000, 100)
+        assert extensions.sum() <= 4000 and extensions.sum() > 3600
+        assert extensions[2] == 0 and extensions[1] > extensions[3] > extensions[0]
+        assert list(allocate_extensions([0, 0], 1000, 2000)) == [1000, 1000]
+
+
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                patch('analysis_cache.get_home_pathway', return_value=tmpdir), \
+                patch('analysis_cache.get_analysis_cache_size', return_value=100):
+            file = os.path.join(tmpdir, 'L89-L97_prod_myid_0.out')
+            write_synthetic_out(file, 0.5, 300)
+            assert len(analysis_cache.window_dHdl(file, 300)) == 300
+            write_synthetic_out(os.path.join(tmpdir, 'L89-L97_ext_myid_0.out'), 0.5, 200, t0=1300.0, seed=1)
+            dhdl = analysis_cache.window_dHdl(file, 300)
+            assert len(dhdl) == 500
+            assert dhdl.index.get_level_values('time').is_monotonic_increasing
+            assert dhdl.attrs['temperature'] == 300
+            assert analysis_cache.decorrelated_dHdl(file, 300).index.get_level_values('time').max() == 1500
+
+    def test_lambda_planner(self):
+        clambdas, weights = make_schedule('gaussian', 12)
+        lambdas, plan_weights, error = plan_schedule([(clambdas, 2 + 3 * clambdas, np.full(12, 0.1))], 7)
+        assert np.allclose(lambdas, make_schedule('gaussian', 7)[0])
+        assert np.allclose(plan_weights, make_schedule('gaussian', 7)[1])
+
+        curve = (clambdas, 40 * np.exp(-clambdas / 0.05) - 5 * clambdas, np.full(12, 0.05))
+        lambdas, plan_weights, error = plan_schedule([curve], 5)
+        x, f, sigma = combine_curves([curve])
+        assert error < expected_error(x, f, sigma, *make_schedule('gaussian', 5))
+        assert np.isclose(plan_weights.sum(), 1, atol=0.01) and np.all(np.diff(lambdas) > 0)
+        assert lambdas[1] - lambdas[0] < lambdas[-1] - lambdas[-2]
+
+        delete_all_data()
+        create_run_summary('myid', 'MCL1', None)
+        create_run_summary('myid2', 'MCL1', None)
+        save_lambda_schedule('myid2', 'uniform', *make_schedule('uniform', 5))
+        db = get_db()
+        db.executemany('INSERT INTO lambdas (result_id, lambda, lambda_result, error) VALUES (?, ?, ?, ?)',
+                       [('L89-L97_myid', i, 0.5 * (clambdas[i + 1] - clambdas[i]), 0.01) for i in range(11)] +
+                       [('L89-L97_myid2', i, 0.25, 0.01) for i in range(5)])
+        lambdas, means, errors = read_result_curve(db, 'L89-L97_myid')
+        assert np.allclose(lambdas, (clambdas[1:] + clambdas[:-1]) / 2) and np.allclose(means, 0.5)
+        lambdas, means, errors = read_result_curve(db, 'L89-L97_myid2')
+        assert list(lambdas) == [0, 0.25, 0.5, 0.75, 1] and list(means) == [2, 1, 1, 1, 2]
+        with pytest.raises(ValueError):
+            read_result_curve(db, 'L21-L36_myid')
+        db.close()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'plan.json')
+            with open(file, 'w') as outfile:
+                json.dump({'lambdas': [0.1, 0.5, 0.9], 'weights': [0.3, 0.4, 0.3]}, outfile)
+            assert read_lambda_plan(file) == ([0.1, 0.5, 0.9], [0.3, 0.4, 0.3])
+            with open(file, 'w') as outfile:
+                json.dump({'lambdas': [0.5, 0.1, 0.9], 'weights': [0.3, 0.4, 0.3]}, outfile)
+            with pytest.raises(ValueError):
+                read_lambda_plan(file)
+
+    def test_network_planner(self):
+        pairs = {('A', 'B'): (1.0, 0.3, 0.2), ('B', 'C'): (0.5, 0.4, 0.3), ('C', 'D'): (-0.2, 0.3, 0.1),
+                 ('E', 'F'): (0.1, 0.2, 0.1)}
+        candidates = [('A', 'C'), ('A', 'D'), ('D', 'G'), ('B', 'C'), ('D', 'E')]
+        ligands, covariance = network_covariance('A', pairs, [ligand for pair in candidates for ligand in pair], 5.0)
+        assert ligands == ['A', 'B', 'C', 'D', 'E', 'F', 'G'] and covariance[0, 0] == 0
+        assert np.allclose(np.diag(covariance)[4:], 25) and covariance[4, 5] == 0
+
+        # The predicted reduction is the one of the closure with the pair added
+        picked = plan_network(ligands, covariance, candidates, np.full(5, 0.3), np.full(5, 10.0), 10)
+        assert len(picked) == 1
+        best, reduction, variance = picked[0]
+        assert candidates[best] in [('D', 'G'), ('D', 'E')]
+        picked = plan_network(ligands[:4], covariance[:4, :4], candidates[:2], np.full(2, 0.3), np.full(2, 10.0), 30)
+        assert [best for best, _, _ in picked] == [1, 0]
+        added = dict(pairs)
+        del added[('E', 'F')]
+        added[('A', 'D')] = (0.0, 0.3, 0.1)
+        assert np.isclose(picked[0][2], np.trace(build_state('A', added)['covariance'][1]))
+        assert np.isclose(picked[0][1], np.trace(covariance[:4, :4]) - picked[0][2])
+
+        # A cheaper candidate is picked first if its reduction per GPU hour is larger
+        picked = plan_network(ligands[:4], covariance[:4, :4], candidates[:2], np.full(2, 0.3), np.array([1, 15.0]), 30)
+        assert [best for best, _, _ in picked] == [0, 1]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'candidates.txt')
+            with open(file, 'w') as outfile:
+                outfile.write('A-C\nA D 0.8\n# comment\nD-G 0.2\nB-C 0.5 12\n')
+            assert read_candidates(file, 24, 0.4) == [('A', 'C', 1.0, 24), ('A', 'D', 0.8, 24), ('B', 'C', 0.5, 12)]
+            with open(file, 'w') as outfile:
+                outfile.write('#    Index_1   Index_2   Filename_1   Filename_2   Str_sim   Eff_sim   Loose_sim   Connect\n'
+                              '      0         1         L21.mol2     L36.mol2     0.905     0.805     0.905       Yes\n'
+                              '      0         2         L21.mol2     L45.mol2     0.305     0.305     0.605       No\n')
+            assert read_candidates(file, 24, 0.4) == [('L21', 'L36', 0.805, 24)]
+
+    def test_bootstrap(self):
+        rng = np.random.default_rng(0)
+        windows = [rng.normal(i, 1 + i, 1000 + 100 * i) for i in range(5)]
+        weights = np.array([0.1, 0.2, 0.4, 0.2, 0.1])
+        resamples = bootstrap.block_bootstrap(windows, weights, 4000, [1] * 5, seed=1)
+        analytical = np.sqrt(np.sum([(w * np.std(x, ddof=1)) ** 2 / len(x) for w, x in zip(weights, windows)]))
+        assert np.isclose(np.std(resamples), analytical, rtol=0.05)
+        assert np.isclose(np.mean(resamples), weights @ [np.mean(x) for x in windows], atol=analytical / 10)
+
+        # Resamples drawn in several chunks are the same as drawn at once
+        resamples = bootstrap.block_bootstrap(windows, weights, 100, [3] * 5, seed=1)
+        with patch('bootstrap.MAX_BLOCKS', 5000):
+            assert np.array_equal(bootstrap.block_bootstrap(windows, weights, 100, [3] * 5, seed=1), resamples)
+
+        x = np.zeros(5000)
+        for i in range(1, len(x)):
+            x[i] = 0.8 * x[i - 1] + rng.normal()
+        assert bootstrap.block_length(x) > 20
+        assert np.std(bootstrap.block_bootstrap([x], [1], 1000, seed=2)) > 2.5 * np.std(x) / np.sqrt(len(x))
+
+        delete_all_data()
+        db = get_db()
+        for result_id, ligand_1, ligand_2, is_wat, scale in [('L21-L36_myid', 'L21', 'L36', 0, 0.3),
+                                                              ('L21-L36-wat_myid', 'L21', 'L36', 1, 0.4),
+                                                              ('L21-L36_myid2', 'L21', 'L36', 0, 0.3),
+                                                              ('L21-L36-wat_myid2', 'L21', 'L36', 1, 0.4)]:
+            db.execute('''INSERT INTO run_info (result_id, error, simulation_datetime, ligand_1, ligand_2, is_wat,
+                          run_name) VALUES (?, 0, '2020-01-01 00:00:00', ?, ?, ?, ?)''',
+                       (result_id, ligand_1, ligand_2, is_wat, result_id.split('_')[1]))
+            db.execute('''INSERT INTO free_energies (result_id, total_free_energy, total_error, total_convergence)
+                          VALUES (?, 1, ?, 0.1)''', (result_id, scale))
+            db.execute('''INSERT INTO bootstrap_samples (result_id, deviations) VALUES (?, ?)''',
+                       (result_id, rng.normal(0, scale, 20000).tobytes()))
+        db.commit()
+        make_averaged_energies(['myid', 'myid2'], 'aveid')
+        error, bootstrap_error = db.execute('''SELECT total_error_averaged, bootstrap_error_averaged
+                                               FROM averaged_free_energies''').fetchone()
+        assert np.isclose(error, 0.5)
+        assert np.isclose(bootstrap_error, 0.5 / np.sqrt(2), rtol=0.02)
+        db.close()
+
+    def test_benchmark_weighted_cc(self):
+        pairs, energies = make_network('ring', 12, seed=1)
+        assert len(pairs) == 12 and len(energies) == 12 and pairs[-1][:2] == ['L11', 'L0']
+        assert len(make_network('star', 12)[0]) == 11 and len(make_network('random', 20, 0.5)[0]) == 29
+        with pytest.raises(ValueError):
+            make_network('tree', 12)
+
+        result = benchmark_network(*make_network('random', 40, seed=2))
+        assert result['edges'] == 59 and result['cycles'] >= 20
+        assert np.allclose(result['closure_rmse'], result['lsq_rmse'], atol=0.01)
+        assert max(result['lsq_rmse']) < 1 and result['mean_path_error'] > 0
+        assert benchmark_network(*make_network('star', 10))['cycles'] == 0
+
+    def test_cycle_basis(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Complete graph of 4 ligands: 3 independent cycles, 4 triangles and 3 squares
+            file = os.path.join(tmpdir, 'k4.csv')
+            with open(file, 'w') as outfile:
+                outfile.write('A B 1\nA C 2\nA D 3\nB C 1\nB D 2\nC D 1\n')
+            g = Graph(file)
+            assert len(g.getCycleBasis()) == 3
+            assert sorted(len(cycle) for cycle in g.getShortCycles(6)) == [4] * 4 + [5] * 3
+            assert len(g.getShortCycles(3)) == 4
+            g.getCycles(6)
+            assert len(g.cycles) == 7
+
+            # Ring of 300 ligands with chords: the cycles are found and closed without enumerating all of them
+            ring, chords = 300, 60
+            rng = np.random.default_rng(0)
+            file = os.path.join(tmpdir, 'ring.csv')
+            with open(file, 'w') as outfile:
+                for i in range(ring):
+                    outfile.write(f'L{i} L{(i + 1) % ring} {rng.normal(0, 0.5):.3f} 0.3\n')
+                for i in range(chords):
+                    outfile.write(f'L{5 * i} L{(5 * i + 17) % ring} {rng.normal(0, 0.5):.3f} 0.3\n')
+            g = Graph(file)
+            basis = g.getCycleBasis()
+            assert len(basis) == chords + 1
+            for cycle in basis:
+                assert cycle[0] == cycle[-1] and len(set(cycle)) == len(cycle) - 1
+                assert all(mol2 in g.graph[mol1] for mol1, mol2 in zip(cycle, cycle[1:]))
+            g.getCycles(0)
+            assert len(g.cycles) == len(basis)
+            g.iterateCycleClosure(minimum_cycles=2)
+            # The iterations stop when no edge changes by more than 0.001, long cycles keep a small part of the error
+            for cycle in basis:
+                assert abs(g.getDelta(0, cycle)[0]) < 0.1
+
+    def test_cycle_closure_energies(self):
+        # closed energies of the pairs, as given by the Decimal implementation of Weighted_cc
+        expected = {('A', 'B'): [1.2, 1.1486, 1.3984], ('A', 'C'): [2.53, 2.5244, 2.4928],
+                    ('A', 'D'): [3.0701, 3.0862, 3.0327], ('B', 'C'): [1.33, 1.3756, 1.0946],
+                    ('B', 'D'): [1.87, 1.9374, 1.6345], ('C', 'D'): [0.54, 0.5618, 0.5399],
+                    ('D', 'E'): [-1.22, -1.0924, -1.1584], ('E', 'C'): [0.68, 0.5305, 0.6185]}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'pairs.csv')
+            with open(file, 'w') as outfile:
+                outfile.write('A B 1.2 0.3 0.5\nA C 2.5 0.2 0.4\nA D 3.1 0.6 0.3\nB C 1.0 0.4 0.2\n'
+                              'B D 2.2 0.3 0.6\nC D 0.4 0.5 0.5\nD E -1.0 0.2 0.3\nE C 0.9 0.4 0.4\n')
+            g = Graph(file)
+            g.getCycles(6)
+            g.iterateCycleClosure(minimum_cycles=2)
+        assert g.weight_num == 3 and g.ddG_cc.dtype == np.float64
+        for (mol1, mol2), energies in expected.items():
+            energy = [g.getEnergy(n, g.nodeIndex[mol1], g.nodeIndex[mol2]) for n in range(3)]
+            assert np.allclose(energy, energies, atol=0.002)
+            assert np.allclose([g.getEnergy(n, g.nodeIndex[mol2], g.nodeIndex[mol1]) for n in range(3)],
+                               -np.array(energy))
+
+        # The least squares solution is the limit of the iterated closure
+        node_map = CalLig.set_node_map(g)
+        path_dependent_error, path = CalLig.cal_node_path_dependent_error(0, g.V, node_map)
+        mol_ene = CalLig.calcMolEnes(-5.0, g, path)
+        lsq_ene, lsq_err = CalLig.solveMolEnes(g, 0, -5.0)
+        assert np.allclose(lsq_ene, mol_ene, atol=0.002)
+        assert np.all(np.array(lsq_err)[:, 1:] > 0) and np.all(np.array(lsq_err)[:, 0] == 0)
+        # With unit weights the covariance is scaled by the variance of the residuals
+        assert np.isclose(lsq_err[0][g.nodeIndex['B']], 0.2049, atol=0.0001)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'cycled.csv')
+            CalLig.outputMol(g.V, lsq_ene, file, lsq_err)
+            cycled = pd.read_csv(file)
+            assert list(cycled.columns[-3:]) == ['Uncertainty_no_error', 'Uncertainty_with_error1',
+                                                 'Uncertainty_with_error2']
+            assert np.allclose(cycled['Cycled_with_error1'], lsq_ene[1])
+
+            file = os.path.join(tmpdir, 'disconnected.csv')
+            with open(file, 'w') as outfile:
+                outfile.write('A B 1.2\nB C 2.5\nC A -3.5\nD E 1.0\n')
+            with pytest.raises(Exception):
+                CalLig.solveMolEnes(Graph(file), 0)
+
+        # All weight schemes are closed together, every scheme as if it were closed alone
+        pairs = [[mol1, mol2, energy, error, convergence, error, convergence, 1.0] for mol1, mol2, energy, error, convergence
+                 in [('A', 'B', 1.2, 0.3, 0.5), ('A', 'C', 2.5, 0.2, 0.4), ('A', 'D', 3.1, 0.6, 0.3), ('B', 'C', 1.0, 0.4, 0.2),
+                     ('B', 'D', 2.2, 0.3, 0.6), ('C', 'D', 0.4, 0.5, 0.5), ('D', 'E', -1.0, 0.2, 0.3),
+                     ('E', 'C', 0.9, 0.4, 0.4)]]
+        batched = Graph(None, pairs)
+        batched.getCycles(6)
+        batched.iterateCycleClosure(minimum_cycles=2)
+        assert batched.weight_num == 6
+        assert np.allclose(batched.ddG_cc[3:5], g.ddG_cc[1:3]) and np.allclose(batched.ddG_cc[5], g.ddG_cc[0])
+        assert np.allclose(batched.err, g.err)
+
+    def test_path_dependent_errors(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'pairs.csv')
+            with open(file, 'w') as outfile:
+                outfile.write('A B 1.2 0.3\nA C 2.5 0.2\nA D 3.1 0.6\nB C 1.0 0.4\nB D 2.2 0.3\nD E -1.0 0.2\n'
+                              'E C 0.9 0.4\nF G 0.5 0.1\n')
+            g = Graph(file)
+        # pair errors of the input, without the cycle closure
+        g.nodelist = [[g.V[i], g.V[j], g.err[edge]] for edge, (i, j) in enumerate(g.edges)]
+        node_map = CalLig.set_node_map(g)
+        assert node_map[g.nodeIndex['A']] == {g.nodeIndex['B']: pytest.approx(0.09), g.nodeIndex['C']: pytest.approx(0.04),
+                                              g.nodeIndex['D']: pytest.approx(0.36)}
+        assert np.allclose(CalLig.cal_node_path_independent_error(g.V, node_map)[:3], [0.36, 0.16, 0.16])
+
+        dist, path = CalLig.cal_node_path_dependent_error(g.nodeIndex['A'], g.V, node_map)
+        # A-B-D is more precise than the pair A-D
+        assert np.isclose(dist[g.nodeIndex['D']], 0.18)
+        assert [g.V[i] for i in path[g.nodeIndex['D']]] == ['D', 'B', 'A']
+        assert [g.V[i] for i in path[g.nodeIndex['E']]] == ['E', 'C', 'A']
+        # F and G are not connected to A
+        assert dist[g.nodeIndex['F']] == np.inf and path[g.nodeIndex['F']] is None
+        assert np.isnan(CalLig.calcMolEnes(0.0, g, path)[0][g.nodeIndex['F']])
+
+        ref_errors = CalLig.cal_reference_errors(g.V[:5], [{j: val for j, val in neighbours.items() if j < 5}
+                                                         for neighbours in node_map[:5]])
+        assert len(ref_errors) == 5
+        assert [rms_error for ref, rms_error, max_error in ref_errors] == sorted(rms_error for ref, rms_error, max_error
+                                                                                 in ref_errors)
+        ref, rms_error, max_error = [ref_error for ref_error in ref_errors if ref_error[0] == 'A'][0]
+        assert np.isclose(rms_error, np.sqrt((0.09 + 0.04 + 0.18 + 0.2) / 4))
+        assert np.isclose(max_error, np.sqrt(0.2))
+
+        # The reference errors need the pair errors of the iterative closure
+        assert optParser(['-f', 'pairs.txt', '-a', 'refs.txt']).option.ref_errors == 'refs.txt'
+        with pytest.raises(SystemExit):
+            optParser(['-f', 'pairs.txt', '-m', 'lsq', '-a', 'refs.txt'])
+
 
 if __name__ == '__main__':
     globals()[sys.argv[1]](*sys.argv[2:])
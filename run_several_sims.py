@@ -4,10 +4,14 @@
 to be queued for execution."""
 
 import argparse
+import json
 import os
 
-from database_helper import insert_into_simulations, create_run_summary, run_name_exists
-from settings_helper import get_amberti_path
+from database_helper import insert_into_simulations, create_run_summary, run_name_exists, save_lambda_schedule
+from lambda_schedule import make_schedule, SCHEDULE_KINDS
+from parm7 import check_transformation_folder
+from settings_helper import get_amberti_path, get_home_pathway
+from simulation_id_helper import get_complex_name, get_ligand_one
 
 
 def get_all_lines_stripped(file):
@@ -81,6 +85,66 @@ def write_to_file(simulation_ids, mode, wat=False):
             insert_into_simulations(simulation_id_wat, is_gpu)
 
 
+def check_masks(simulation_ids, protein_pathway, wat=False):
+    """Check the TI masks of the transformations against their topologies before they are queued.
+
+    Parameters
+    ----------
+    simulation_ids : list of str
+        List of simulation IDs to add.
+    protein_pathway : str
+        Pathway to the protein folder.
+    wat : bool
+        Whether the water simulations are in the list explicitly (otherwise they are checked with their complex).
+
+    Returns
+    -------
+    list of str
+        Problems of the transformations, empty if all of them can be run.
+
+    """
+    complex_names = {}
+    for simulation_id in simulation_ids:
+        complex_name = get_complex_name(simulation_id)
+        complex_names[complex_name] = get_ligand_one(simulation_id)
+        if not wat:
+            complex_names[f'{complex_name}-wat'] = get_ligand_one(simulation_id)
+
+    problems = []
+    for complex_name, ligand in complex_names.items():
+        folder = os.path.join(protein_pathway, ligand, complex_name)
+        problems += [f'{complex_name}: {problem}' for problem in check_transformation_folder(folder, complex_name)]
+    return problems
+
+
+def read_lambda_plan(file):
+    """Read the lambda values and weights of a schedule planned by lambda_planner.py.
+
+    Parameters
+    ----------
+    file : str
+        Path to the JSON file of the plan.
+
+    Returns
+    -------
+    tuple of (list, list)
+        Lambda values and the quadrature weights of the windows.
+
+    Raises
+    ------
+    ValueError
+        If the lambda values are not increasing values between 0 and 1 or do not match the weights.
+    """
+    with open(file, 'r') as infile:
+        plan = json.load(infile)
+    lambdas, weights = plan['lambdas'], plan['weights']
+    if len(lambdas) < 2 or len(lambdas) != len(weights):
+        raise ValueError(f'The lambda plan has {len(lambdas)} lambda values and {len(weights)} weights')
+    if any(not 0 <= clambda <= 1 for clambda in lambdas) or any(a >= b for a, b in zip(lambdas, lambdas[1:])):
+        raise ValueError('The lambda values of the plan have to increase from 0 to 1')
+    return lambdas, weights
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='This script gives input for ti1slow and ti2 scripts')
     parser.add_argument('-i', '--input', help="File with list of ligand combinations to run simulations at. "
@@ -93,12 +157,29 @@ if __name__ == '__main__':
     parser.add_argument('--wat', help="Have water simulatoins in the file explicitly", action='store_true')
     parser.add_argument('-d', '--modification', help="Modification of the run", required=False)
     parser.add_argument('-p', '--protein', help="Protein name", required=True)
+    parser.add_argument('--target_error', help="Stop a production window early once the error of its mean dV/dl "
+                                               "(kcal/mol) is below this value", type=float, required=False)
+    parser.add_argument('--target_convergence', help="Also require the forward/reverse convergence (R_c) of the "
+                                                     "window to be below this value before stopping it early",
+                        type=float, required=False)
+    parser.add_argument('--lambda_schedule', help="Kind of the lambda schedule", choices=SCHEDULE_KINDS,
+                        default='gaussian')
+    parser.add_argument('--lambda_windows', help="Number of lambda windows", type=int, default=12)
+    parser.add_argument('--lambda_plan', help="JSON file with the lambda schedule planned by lambda_planner.py, "
+                                              "replaces --lambda_schedule and --lambda_windows", required=False)
+    parser.add_argument('--hmr', help="Repartition the hydrogen masses and run the equilibrations and the "
+                                      "production with SHAKE and a 4 fs time step", action='store_true')
+    parser.add_argument('--pilot_fraction', help="Run this fraction of the production of every window first and "
+                                                 "distribute the rest according to the errors of the windows",
+                        type=float, required=False)
 
     args = parser.parse_args()
     mode = args.mode
     run_name = args.run_name
     modification = args.modification
     protein = args.protein
+    target_error = args.target_error
+    target_convergence = args.target_convergence
 
     # Check if the run name is already in the database and modification file exists and that the protein folder exists
     if run_name_exists(run_name):
@@ -110,6 +191,28 @@ if __name__ == '__main__':
     if not os.path.isdir(os.path.join(get_amberti_path(), protein)):
         print("Protein folder does not exist")
         exit(1)
+    if target_convergence is not None and target_error is None:
+        print("Target convergence can only be used together with target error")
+        exit(1)
+    if args.pilot_fraction is not None and not 0 < args.pilot_fraction < 1:
+        print("Pilot fraction has to be between 0 and 1")
+        exit(1)
+    if args.pilot_fraction is not None and target_error is not None:
+        print("Adaptive sampling cannot be used together with early stopping")
+        exit(1)
+    if args.lambda_plan is not None and not os.path.isfile(args.lambda_plan):
+        print("Lambda plan does not exist")
+        exit(1)
+    try:
+        if args.lambda_plan is not None:
+            schedule = 'adaptive'
+            lambdas, weights = read_lambda_plan(args.lambda_plan)
+        else:
+            schedule = args.lambda_schedule
+            lambdas, weights = make_schedule(args.lambda_schedule, args.lambda_windows)
+    except ValueError as error:
+        print(error)
+        exit(1)
 
 
 
@@ -117,11 +220,20 @@ if __name__ == '__main__':
     lines = get_all_lines_stripped(args.input)
     simulation_ids = convert_lines_to_modes(lines, mode, run_name)
 
+    # Check the masks before anything is queued, so that no job fails on them in the queue
+    problems = check_masks(simulation_ids, os.path.join(get_home_pathway(), protein), args.wat)
+    if problems:
+        print("The following transformations can not be queued:")
+        print('\n'.join(problems))
+        exit(1)
+
     # Put simulation IDs into the database
     write_to_file(simulation_ids, mode, args.wat)
 
     # Write to the run_summary table
-    create_run_summary(run_name, protein, modification)
+    create_run_summary(run_name, protein, modification, target_error, target_convergence, args.pilot_fraction,
+                       args.hmr)
+    save_lambda_schedule(run_name, schedule, lambdas, weights)
 
     # Check the queue and run simulations
     os.system(f'python3 {os.path.join(get_amberti_path(), "check_queue.py")}')
@@ -1,15 +1,100 @@
 #!/bin/python3
 
 """Helper functions for reading and modifying settings from the
-settings file."""
+settings file.
+
+The settings file is parsed once into a Settings object, which is kept
+for the rest of the process and parsed again only when the file (or
+the saved path to it) changes, so that e.g. max_GPUs can be changed
+while the scheduler is running."""
 import re
 import os
 import sys
+from typing import NamedTuple
 
 
 # settings_path = os.path.join('~', '.ti_sim.config')
 settings_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '.ti_sim.config')
 
+# Settings that have to be in the settings file
+REQUIRED_SETTINGS = ('home_pathway', 'GPU_setting', 'CPU_setting', 'environment', 'max_CPUs', 'max_GPUs')
+
+# Parsed settings files and saved settings path, with the state of the file they were read from
+SETTINGS_CACHE = {}
+
+
+class Settings(NamedTuple):
+    """Parsed settings file."""
+    home_pathway: str
+    gpu_setting: str
+    cpu_setting: str
+    environment: str
+    max_gpus: int
+    max_cpus: int
+    max_analyses: int
+    analysis_setting: str
+    analysis_cache_size: int
+
+
+def file_state(path):
+    """Get the modification time and the size of a file, which tell if it was changed."""
+    status = os.stat(path)
+    return status.st_mtime_ns, status.st_size
+
+
+def parse_settings(data):
+    """Parse the text of a settings file.
+
+    Parameters
+    ----------
+    data : str
+        Text of the settings file, with the settings as name="value".
+
+    Returns
+    -------
+    Settings
+        The settings, with the defaults of the optional ones.
+
+    Raises
+    ------
+    ValueError
+        If a required setting is missing or a number of jobs or the cache size is not a non-negative integer.
+
+    """
+    values = dict(re.findall(r'(\w+)="(.*?)"', data, re.DOTALL))
+    missing = [name for name in REQUIRED_SETTINGS if name not in values]
+    if missing:
+        raise ValueError(f'The settings file has no {", ".join(missing)}')
+
+    def count(name, default):
+        value = values.get(name, default)
+        try:
+            value = int(value)
+        except ValueError:
+            raise ValueError(f'{name} has to be an integer, not "{value}"')
+        if value < 0:
+            raise ValueError(f'{name} can not be negative')
+        return value
+
+    max_cpus = count('max_CPUs', None)
+    return Settings(home_pathway=values['home_pathway'], gpu_setting=values['GPU_setting'],
+                    cpu_setting=values['CPU_setting'], environment=values['environment'],
+                    max_gpus=count('max_GPUs', None), max_cpus=max_cpus,
+                    max_analyses=count('max_analyses', max_cpus),
+                    analysis_setting=values.get('analysis_setting', values['CPU_setting']),
+                    analysis_cache_size=count('analysis_cache_size', 2000))
+
+
+def get_settings():
+    """Get the parsed settings file, parsed again only if it was changed since it was last read."""
+    path = get_settings_path()
+    state = file_state(path)
+    cached = SETTINGS_CACHE.get(path)
+    if cached is None or cached[0] != state:
+        cached = SETTINGS_CACHE[path] = (state, parse_settings(get_settings_data()))
+    return cached[1]
+
+
 def set_settings_path(path):
     """Save the settings file path.
 
@@ -32,8 +117,11 @@ def set_settings_path(path):
         data = file.read()
 
         # Check if the settings file has all the data it should have
-        if 'home_pathway=' not in data or 'GPU_setting=' not in data or 'CPU_setting=' not in data or 'environment=' not in data or 'max_CPUs=' not in data or 'max_GPUs=' not in data:
-            print("ERROR: The settings file is not in the correct format. Please check the README for more information.")
+        try:
+            parse_settings(data)
+        except ValueError as error:
+            print(f"ERROR: The settings file is not in the correct format ({error}). Please check the README for more "
+                  f"information.")
             exit(1)
 
     print("Settings path set to: %s" % path)
@@ -41,9 +129,12 @@ def set_settings_path(path):
 
 def get_settings_path():
     """Get the saved path to the settings file."""
-    with open(settings_path, 'r') as file:
-        path = file.read()
-    return path
+    state = file_state(settings_path)
+    cached = SETTINGS_CACHE.get(settings_path)
+    if cached is None or cached[0] != state:
+        with open(settings_path, 'r') as file:
+            cached = SETTINGS_CACHE[settings_path] = (state, file.read())
+    return cached[1]
 
 
 def get_settings_data():
@@ -60,39 +151,48 @@ def find_between(s, start, end):
 
 def get_home_pathway():
     """Get the home pathway."""
-    home_pathway = find_between(get_settings_data(), 'home_pathway="', '"')
-    return home_pathway
+    return get_settings().home_pathway
 
 
 def get_gpu_settings():
     """Get the GPU settings."""
-    settings_data = get_settings_data()
-    gpu_settings = find_between(settings_data, 'GPU_setting="', '"')
-    return gpu_settings
+    return get_settings().gpu_setting
 
 
 def get_cpu_settings():
     """Get the CPU settings."""
-    settings_data = get_settings_data()
-    cpu_settings = find_between(settings_data, 'CPU_setting="', '"')
-    return cpu_settings
+    return get_settings().cpu_setting
 
 
 def get_environment():
     """Get the environment."""
-    settings_data = get_settings_data()
-    environment = find_between(settings_data, 'environment="', '"')
-    return environment
+    return get_settings().environment
 
 
 def get_max_cpus():
     """Get the maximum number of CPUs to be used at once."""
-    return int(find_between(get_settings_data(), 'max_CPUs="', '"'))
+    return get_settings().max_cpus
 
 
 def get_max_gpus():
     """Get the maximum number of GPUs to be used at once."""
-    return int(find_between(get_settings_data(), 'max_GPUs="', '"'))
+    return get_settings().max_gpus
+
+
+def get_max_analyses():
+    """Get the maximum number of analyses to be run at once (optional, max_CPUs if not set)."""
+    return get_settings().max_analyses
+
+
+def get_analysis_settings():
+    """Get the Slurm settings of the analysis jobs (optional, the CPU settings if not set)."""
+    return get_settings().analysis_setting
+
+
+def get_analysis_cache_size():
+    """Get the maximum size of the analysis cache in MB (optional, 2000 MB if not set, 0 disables the cache)."""
+    return get_settings().analysis_cache_size
+
 
 def get_amberti_path():
     """Get the path to the amberti folder."""
@@ -153,6 +153,8 @@ def get_mode(simulation_id):
         return 'ti2p1'
     elif mode_number == '4':
         return 'ti2p2'
+    elif mode_number == '5':
+        return 'analysis'
     else:
         raise ValueError("There is invalid line in the queue file.")
 
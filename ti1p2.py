@@ -4,7 +4,9 @@ import argparse
 import os
 import textwrap
 
-from database_helper import add_job_id, check_if_job_id_null, modify_run_input
+from database_helper import add_job_id, check_if_job_id_null, get_run_context
+from mdin import transformation_parameters, stage_input, render_input
+from parm7 import read_stage_box, prepare_topology
 from settings_helper import get_cpu_settings, get_amberti_path
 from simulation_id_helper import get_run_name
 
@@ -28,182 +30,18 @@ if __name__ == '__main__':
     cpu_setting = get_cpu_settings()
     run_name = get_run_name(args.simulation_id)
 
-    ti_equi_7 = textwrap.dedent(f'''\
-    NPT MD w/No position restraints and PME (sander)
-     &cntrl
-      ntx    = 5,
-      irest  = 1,
-      ntpr   = 1000,
-      ntwx   = 10000,
-      ntwe   = 1000,
-      ig     = -1,
-    
-      ntf    = 1,
-      ntb    = 2,
-      ntp = 1, 
-      pres0 = 1.0, 
-      taup = 2.0,
-      gamma_ln = 2.0,
-      cut    = 9.0,
-      iwrap  = 1,
-      nsnb   = 10,
-    
-      nstlim = 200000,
-      t      = 0.0,
-      nscm   = 1000,
-      dt     = 0.001,
-    
-      temp0  = 300.0,
-      tempi  = 300.0,
-      ntt    = 3,
-      tautp  = 2.0,
-    
-      ntc    = 1,
-      iwrap=1, 
-      ioutfm=1, 
-      ntwv=-1,
-      ntave=1000,
-      icfe = 1, 
-      ifsc = 1,
-      timask1='{timask1}',
-      timask2='{timask2}',
-      scmask1='{scmask1},',
-      scmask2='{scmask2},',
-      clambda=0.5,
-    
-      ntr=1,
-      restraintmask = '!(:WAT,NA,CL)',
-      restraint_wt = 5.0,
-    
-    &end
-     &ewald
-       skinnb=2, 
-       nfft1=96, 
-       nfft2=96, 
-       nfft3=96,
-     /
-     ''')
-
-    ti_equi_7 = modify_run_input(run_name, ti_equi_7, 'ti1p2', '07_equi')
-
-    with open('07_ti_equi.in', 'w') as outfile:
-        outfile.write(ti_equi_7)
-
-    ti_equi_8 = textwrap.dedent(f'''\
-    NPT MD w/No position restraints and PME (sander)
-     &cntrl
-      ntx    = 5,
-      irest  = 1,
-      ntpr   = 1000,
-      ntwx   = 10000,
-      ntwe   = 1000,
-      ig     = -1,
-    
-      ntf    = 1,
-      ntb    = 2,
-      ntp = 1, 
-      pres0 = 1.0, 
-      taup = 2.0,
-      gamma_ln = 2.0,
-      cut    = 9.0,
-      iwrap  = 1,
-      nsnb   = 10,
-    
-      nstlim = 200000,
-      t      = 0.0,
-      nscm   = 1000,
-      dt     = 0.001,
-    
-      temp0  = 300.0,
-      tempi  = 300.0,
-      ntt    = 3,
-      tautp  = 2.0,
-    
-      ntc    = 1,
-      iwrap=1, 
-      ioutfm=1, 
-      ntwv=-1,
-      ntave=1000,
-      icfe = 1, 
-      ifsc = 1,
-      timask1='{timask1}',
-      timask2='{timask2}',
-      scmask1='{scmask1},',
-      scmask2='{scmask2},',
-      clambda=0.5,
-    
-      ntr=1,
-      restraintmask = '!(:WAT,NA,CL)',
-      restraint_wt = 2.0,
-    
-    &end
-     &ewald
-       skinnb=2, 
-       nfft1=96,
-       nfft2=96,
-       nfft3=96,
-     /
-     ''')
-
-    ti_equi_8 = modify_run_input(run_name, ti_equi_8, 'ti1p2', '08_equi')
-
-    with open('08_ti_equi.in', 'w') as outfile:
-        outfile.write(ti_equi_8)
-
-    ti_equi_9 = textwrap.dedent(f'''\
-    NPT MD w/No position restraints and PME (sander)
-     &cntrl
-      ntx    = 5,
-      irest  = 1,
-      ntpr   = 1000,
-      ntwx   = 10000,
-      ntwe   = 1000,
-      ig     = -1,
-    
-      ntf    = 1,
-      ntb    = 2,
-      ntp = 1, 
-      pres0 = 1.0, 
-      taup = 2.0,
-      gamma_ln = 2.0,
-      cut    = 9.0,
-      iwrap  = 1,
-      nsnb   = 10,
-    
-      nstlim = 600000,
-      t      = 0.0,
-      nscm   = 1000,
-      dt     = 0.001,
-    
-      temp0  = 300.0,
-      tempi  = 300.0,
-      ntt    = 3,
-      tautp  = 2.0,
-    
-      ntc    = 1,
-      ioutfm=1, 
-      ntwv=-1,
-      ntave=1000,
-      icfe = 1, 
-      ifsc = 1,
-      timask1='{timask1}',
-      timask2='{timask2}',
-      scmask1='{scmask1},',
-      scmask2='{scmask2},',
-      clambda=0.5,
-    
-    &end
-     &ewald
-       skinnb=2, 
-       nfft1=96, 
-       nfft2=96, 
-       nfft3=96,
-     /
-     ''')
-
-    ti_equi_9 = modify_run_input(run_name, ti_equi_9, 'ti1p2', '09_equi')
-    with open('09_ti_equi.in', 'w') as outfile:
-        outfile.write(ti_equi_9)
+    # Inputs of the equilibrations, with the modifications of the run
+    context = get_run_context(run_name)
+    modifications = context['modifications']
+    masks = transformation_parameters(timask1, timask2, scmask1, scmask2)
+    # PME grid and skin for the box of the system after the heating (the box of the later equilibrations is not known
+    # yet)
+    box = read_stage_box([f'{complex}_ti_heat.rst7', f'{complex}.rst7'], f'{complex}.parm7')
+    # With hydrogen mass repartitioning, the simulations use the repartitioned topology
+    parm7 = prepare_topology(complex, context['hmr'])
+    for stage, file in (('07_equi', '07_ti_equi.in'), ('08_equi', '08_ti_equi.in'), ('09_equi', '09_ti_equi.in')):
+        with open(file, 'w') as outfile:
+            outfile.write(render_input(stage_input(stage, modifications, box, context['hmr'], **masks)))
 
     ti1p2_script = textwrap.dedent(f'''\
 #!/bin/bash
@@ -215,9 +53,9 @@ trap "python3 {os.path.join(get_amberti_path(), "update_job_status.py")} -r {arg
 
 python3 {os.path.join(get_amberti_path(), "update_job_status.py")} -r {args.simulation_id} -s 2
 
-mpirun -np 40 pmemd.MPI -O -i 07_ti_equi.in -c {complex}_ti_heat.rst7 -p {complex}.parm7 -o {complex}_ti_equi1.out -r {complex}_ti_equi1.rst7 -x {complex}_ti_equi1.nc -ref {complex}_ti_heat.rst7
-mpirun -np 40 pmemd.MPI -O -i 08_ti_equi.in -c {complex}_ti_equi1.rst7 -p {complex}.parm7 -o {complex}_ti_equi2.out -r {complex}_ti_equi2.rst7 -x {complex}_ti_equi2.nc -ref {complex}_ti_equi1.rst7
-mpirun -np 40 pmemd.MPI -O -i 09_ti_equi.in -c {complex}_ti_equi2.rst7 -p {complex}.parm7 -o {complex}_ti_equi.out -r {complex}_ti_equi.rst7 -x {complex}_ti_equi.nc
+mpirun -np 40 pmemd.MPI -O -i 07_ti_equi.in -c {complex}_ti_heat.rst7 -p {parm7} -o {complex}_ti_equi1.out -r {complex}_ti_equi1.rst7 -x {complex}_ti_equi1.nc -ref {complex}_ti_heat.rst7
+mpirun -np 40 pmemd.MPI -O -i 08_ti_equi.in -c {complex}_ti_equi1.rst7 -p {parm7} -o {complex}_ti_equi2.out -r {complex}_ti_equi2.rst7 -x {complex}_ti_equi2.nc -ref {complex}_ti_equi1.rst7
+mpirun -np 40 pmemd.MPI -O -i 09_ti_equi.in -c {complex}_ti_equi2.rst7 -p {parm7} -o {complex}_ti_equi.out -r {complex}_ti_equi.rst7 -x {complex}_ti_equi.nc
 
 python3 {os.path.join(get_amberti_path(), "update_job_status.py")} -r {args.simulation_id} -s 3
 ''')
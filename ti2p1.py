@@ -3,15 +3,13 @@
 import argparse
 import os
 import textwrap
-from database_helper import add_job_id, check_if_job_id_null, modify_run_input
+from database_helper import add_job_id, check_if_job_id_null, get_run_context, get_lambda_schedule
+from mdin import transformation_parameters, stage_input, render_input
+from parm7 import read_stage_box, prepare_topology
 from settings_helper import get_gpu_settings, get_amberti_path
 from simulation_id_helper import get_run_name
 
 if __name__ == '__main__':
-    clambda_list = [0.00922, 0.04794, 0.11505, 0.20634, 0.31608, 0.43738, 0.56262, 0.68392, 0.79366, 0.88495, 0.95206,
-                    0.99078]
-    mid_lambda_index = int(len(clambda_list)/2)-1
-
     parser = argparse.ArgumentParser(description='This script runs TI')
     parser.add_argument('-c', '--complex', help='Name of complex', required=True)
     parser.add_argument('--timask1', help='timask1', required=True)
@@ -19,7 +17,7 @@ if __name__ == '__main__':
     parser.add_argument('--scmask1', help='scmask1', required=True)
     parser.add_argument('--scmask2', help='scmask2', required=True)
     parser.add_argument('--start', help='Start from this lambda, works only in case of skipeq', default=0, required=False)
-    parser.add_argument('--end', help='End at this lambda, works only in case of skipeq', default=len(clambda_list) - 1,
+    parser.add_argument('--end', help='End at this lambda, works only in case of skipeq', default=None,
                         required=False)
     parser.add_argument('-r', '--simulation_id', help='Run id of the simulation', required=False, default="no_id")
 
@@ -30,13 +28,28 @@ if __name__ == '__main__':
     timask2 = args.timask2
     scmask1 = args.scmask1
     scmask2 = args.scmask2
-    start = int(args.start)
-    end = int(args.end)
-    length = end - start + 1
 
     gpu_setting = get_gpu_settings()
     run_name = get_run_name(args.simulation_id)
 
+    # Lambda values of the windows, saved for the run by run_several_sims
+    schedule, clambda_list, weights = get_lambda_schedule(run_name)
+    mid_lambda_index = max(int(len(clambda_list)/2)-1, 0)
+    upper_windows = ' '.join(str(i) for i in range(mid_lambda_index + 1, len(clambda_list)))
+    lower_windows = ' '.join(str(i) for i in range(mid_lambda_index - 1, -1, -1))
+
+    start = int(args.start)
+    end = len(clambda_list) - 1 if args.end is None else int(args.end)
+    length = end - start + 1
+
+    context = get_run_context(run_name)
+    modifications = context['modifications']
+    masks = transformation_parameters(timask1, timask2, scmask1, scmask2)
+    # PME grid and skin for the box of the system after the NPT equilibration of ti1p2
+    box = read_stage_box([f'{complex}_ti_equi.rst7', f'{complex}.rst7'], f'{complex}.parm7')
+    # With hydrogen mass repartitioning, the simulations use the repartitioned topology
+    parm7 = prepare_topology(complex, context['hmr'])
+
     for i in range(start, end + 1):
         dir = i
         clambda = clambda_list[i]
@@ -45,51 +58,7 @@ if __name__ == '__main__':
 
         os.chdir("%s" % (dir))
 
-        string = textwrap.dedent(f'''
-            NVT MD w/No position restraints and PME (sander)
-             &cntrl
-              ntx    = 1,
-              irest  = 0,
-              ntpr   = 1000,
-              ntwx   = 50000,
-              ntwe   = 1000,
-              ig     = -1,
-              ntf    = 1,
-              ntb    = 1,
-              cut    = 9.0,
-              iwrap  = 1,
-              nsnb   = 10,
-              nstlim = 500000,
-              t      = 0.0,
-              nscm   = 1000,
-              dt     = 0.001,
-              temp0  = 300.0,
-              tempi  = 300.0,
-              ntt    = 1,
-              tautp  = 2.0,
-              ntc    = 1,
-              ioutfm=1, 
-              ntwv=-1,
-              ntave=1000,
-              icfe = 1, 
-              ifsc = 1,
-              timask1='{timask1}',
-              timask2='{timask2}',
-              scmask1='{scmask1},',
-              scmask2='{scmask2},',
-              clambda={clambda},
-            &end
-    
-             &ewald
-               skinnb=2, 
-               nfft1=96, 
-               nfft2=96, 
-               nfft3=96,
-             /
-    
-            ''')
-
-        string = modify_run_input(run_name, string, 'ti2p1')
+        string = render_input(stage_input('ti2p1', modifications, box, context['hmr'], **masks, clambda=clambda))
 
         with open('%s_equi.in' % dir, 'w') as outfile:
             outfile.write(string)
@@ -107,22 +76,22 @@ trap "python3 {os.path.join(get_amberti_path(), "update_job_status.py")} -r {arg
 python3 {os.path.join(get_amberti_path(), "update_job_status.py")} -r {args.simulation_id} -s 2
 
 cd {mid_lambda_index}
-pmemd.cuda -O -i {mid_lambda_index}_equi.in -c ../{complex}_ti_equi.rst7 -p ../{complex}.parm7 -o {complex}_equi_{mid_lambda_index}.out -r {complex}_equi_{mid_lambda_index}.rst7 -x {complex}_equi_{mid_lambda_index}.nc
+pmemd.cuda -O -i {mid_lambda_index}_equi.in -c ../{complex}_ti_equi.rst7 -p ../{parm7} -o {complex}_equi_{mid_lambda_index}.out -r {complex}_equi_{mid_lambda_index}.rst7 -x {complex}_equi_{mid_lambda_index}.nc
 cd ..
 
-for i in {{{mid_lambda_index+1}..{len(clambda_list) - 1}}}
+for i in {upper_windows}
 do
 cd ${{i}}
 export j=$(echo "$i-1" | bc);
-pmemd.cuda -O -i ${{i}}_equi.in -c ../${{j}}/{complex}_equi_${{j}}.rst7 -p ../{complex}.parm7 -o {complex}_equi_${{i}}.out -r {complex}_equi_${{i}}.rst7 -x {complex}_equi_${{i}}.nc
+pmemd.cuda -O -i ${{i}}_equi.in -c ../${{j}}/{complex}_equi_${{j}}.rst7 -p ../{parm7} -o {complex}_equi_${{i}}.out -r {complex}_equi_${{i}}.rst7 -x {complex}_equi_${{i}}.nc
 cd ..
 done
 
-for i in {{{mid_lambda_index-1}..0..-1}}
+for i in {lower_windows}
 do
 cd ${{i}}
 export j=$(echo "$i+1" | bc);
-pmemd.cuda -O -i ${{i}}_equi.in -c ../${{j}}/{complex}_equi_${{j}}.rst7 -p ../{complex}.parm7 -o {complex}_equi_${{i}}.out -r {complex}_equi_${{i}}.rst7 -x {complex}_equi_${{i}}.nc
+pmemd.cuda -O -i ${{i}}_equi.in -c ../${{j}}/{complex}_equi_${{j}}.rst7 -p ../{parm7} -o {complex}_equi_${{i}}.out -r {complex}_equi_${{i}}.rst7 -x {complex}_equi_${{i}}.nc
 cd ..
 done
 
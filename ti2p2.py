@@ -3,13 +3,14 @@
 import argparse
 import os
 import textwrap
-from database_helper import add_job_id, check_if_job_id_null, modify_run_input
+from database_helper import add_job_id, check_if_job_id_null, get_run_context, get_early_stopping_targets, \
+    get_lambda_schedule, get_pilot_fraction
+from mdin import transformation_parameters, stage_input, render_input
+from parm7 import read_stage_box, prepare_topology
 from settings_helper import get_gpu_settings, get_environment, get_amberti_path
 from simulation_id_helper import get_run_name
 
 if __name__ == '__main__':
-    clambda_list = [0.00922, 0.04794, 0.11505, 0.20634, 0.31608, 0.43738, 0.56262, 0.68392, 0.79366, 0.88495, 0.95206,
-                    0.99078]
 
     parser = argparse.ArgumentParser(description='This script runs TI')
     parser.add_argument('-c', '--complex', help='Name of complex', required=True)
@@ -18,7 +19,7 @@ if __name__ == '__main__':
     parser.add_argument('--scmask1', help='scmask1', required=True)
     parser.add_argument('--scmask2', help='scmask2', required=True)
     parser.add_argument('--start', help='Start from this lambda, works only in case of skipeq', default=0, required=False)
-    parser.add_argument('--end', help='End at this lambda, works only in case of skipeq', default=len(clambda_list) - 1,
+    parser.add_argument('--end', help='End at this lambda, works only in case of skipeq', default=None,
                         required=False)
     parser.add_argument('-r', '--simulation_id', help='Run id of the simulation', required=False, default="no_id")
 
@@ -29,69 +30,100 @@ if __name__ == '__main__':
     timask2 = args.timask2
     scmask1 = args.scmask1
     scmask2 = args.scmask2
-    start = int(args.start)
-    end = int(args.end)
-    length = end - start + 1
 
     gpu_setting = get_gpu_settings()
     environment = get_environment()
     run_name = get_run_name(args.simulation_id)
 
+    # Lambda values of the windows, saved for the run by run_several_sims
+    schedule, clambda_list, weights = get_lambda_schedule(run_name)
+
+    start = int(args.start)
+    end = len(clambda_list) - 1 if args.end is None else int(args.end)
+    if start > end:
+        parser.error(f'--start {start} is after --end {end}')
+    length = end - start + 1
+
+    # With adaptive sampling, the windows first run only a pilot pass
+    pilot_fraction = get_pilot_fraction(run_name)
+
+    context = get_run_context(run_name)
+    modifications = context['modifications']
+    masks = transformation_parameters(timask1, timask2, scmask1, scmask2)
+    # With hydrogen mass repartitioning, the simulations use the repartitioned topology
+    parm7 = prepare_topology(complex, context['hmr'])
+    # Number of MD steps of a window, with adaptive sampling the windows first run only a pilot pass of it
+    nstlim = int(stage_input('ti2p2', modifications, None, context['hmr'], **masks,
+                             clambda=clambda_list[0])['namelists'][0][1]['nstlim'])
+
     for i in range(start, end + 1):
 
         dir = i
         clambda = clambda_list[i]
         os.chdir("%s" % (dir))
-        string = textwrap.dedent(f'''\
-        NVT MD w/No position restraints and PME (sander)
-         &cntrl
-          ntx    = 1,
-          irest  = 0,
-          ntpr   = 1000,
-          ntwx   = 50000,
-          ntwe   = 1000,
-          ig     = -1,
-          ntf    = 1,
-          ntb    = 1,
-          cut    = 9.0,
-          iwrap  = 1,
-          nsnb   = 10,
-          nstlim = 715000,
-          t      = 0.0,
-          nscm   = 1000,
-          dt     = 0.001,
-          temp0  = 300.0,
-          tempi  = 300.0,
-          ntt    = 1,
-          tautp  = 2.0,
-          ntc    = 1,
-          ioutfm=1, 
-          ntwv=-1,
-          ntave=1000,
-          icfe = 1, 
-          ifsc = 1,
-          timask1='{timask1}',
-          timask2='{timask2}',
-          scmask1='{scmask1},',
-          scmask2='{scmask2},',
-          clambda={clambda},
-        &end
-    
-         &ewald
-           skinnb=2, 
-           nfft1=96, 
-           nfft2=96, 
-           nfft3=96,
-         /
-    
-        ''')
-
-        string = modify_run_input(run_name, string, 'ti2p2')
+        # PME grid and skin for the box of the window after its equilibration
+        box = read_stage_box([f'{complex}_equi_{i}.rst7', f'../{complex}_ti_equi.rst7', f'../{complex}.rst7'],
+                             f'../{complex}.parm7')
+        namelists = stage_input('ti2p2', modifications, box, context['hmr'], **masks, clambda=clambda)
+
+        if pilot_fraction is not None:
+            cntrl = namelists['namelists'][0][1]
+            ntpr = int(cntrl['ntpr'])
+            cntrl['nstlim'] = max(int(nstlim * pilot_fraction) // ntpr, 1) * ntpr
+        string = render_input(namelists)
 
         with open('%s_prod.in' % dir, 'w') as outfile:
             outfile.write(string)
         os.chdir('../')
 
+    pmemd_command = (f'pmemd.cuda -O -i ${{i}}_prod.in -c {complex}_equi_${{i}}.rst7 -p ../{parm7} '
+                     f'-o {complex}_prod_{run_name}_${{i}}.out -r {complex}_prod_{run_name}_${{i}}.rst7 '
+                     f'-x {complex}_prod_{run_name}_${{i}}.nc')
+
+    # With early stopping, every window is followed by the online monitor, which may end it before nstlim.
+    # A window stopped by the monitor leaves the stop file behind, so that its termination is not treated as an error.
+    target_error, target_convergence = get_early_stopping_targets(run_name)
+    stop_file = 'early_stop'
+    if target_error is not None:
+        production_loop = textwrap.dedent(f'''\
+{environment}
+
+for i in {{0..{len(clambda_list) - 1}}}
+do
+cd ${{i}}
+rm -f {stop_file}
+{pmemd_command} &
+pmemd_pid=$!
+python3 {os.path.join(get_amberti_path(), "online_monitor.py")} -r {args.simulation_id} -l ${{i}} -f {complex}_prod_{run_name}_${{i}}.out -p $pmemd_pid -s {stop_file} &
+monitor_pid=$!
+wait $pmemd_pid || [ -f {stop_file} ]
+wait $monitor_pid || true
+cd ..
+done
+''')
+    else:
+        production_loop = textwrap.dedent(f'''\
+for i in {{0..{len(clambda_list) - 1}}}
+do
+cd ${{i}}
+{pmemd_command}
+cd ..
+done
+''')
+
+    # The analysis is not run here but queued as a separate CPU stage once the simulation is finished, so that the
+    # GPU is released as soon as the MD ends
+    if pilot_fraction is not None:
+        # The extension job sent by adaptive_sampling finishes the simulation
+        finish = textwrap.dedent(f'''\
+{environment}
+python3 {os.path.join(get_amberti_path(), "adaptive_sampling.py")} -r {args.simulation_id} -n {nstlim}
+''')
+    else:
+        finish = textwrap.dedent(f'''\
+python3 {os.path.join(get_amberti_path(), "update_job_status.py")} -r {args.simulation_id} -s 3
+''')
+
     string = textwrap.dedent(f'''\
 #!/bin/bash
 #SBATCH --time=20:00:00
@@ -102,18 +134,9 @@ trap "python3 {os.path.join(get_amberti_path(), "update_job_status.py")} -r {arg
 
 python3 {os.path.join(get_amberti_path(), "update_job_status.py")} -r {args.simulation_id} -s 2 
 
-for i in {{0..{len(clambda_list) - 1}}}
-do
-cd ${{i}}
-pmemd.cuda -O -i ${{i}}_prod.in -c {complex}_equi_${{i}}.rst7 -p ../{complex}.parm7 -o {complex}_prod_{run_name}_${{i}}.out -r {complex}_prod_{run_name}_${{i}}.rst7 -x {complex}_prod_{run_name}_${{i}}.nc
-cd ..
-done
-
-python3 {os.path.join(get_amberti_path(), "update_job_status.py")} -r {args.simulation_id} -s 3
+{production_loop}
 
-{environment}
-python3 {os.path.join(get_amberti_path(), "analyse_data_after_run.py")} -r {args.simulation_id}
-''')
+{finish}''')
 
     with open('ti2p2.txt', 'w') as outfile:
         outfile.write(string)
@@ -1,6 +1,6 @@
 """When the simulation ends, this code is invoked to check whether there is any other simulation waiting to be called
 and if there is one, it will send it into a row
-Also will analyse the ended simulation
+When ti2p2 ends, the analysis of the transformation is added to the queue as its own CPU stage
 
 When the simulation starts changes the status of the simulation to running
 
@@ -12,7 +12,7 @@ import argparse
 
 from database_helper import update_job_status, insert_into_simulations
 from settings_helper import get_amberti_path
-from simulation_id_helper import get_updated_simulation_id
+from simulation_id_helper import get_updated_simulation_id, get_mode
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='This script takes care of the queue of simulations after simulation '
@@ -29,11 +29,13 @@ if __name__ == '__main__':
 
     # If the simulation ends, it will check if there is any other follow-up simulation to be called
     if job_status == 3:
-        if ('_all_' in simulation_id and '_4_' not in simulation_id) or (
+        # ti2p2 is always followed by the analysis of the transformation, which is the last stage
+        mode = get_mode(simulation_id)
+        if mode == 'ti2p2' or mode != 'analysis' and (('_all_' in simulation_id and '_4_' not in simulation_id) or (
                 '_ti1_' in simulation_id and '_1_' in simulation_id) or (
-                '_ti2_' in simulation_id and '_3_' in simulation_id):
+                '_ti2_' in simulation_id and '_3_' in simulation_id)):
             updated_sim_id = get_updated_simulation_id(simulation_id)
-            is_gpu = 0 if '_2_' in updated_sim_id else 1
+            is_gpu = 0 if get_mode(updated_sim_id) in ('ti1p2', 'analysis') else 1
             insert_into_simulations(updated_sim_id, is_gpu)
 
     # If the simulation ends or gives error, it will check if there is any other simulation waiting to be called